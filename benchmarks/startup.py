@@ -0,0 +1,88 @@
+"""
+Measure the startup time of the command-line entry points.
+
+Each scenario is run several times in a fresh interpreter, so that nothing
+is cached between runs, and its median duration is compared to a budget. The
+exit code is non-zero if any budget is exceeded.
+"""
+
+import click
+import statistics
+import subprocess
+import sys
+import time
+
+SCENARIOS = [
+    (
+        'pylar-broker --help',
+        "from pylar.entry_points import broker; broker(['--help'])",
+        0.3,
+    ),
+    (
+        'pylar-service --help',
+        "from pylar.entry_points import service; service(['--help'])",
+        0.3,
+    ),
+    (
+        'pylar-service (entry points scan)',
+        "from pylar.entry_points import get_entry_points; "
+        "get_entry_points('pylar_services')",
+        0.3,
+    ),
+    (
+        'pylar-service (service import)',
+        "from pylar.entry_points import import_service; "
+        "import_service('pylar.arithmetic_service.ArithmeticService')",
+        0.5,
+    ),
+]
+
+
+def measure(code, runs):
+    durations = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        durations.append(time.perf_counter() - start)
+
+    return statistics.median(durations)
+
+
+@click.command()
+@click.option('-n', '--runs', default=10, help="The number of runs.")
+@click.option(
+    '-f',
+    '--budget-factor',
+    default=1.0,
+    help="A factor to apply to all the budgets, for slow machines.",
+)
+def main(runs, budget_factor):
+    baseline = measure('pass', runs)
+    click.echo("Interpreter startup: %.3fs" % baseline)
+    failed = False
+
+    for name, code, budget in SCENARIOS:
+        budget *= budget_factor
+        duration = measure(code, runs)
+
+        if duration > budget:
+            failed = True
+            status = click.style('over budget', fg='red')
+        else:
+            status = click.style('ok', fg='green')
+
+        click.echo(
+            "%s: %.3fs (budget: %.3fs) %s" % (name, duration, budget, status),
+        )
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
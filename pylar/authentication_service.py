@@ -2,10 +2,25 @@
 Authentication service.
 """
 
-from .domain import user_domain
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .client_context import ClientContext
+from .domain import (
+    BROKER_DOMAIN,
+    user_domain,
+)
 from .errors import CallError
 from .log import logger as main_logger
+from .security import (
+    generate_salt,
+    hash_password,
+    verify_password,
+)
 from .service import Service
+from .user_store import MemoryUserStore
 
 logger = main_logger.getChild('authentication_service')
 
@@ -13,16 +28,31 @@ logger = main_logger.getChild('authentication_service')
 class AuthenticationService(Service):
     name = 'authentication'
 
-    def __init__(self, **kwargs):
+    def __init__(self, *, user_store=None, max_workers=4, **kwargs):
         super().__init__(**kwargs)
 
-        self._users = {}
+        # Password hashing is slow on purpose: it must not block the loop.
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.add_cleanup(partial(self.__executor.shutdown, wait=False))
 
-        # TODO: Remove this.
-        self.add_user('alice', 'password')
-        self.add_user('bob', 'password')
+        if user_store is None:
+            self.user_store = MemoryUserStore()
+
+            # TODO: Remove this.
+            self.__default_users = self.add_task(
+                asyncio.gather(
+                    self.add_user('alice', 'password'),
+                    self.add_user('bob', 'password'),
+                    loop=self.loop
+                ),
+            )
+        else:
+            self.user_store = user_store
+            self.__default_users = None
 
-    def add_user(self, username, password):
+        self.add_cleanup(self.user_store.close)
+
+    async def add_user(self, username, password):
         """
         Add or replace an user in the users database.
 
@@ -30,16 +60,29 @@ class AuthenticationService(Service):
         :param password: The password.
         """
         domain = user_domain(username)
-        self._users[domain] = password.encode('utf-8')
+        existed = await self.loop.run_in_executor(
+            self.__executor,
+            self.__set_user,
+            domain,
+            password,
+        )
+
+        if existed:
+            self.add_task(self.revoke(domain))
 
-    def remove_user(self, username):
+    async def remove_user(self, username):
         """
         Remove a user from the users database.
 
         :param username: The username.
         """
         domain = user_domain(username)
-        self._users.pop(domain)
+        await self.loop.run_in_executor(
+            self.__executor,
+            self.user_store.remove,
+            domain,
+        )
+        self.add_task(self.revoke(domain))
 
     @Service.command(use_context=True)
     async def authenticate(self, context, password):
@@ -49,10 +92,78 @@ class AuthenticationService(Service):
         :param context: The caller's context.
         :param password: The encoded password.
         """
+        return [await self._authenticate(context, password)]
+
+    @Service.command(use_context=True)
+    async def authenticate_many(self, context, *frames):
+        """
+        Authenticate several domains at once on behalf of the broker.
+
+        :param context: The caller's context. Must be the broker.
+        :param frames: A flat list of domains and encoded passwords.
+        :returns: A flat list of result codes and tokens (or error messages).
+        """
+        if context.domain != BROKER_DOMAIN:
+            raise CallError(
+                code=403,
+                message="Only the broker may authenticate in bulk.",
+            )
+
+        logger.debug(
+            "Received bulk authentication request for %d domain(s).",
+            len(frames) // 2,
+        )
+        results = await asyncio.gather(
+            *[
+                self._authenticate(
+                    ClientContext(domain=domain, token=None),
+                    password,
+                )
+                for domain, password in zip(frames[::2], frames[1::2])
+            ],
+            return_exceptions=True,
+            loop=self.loop
+        )
+        result = []
+
+        for token in results:
+            if isinstance(token, CallError):
+                result.extend([
+                    ('%d' % token.code).encode('utf-8'),
+                    token.message.encode('utf-8'),
+                ])
+            elif isinstance(token, Exception):
+                logger.error(
+                    "Unexpected error during bulk authentication (%s).",
+                    token,
+                )
+                result.extend([b'500', b'Internal error.'])
+            else:
+                result.extend([b'200', token])
+
+        return result
+
+    async def _authenticate(self, context, password):
+        """
+        Authenticate a domain.
+
+        :param context: The context to authenticate.
+        :param password: The encoded password.
+        :returns: The authentication token.
+        """
         logger.debug("Received authentication request for: %s", context)
-        ref_password = self._users.get(context.domain)
 
-        if not ref_password:
+        if self.__default_users is not None:
+            await self.__default_users
+
+        valid = await self.loop.run_in_executor(
+            self.__executor,
+            self.__check_password,
+            context.domain,
+            password,
+        )
+
+        if valid is None:
             logger.warning(
                 "Authentication failed for %s: unknown username.",
                 context,
@@ -62,7 +173,7 @@ class AuthenticationService(Service):
                 message="Unknown username.",
             )
 
-        if ref_password != password:
+        if not valid:
             logger.warning(
                 "Authentication failed for %s: invalid password.",
                 context,
@@ -72,4 +183,27 @@ class AuthenticationService(Service):
                 message="Invalid password.",
             )
 
-        return [b'']
+        return b''
+
+    # Private methods.
+
+    def __set_user(self, domain, password):
+        existed = self.user_store.get(domain) is not None
+        salt = generate_salt()
+        self.user_store.set(
+            domain,
+            salt,
+            hash_password(password.encode('utf-8'), salt),
+        )
+
+        return existed
+
+    def __check_password(self, domain, password):
+        user = self.user_store.get(domain)
+
+        if user is None:
+            return None
+
+        salt, hash = user
+
+        return verify_password(password, salt, hash)
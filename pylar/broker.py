@@ -6,22 +6,48 @@ A broker class.
 import asyncio
 import azmq
 import logging
-import struct
+import os
 
 from azmq.common import AsyncTimeout
 from binascii import hexlify
+from cachetools import TTLCache
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from itertools import count
+from pyslot import Signal
 from uuid import uuid4
 
 from .async_object import AsyncObject
-from .errors import CallError
+from .common import (
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+    deserialize_header,
+    get_priority,
+    get_timeout,
+    pack_frames,
+    unpack_frames,
+)
+from .domain import BROKER_DOMAIN
+from .errors import (
+    CallError,
+    InvalidReplyError,
+)
 from .generic_client import GenericClient
 from .log import logger as main_logger
-from .security import verify_hash
+from .notification_queue import NotificationQueue
+from .peer import Peer
+from .replica import Replica
+from .security import (
+    digest_credentials,
+    verify_hash,
+)
+from .topics import TopicTrie
 
 logger = main_logger.getChild('broker')
 
+SNAPSHOT_MAGIC = b'pylar-snapshot-1'
+
 
 class Connection(GenericClient):
     def __init__(
@@ -42,8 +68,9 @@ class Connection(GenericClient):
         self.__on_request_cb = on_request_cb
         self.__on_notification_cb = on_notification_cb
 
-        # The receiving queue.
-        self.__queue = asyncio.Queue(loop=self.loop)
+        # The receiving queue. Urgent requests are read first.
+        self.__queue = asyncio.PriorityQueue(loop=self.loop)
+        self.__queue_counter = count()
 
         # The dying timer.
         self.__timeout = AsyncTimeout(
@@ -56,6 +83,8 @@ class Connection(GenericClient):
 
         # Public attributes.
         self.domains = {}
+        self.draining_domains = set()
+        self.session = None
 
     def __str__(self):
         return hexlify(self.identity).decode('utf-8')
@@ -72,7 +101,12 @@ class Connection(GenericClient):
 
         :param frames: The frames to receive.
         """
-        await self.__queue.put(frames)
+        priority = PRIORITY_NORMAL
+
+        if len(frames) > 2 and frames[0] == b'request':
+            priority = get_priority(deserialize_header(frames[2]))
+
+        await self.__queue.put((priority, next(self.__queue_counter), frames))
 
     async def _read(self):
         """
@@ -80,19 +114,30 @@ class Connection(GenericClient):
 
         :returns: The read frames.
         """
-        return await self.__queue.get()
+        _, _, frames = await self.__queue.get()
+
+        return frames
 
-    async def _write(self, frames):
+    async def _write(self, frames, priority=PRIORITY_NORMAL):
         """
         Write frames.
 
         :param frames: The frames to write.
+        :param priority: The priority of the frames.
         """
         frames.insert(0, b'')
         frames.insert(0, self.identity)
         await self.socket.send_multipart(frames)
 
-    async def request(self, domain, source_domain, source_token, args):
+    async def request(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        args,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+    ):
         """
         Send a generic request from a specified domain.
 
@@ -101,6 +146,8 @@ class Connection(GenericClient):
             is made.
         :param source_token: The token for the source domain.
         :param args: A list of frames to pass.
+        :param priority: The request priority.
+        :param timeout: The request timeout, in seconds.
         :returns: The request result.
         """
         assert domain is not None
@@ -112,16 +159,17 @@ class Connection(GenericClient):
         ]
         frames.extend(args)
 
-        return await self._request(frames)
+        return await self._request(frames, priority, timeout)
 
-    async def _on_request(self, frames):
+    async def _on_request(self, frames, header):
         """
         Called whenever a request is received.
 
         :param frames: The request frames.
+        :param header: The request header.
         :returns: A list of frames that constitute the reply.
         """
-        return await self.__on_request_cb(self, frames)
+        return await self.__on_request_cb(self, frames, header)
 
     async def notification(
         self,
@@ -163,12 +211,32 @@ class Connection(GenericClient):
         """
         return await self.__on_notification_cb(self, frames)
 
+    async def advertise(self, type_, domains):
+        """
+        Advertise domain changes to a peer broker.
+
+        :param type_: The advertisement type.
+        :param domains: A list of domains.
+        """
+        frames = [type_]
+        frames.extend(domains)
+
+        return await self._notification(frames)
+
 
 class LinkConnection(object):
     def __init__(self, connection):
         self.connection = connection
 
-    async def request(self, domain, source_domain, source_token, args):
+    async def request(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        args,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+    ):
         """
         Send a generic request from a specified domain.
 
@@ -177,6 +245,8 @@ class LinkConnection(object):
             is made.
         :param source_token: The token for the source domain.
         :param args: A list of frames to pass.
+        :param priority: The request priority.
+        :param timeout: The request timeout, in seconds.
         :returns: The request result.
         """
         return await self.connection.request(
@@ -187,6 +257,8 @@ class LinkConnection(object):
                 b'dispatch',
                 domain,
             ] + list(args),
+            priority=priority,
+            timeout=timeout,
         )
 
     async def notification(
@@ -221,6 +293,69 @@ class LinkConnection(object):
             ] + list(args),
         )
 
+
+class PeerConnection(object):
+    def __init__(self, peer):
+        self.peer = peer
+
+    async def request(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        args,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+    ):
+        """
+        Send a generic request from a specified domain.
+
+        :param domain: The domain for which the request is destined.
+        :param source_domain: The source domain in behalf of which the request
+            is made.
+        :param source_token: The token for the source domain.
+        :param args: A list of frames to pass.
+        :param priority: The request priority.
+        :param timeout: The request timeout, in seconds.
+        :returns: The request result.
+        """
+        return await self.peer.forward(
+            domain=domain,
+            source_domain=source_domain,
+            source_token=source_token,
+            args=args,
+            priority=priority,
+            timeout=timeout,
+        )
+
+    async def notification(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        type_,
+        args,
+    ):
+        """
+        Send a generic notification from a specified domain.
+
+        :param domain: The domain for which the request is destined.
+        :param source_domain: The source domain in behalf of which the request
+            is made.
+        :param source_token: The token for the source domain.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        :returns: The request result.
+        """
+        return await self.peer.forward_notification(
+            domain=domain,
+            source_domain=source_domain,
+            source_token=source_token,
+            type_=type_,
+            args=args,
+        )
+
+
 class Broker(AsyncObject):
     SERVICE_DOMAIN_PREFIX = b'service'
     SERVICE_AUTHENTICATION_DOMAIN = b'%s/%s' % (
@@ -232,25 +367,183 @@ class Broker(AsyncObject):
         b'link',
     )
 
-    def __init__(self, *, socket, shared_secret, **kwargs):
+    def __init__(
+        self,
+        *,
+        shared_secret,
+        socket=None,
+        sockets=(),
+        peer_sockets=(),
+        authentication_cache_size=4096,
+        authentication_cache_ttl=60.0,
+        authentication_batch_size=256,
+        authentication_batch_delay=0.005,
+        credentials_cache_size=1024,
+        credentials_cache_ttl=3600.0,
+        notification_queue_directory=None,
+        notification_queue_max_size=64 * 1024 * 1024,
+        notification_queue_max_queues=1024,
+        notification_queue_max_total_size=1024 * 1024 * 1024,
+        notification_replay_batch_size=64,
+        snapshot_path=None,
+        snapshot_interval=5.0,
+        session_restore_timeout=60.0,
+        replicate_from=None,
+        replication_max_missed_pings=3,
+        max_concurrent_requests=None,
+        **kwargs
+    ):
         super().__init__(**kwargs)
-        self.socket = socket
+        self.sockets = []
         self.shared_secret = shared_secret
 
+        # The number of requests each connection may have processed at once.
+        # Requests in excess wait for a slot, the most urgent first.
+        self.__max_concurrent_requests = max_concurrent_requests
+
+        if authentication_cache_size and authentication_cache_ttl:
+            self.__authentication_cache = TTLCache(
+                maxsize=authentication_cache_size,
+                ttl=authentication_cache_ttl,
+            )
+        else:
+            self.__authentication_cache = None
+
+        self.__authentication_batch_size = authentication_batch_size
+        self.__authentication_batch_delay = authentication_batch_delay
+        self.__authentication_batch = []
+        self.__authentication_batch_handle = None
+
+        # Services and peers keep sending the same credentials when they
+        # re-register: once verified, those act as a resumption ticket.
+        if credentials_cache_size and credentials_cache_ttl:
+            self.__credentials_cache = TTLCache(
+                maxsize=credentials_cache_size,
+                ttl=credentials_cache_ttl,
+            )
+        else:
+            self.__credentials_cache = None
+
         self.__connection_timeout = 10.0
         self.__connections = {}
         self.__connections_by_domain = {}
+        self.__peer_connections = set()
+        self.__peers_by_domain = {}
+        self.__topics = TopicTrie()
+
+        # The connections that got the first copy of hedged requests, so
+        # that the other copies go elsewhere. They are kept for a while after
+        # the first copy completes, as the others may still be on their way.
+        self.__hedged_connections = TTLCache(maxsize=4096, ttl=10.0)
+
+        # Notifications for absent domains are kept on disk and replayed
+        # when the domains come back.
+        if notification_queue_directory is not None:
+            self.__notification_queue = NotificationQueue(
+                directory=notification_queue_directory,
+                max_size=notification_queue_max_size,
+                max_queues=notification_queue_max_queues,
+                max_total_size=notification_queue_max_total_size,
+            )
+
+            # The queues do blocking IO and are not thread-safe: they are
+            # only ever used from this thread, which runs the calls in order.
+            self.__notification_executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.__notification_queue = None
+
+        self.__notification_replay_batch_size = notification_replay_batch_size
+        self.__replaying_domains = set()
+        self.__replay_tasks = set()
+
+        # The number of notifications queued for each domain, so that a
+        # replay knows whether some were queued while it was reading.
+        self.__queued_notifications = {}
         self.__command_handlers = {
             b'register': self.__register_request,
             b'unregister': self.__unregister_request,
             b'request': self.__request_request,
             b'query': self.__query_request,
             b'transmit': self.__transmit_request,
+            b'forward': self.__forward_request,
+            b'forward_notification': self.__forward_notification_request,
+            b'publish': self.__publish_request,
+            b'broadcast': self.__broadcast_request,
+            b'revoke': self.__revoke_request,
+            b'subscribe': self.__subscribe_request,
+            b'unsubscribe': self.__unsubscribe_request,
+            b'drain': self.__drain_request,
         }
 
+        # Requests relayed to other connections or peers. When the broker is
+        # draining, it waits for them before closing and refuses new ones.
+        self.__draining = False
+        self.__relayed_requests = 0
+        self.__idle = asyncio.Event(loop=self.loop)
+        self.__idle.set()
+
+        # The registry is saved periodically and upon closure. Sessions that
+        # were restored from a snapshot are resumed as their clients come
+        # back.
+        self.snapshot_path = snapshot_path
+        self.__snapshot_interval = snapshot_interval
+        self.__session_restore_timeout = session_restore_timeout
+        self.__restored_sessions = {}
+
+        if snapshot_path is not None:
+            self.__load_snapshot()
+
+            # Snapshots are written off the loop, one at a time.
+            self.__snapshot_executor = ThreadPoolExecutor(max_workers=1)
+            self.add_task(self.__snapshot_loop())
+            self.add_cleanup(self.save_snapshot)
+            self.add_cleanup(
+                partial(self.__snapshot_executor.shutdown, wait=False),
+            )
+
+        # Registry changes are streamed to standby brokers, one record per
+        # changed session.
+        self.__connections_by_session = {}
+        self.__replica_connections = set()
+        self.__dirty_sessions = set()
+        self.__replication_handle = None
+
+        # Exposed signals.
+        self.on_promoted = Signal()
+
+        if replicate_from is not None:
+            self.__replica = Replica(
+                socket=replicate_from,
+                shared_secret=self.shared_secret,
+                max_missed_pings=replication_max_missed_pings,
+                loop=self.loop,
+            )
+            self.__replica.on_primary_lost.connect(self.__on_primary_lost)
+            self.add_cleanup(self.__replica.close)
+            self.add_cleanup(self.__replica.wait_closed)
+        else:
+            self.__replica = None
+
         self.add_cleanup(self.force_disconnections)
-        self.add_task(self.__receiving_loop())
 
+        if self.__notification_queue is not None:
+            self.add_cleanup(self.__close_notification_queue)
+
+        if socket is not None:
+            self.add_socket(socket)
+
+        for socket in sockets:
+            self.add_socket(socket)
+
+        for peer_socket in peer_sockets:
+            self.add_peer(peer_socket)
+
+    def add_socket(self, socket):
+        """
+        Accept connections on a listening socket.
+
+        :param socket: A ROUTER-like socket, bound to some endpoints.
+        """
         def close_connection(conn):
             connection = self.__connections.get(conn.remote_identity)
 
@@ -258,6 +551,150 @@ class Broker(AsyncObject):
                 connection.close()
 
         socket.on_connection_lost.connect(close_connection)
+        self.sockets.append(socket)
+        self.add_task(self.__receiving_loop(socket))
+
+    def add_peer(self, socket):
+        """
+        Peer with a remote broker.
+
+        :param socket: A socket connected to the remote broker.
+        :returns: The peer.
+        """
+        peer = Peer(
+            socket=socket,
+            shared_secret=self.shared_secret,
+            loop=self.loop,
+        )
+        peer.on_domain_available.connect(self.__on_peer_domain_available)
+        peer.on_domain_unavailable.connect(self.__on_peer_domain_unavailable)
+        peer.on_revoked.connect(self.__on_peer_revoked)
+        self.add_cleanup(peer.close)
+        self.add_cleanup(peer.wait_closed)
+
+        return peer
+
+    def revoke(self, domain):
+        """
+        Revoke all the cached authentications for a given domain, on this
+        broker and its peers.
+
+        :param domain: The domain whose authentications must be revoked.
+        """
+        self._revoke_cached(domain)
+        self.__advertise(b'revoked', domain)
+
+    def _revoke_cached(self, domain):
+        """
+        Revoke all the cached authentications for a given domain on this
+        broker only.
+
+        :param domain: The domain whose authentications must be revoked.
+        """
+        if self.__authentication_cache is not None:
+            keys = [
+                key for key in self.__authentication_cache
+                if key[0] == domain
+            ]
+
+            for key in keys:
+                self.__authentication_cache.pop(key, None)
+
+    @property
+    def standby(self):
+        """
+        Whether the broker is a standby that was not promoted yet.
+        """
+        return self.__replica is not None
+
+    def promote(self):
+        """
+        Turn a standby broker into a primary.
+
+        The replicated sessions are resumed as their clients connect. The
+        caller is expected to start listening (see `add_socket`) by handling
+        `on_promoted`.
+        """
+        if self.__replica is None:
+            return
+
+        replica = self.__replica
+        self.__replica = None
+        expires = self.loop.time() + self.__session_restore_timeout
+
+        for record in replica.sessions.values():
+            session, uid, domains = self.__unpack_session(record)
+            self.__restored_sessions[session] = (uid, domains, expires)
+
+        replica.close()
+        logger.warning(
+            "Promoted to primary with %d replicated session(s).",
+            len(replica.sessions),
+        )
+        self.on_promoted.emit(self)
+
+    async def save_snapshot(self):
+        """
+        Save the registry to the snapshot file.
+
+        The file is replaced atomically and is only readable by its owner, as
+        it contains the session secrets.
+        """
+        now = self.loop.time()
+        records = [
+            self.__get_session_record(connection)
+            for connection in self.__connections.values()
+            if connection.session is not None and connection.domains
+        ]
+
+        # Sessions that were not resumed yet are kept for a while.
+        for session, (uid, domains, expires) in list(
+            self.__restored_sessions.items()
+        ):
+            if expires < now:
+                del self.__restored_sessions[session]
+            else:
+                records.append(self.__pack_session(session, uid, domains))
+
+        await self.loop.run_in_executor(
+            self.__snapshot_executor,
+            self.__write_snapshot,
+            SNAPSHOT_MAGIC + pack_frames(records),
+        )
+
+    @property
+    def draining(self):
+        return self.__draining
+
+    async def drain(self, timeout=None):
+        """
+        Stop relaying new requests, wait for the ones in flight to complete
+        and close.
+
+        :param timeout: The maximum number of seconds to wait for the
+            requests in flight, or `None` to wait for as long as needed.
+
+        New requests are refused with a 503 error, so that clients connected
+        to several brokers send them elsewhere.
+        """
+        if not self.__draining:
+            logger.info(
+                "Draining: waiting for %d request(s) in flight.",
+                self.__relayed_requests,
+            )
+            self.__draining = True
+
+        try:
+            await asyncio.wait_for(self.__idle.wait(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%d request(s) still in flight after %s second(s). Closing "
+                "anyway.",
+                self.__relayed_requests,
+                timeout,
+            )
+
+        self.close()
 
     async def force_disconnections(self):
         connections = list(self.__connections.values())
@@ -282,23 +719,193 @@ class Broker(AsyncObject):
 
     # Private methods.
 
-    def __refresh_connection(self, identity):
+    @staticmethod
+    def __pack_session(session, uid, domains):
+        frames = [session, uid]
+
+        for domain, token, topics in domains:
+            frames.extend([domain, token, pack_frames(sorted(topics))])
+
+        return pack_frames(frames)
+
+    @staticmethod
+    def __unpack_session(record):
+        frames = unpack_frames(record)
+        session, uid = frames[:2]
+        domains = [
+            (domain, token, unpack_frames(topics))
+            for domain, token, topics in zip(
+                frames[2::3],
+                frames[3::3],
+                frames[4::3],
+            )
+        ]
+
+        return session, uid, domains
+
+    def __get_session_record(self, connection):
+        return self.__pack_session(
+            session=connection.session,
+            uid=connection.uid,
+            domains=[
+                (domain, token, self.__topics.get_topics((connection, domain)))
+                for domain, token in connection.domains.items()
+                if domain not in connection.draining_domains
+            ],
+        )
+
+    def __on_primary_lost(self, replica):
+        self.promote()
+
+    def __mark_session_dirty(self, connection):
+        if connection.session is None or not self.__replica_connections:
+            return
+
+        self.__dirty_sessions.add(connection.session)
+
+        if self.__replication_handle is None:
+            self.__replication_handle = self.loop.call_soon(
+                self.__flush_replication,
+            )
+
+    def __flush_replication(self):
+        self.__replication_handle = None
+        updates = []
+        removals = []
+
+        for session in self.__dirty_sessions:
+            connection = self.__connections_by_session.get(session)
+
+            if connection is not None and connection.domains:
+                updates.extend([
+                    session,
+                    self.__get_session_record(connection),
+                ])
+            else:
+                removals.append(session)
+
+        self.__dirty_sessions.clear()
+
+        for connection in self.__replica_connections:
+            if updates:
+                connection.add_task(
+                    connection.advertise(b'session_update', updates),
+                )
+
+            if removals:
+                connection.add_task(
+                    connection.advertise(b'session_removed', removals),
+                )
+
+    def __load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+
+        if not data.startswith(SNAPSHOT_MAGIC):
+            logger.warning(
+                "Ignoring invalid snapshot at %s.",
+                self.snapshot_path,
+            )
+            return
+
+        expires = self.loop.time() + self.__session_restore_timeout
+
+        try:
+            for record in unpack_frames(data[len(SNAPSHOT_MAGIC):]):
+                session, uid, domains = self.__unpack_session(record)
+                self.__restored_sessions[session] = (uid, domains, expires)
+        except Exception as ex:
+            logger.warning(
+                "Ignoring corrupted snapshot at %s (%s).",
+                self.snapshot_path,
+                ex,
+            )
+            self.__restored_sessions.clear()
+            return
+
+        logger.info(
+            "Loaded %d session(s) from %s.",
+            len(self.__restored_sessions),
+            self.snapshot_path,
+        )
+
+    def __resume_session(self, connection, session):
+        # A session can only be used by one connection at a time.
+        if session in self.__connections_by_session:
+            return
+
+        connection.session = session
+        self.__connections_by_session[session] = connection
+        restored = self.__restored_sessions.pop(session, None)
+
+        if restored is None or connection.domains:
+            self.__mark_session_dirty(connection)
+            return
+
+        uid, domains, expires = restored
+
+        if expires < self.loop.time():
+            return
+
+        # Keeping the unique identifier tells the client it does not need to
+        # register again.
+        connection.uid = uid
+
+        for domain, token, topics in domains:
+            self.__register_connection(connection, domain, token)
+
+            for topic in topics:
+                self.__topics.subscribe(topic, (connection, domain))
+
+        logger.info(
+            "Resumed session for connection %s (%d domain(s)).",
+            connection,
+            len(domains),
+        )
+
+    async def __snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.__snapshot_interval, loop=self.loop)
+
+            try:
+                await self.save_snapshot()
+            except OSError as ex:
+                logger.error("Could not save snapshot (%s).", ex)
+
+    def __write_snapshot(self, data):
+        path = '%s.tmp' % self.snapshot_path
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with os.fdopen(fd, 'wb') as file:
+            # The file may predate this version, with looser permissions.
+            os.fchmod(fd, 0o600)
+            file.write(data)
+            file.flush()
+            os.fsync(fd)
+
+        os.replace(path, self.snapshot_path)
+
+    def __refresh_connection(self, socket, identity):
         connection = self.__connections.get(identity)
 
         if connection:
             connection.refresh()
         else:
-            connection = self.__add_connection(identity)
+            connection = self.__add_connection(socket, identity)
 
         return connection
 
-    def __add_connection(self, identity):
+    def __add_connection(self, socket, identity):
         connection = Connection(
-            socket=self.socket,
+            socket=socket,
             identity=identity,
             on_request_cb=self.__process_request,
             on_notification_cb=self.__process_notification,
             timeout=self.__connection_timeout,
+            max_concurrent_requests=self.__max_concurrent_requests,
             loop=self.loop,
         )
         connection.add_cleanup(partial(self.__remove_connection, connection))
@@ -311,6 +918,12 @@ class Broker(AsyncObject):
         for domain in list(connection.domains):
             self.__unregister_connection(connection, domain)
 
+        self.__peer_connections.discard(connection)
+        self.__replica_connections.discard(connection)
+
+        if connection.session is not None:
+            del self.__connections_by_session[connection.session]
+
         del self.__connections[connection.identity]
         logger.debug("Connection with %s removed.", connection)
 
@@ -324,6 +937,7 @@ class Broker(AsyncObject):
 
         connections.append(connection)
         connection.domains[domain] = token
+        self.__mark_session_dirty(connection)
         logger.debug(
             "Registered domain %s for connection %s.",
             domain,
@@ -331,8 +945,10 @@ class Broker(AsyncObject):
         )
 
     def __unregister_connection(self, connection, domain):
-        connections = self.__connections_by_domain[domain]
-        connections.remove(connection)
+        if domain in connection.draining_domains:
+            connection.draining_domains.remove(domain)
+        else:
+            self.__remove_route(connection, domain)
 
         logger.debug(
             "Unregistered domain %s for connection %s.",
@@ -340,37 +956,205 @@ class Broker(AsyncObject):
             connection,
         )
 
+        del connection.domains[domain]
+        self.__topics.remove_subscriber((connection, domain))
+        self.__mark_session_dirty(connection)
+
+    def __remove_route(self, connection, domain):
+        connections = self.__connections_by_domain[domain]
+        connections.remove(connection)
+
         if not connections:
             del self.__connections_by_domain[domain]
             self.__on_domain_unavailable(domain)
 
-        del connection.domains[domain]
-
     def __on_domain_available(self, domain):
         logger.info("Domain %s is now available.", domain)
+        self.__advertise(b'domain_available', domain)
+
+        if self.__notification_queue is None:
+            return
+
+        # Notifications are only ever queued for domains that registered
+        # once, so that made-up domains can't fill the disk. This happens
+        # before anything else is queued for the domain, as calls to the
+        # queues are run in order.
+        self.__run_notification_queue(
+            self.__notification_queue.add_domain,
+            domain,
+        )
+
+        # Until the replay knows the queue is empty, new notifications are
+        # queued behind the others to preserve ordering.
+        if domain not in self.__replaying_domains:
+            self.__replaying_domains.add(domain)
+            task = asyncio.ensure_future(
+                self.__replay_notifications(domain),
+                loop=self.loop,
+            )
+            self.__replay_tasks.add(task)
+            task.add_done_callback(self.__replay_tasks.discard)
 
     def __on_domain_unavailable(self, domain):
         logger.info("Domain %s is now unavailable.", domain)
+        self.__advertise(b'domain_unavailable', domain)
+
+    def __advertise(self, type_, domain):
+        for connection in self.__peer_connections:
+            connection.add_task(connection.advertise(type_, [domain]))
+
+    def __on_peer_domain_available(self, peer, domain):
+        peers = self.__peers_by_domain.setdefault(domain, deque())
+        peers.append(peer)
+        logger.debug("Domain %s is now available through a peer.", domain)
+
+    def __on_peer_domain_unavailable(self, peer, domain):
+        peers = self.__peers_by_domain[domain]
+        peers.remove(peer)
+
+        if not peers:
+            del self.__peers_by_domain[domain]
+
+        logger.debug(
+            "Domain %s is no longer available through a peer.",
+            domain,
+        )
+
+    def __on_peer_revoked(self, peer, domain):
+        # Advertising it again would bounce it between brokers that peer
+        # with each other forever.
+        self._revoke_cached(domain)
+
+    async def __close_notification_queue(self):
+        for task in self.__replay_tasks:
+            task.cancel()
+
+        await asyncio.gather(
+            *self.__replay_tasks,
+            return_exceptions=True,
+            loop=self.loop
+        )
+        await self.__run_notification_queue(self.__notification_queue.close)
+        self.__notification_executor.shutdown(wait=False)
+
+    def __run_notification_queue(self, func, *args):
+        return self.loop.run_in_executor(
+            self.__notification_executor,
+            func,
+            *args
+        )
+
+    async def __replay_notifications(self, domain):
+        notification_queue = self.__notification_queue
+        delivered_seq = None
+        count = 0
 
-    async def __receiving_loop(self):
+        try:
+            while True:
+                queued = self.__queued_notifications.get(domain, 0)
+                notifications = await self.__run_notification_queue(
+                    notification_queue.read,
+                    domain,
+                    self.__notification_replay_batch_size,
+                )
+
+                if not notifications:
+                    # The notifications queued during the read come after
+                    # it: we must read again.
+                    if self.__queued_notifications.get(domain, 0) == queued:
+                        break
+
+                    continue
+
+                for seq, frames in notifications:
+                    target_connection = self.__get_connection_for(
+                        domain,
+                        allow_link=False,
+                    )
+
+                    if not target_connection:
+                        logger.warning(
+                            "Domain %s went away during replay: queued "
+                            "notifications will be replayed later.",
+                            domain,
+                        )
+                        return
+
+                    source_domain, source_token, type_ = frames[:3]
+                    await target_connection.notification(
+                        domain=domain,
+                        source_domain=source_domain,
+                        source_token=source_token or None,
+                        type_=type_,
+                        args=frames[3:],
+                    )
+                    delivered_seq = seq
+                    count += 1
+
+                # Acknowledgements are batched.
+                await self.__run_notification_queue(
+                    notification_queue.ack,
+                    domain,
+                    delivered_seq,
+                )
+                delivered_seq = None
+        finally:
+            # This may run upon closure: the calls are not waited for but
+            # still happen before the queues are closed.
+            if delivered_seq is not None:
+                self.__run_notification_queue(
+                    notification_queue.ack,
+                    domain,
+                    delivered_seq,
+                )
+
+            self.__run_notification_queue(notification_queue.release, domain)
+            self.__replaying_domains.discard(domain)
+            self.__queued_notifications.pop(domain, None)
+
+            if count:
+                logger.info(
+                    "Replayed %d queued notification(s) to %s.",
+                    count,
+                    domain,
+                )
+
+    async def __receiving_loop(self, socket):
         while True:
-            frames = await self.socket.recv_multipart()
+            frames = await socket.recv_multipart()
             identity = frames.pop(0)
             frames.pop(0)  # Empty frame.
 
-            connection = self.__refresh_connection(identity)
+            connection = self.__refresh_connection(socket, identity)
 
             await connection.receive(frames)
 
-    def __get_connection_for(self, target_domain, allow_link=True):
+    def __get_connection_for(
+        self,
+        target_domain,
+        allow_link=True,
+        exclude=None,
+    ):
         connections = self.__connections_by_domain.get(target_domain)
 
         if connections:
+            # Skip the excluded connection, unless it is the only one.
+            if exclude is not None and connections[0] is exclude and \
+                    len(connections) > 1:
+                connections.rotate(-1)
+
             target_connection = connections[0]
             connections.rotate(-1)
             return target_connection
 
         if allow_link:
+            peers = self.__peers_by_domain.get(target_domain)
+
+            if peers:
+                peer = peers[0]
+                peers.rotate(-1)
+                return PeerConnection(peer=peer)
+
             link_connection = self.__get_connection_for(
                 self.SERVICE_LINK_DOMAIN,
                 allow_link=False,
@@ -381,19 +1165,46 @@ class Broker(AsyncObject):
                     connection=link_connection,
                 )
 
-    async def __process_request(self, connection, frames):
+    async def __process_request(self, connection, frames, header):
         command = frames.pop(0)
 
         if command == b'ping':
+            if frames and connection.session is None:
+                self.__resume_session(connection, frames[0])
+
             return [connection.uid]
 
+        if command == b'peer':
+            return await self.__peer_request(connection, frames)
+
+        if command == b'replicate':
+            return await self.__replicate_request(connection, frames)
+
+        if command == b'register_many':
+            return await self.__register_many_request(connection, frames)
+
         domain = frames.pop(0)
         handler = self.__command_handlers.get(command)
 
         if not handler:
             raise CallError(code=400, message="Bad request.")
 
-        return await handler(connection, domain, frames)
+        if command not in (b'request', b'transmit', b'forward'):
+            return await handler(connection, domain, frames, header)
+
+        if self.__draining:
+            raise CallError(code=503, message="Broker is draining.")
+
+        self.__relayed_requests += 1
+        self.__idle.clear()
+
+        try:
+            return await handler(connection, domain, frames, header)
+        finally:
+            self.__relayed_requests -= 1
+
+            if not self.__relayed_requests:
+                self.__idle.set()
 
     async def __process_notification(self, connection, frames):
         type_ = frames.pop(0)
@@ -408,12 +1219,6 @@ class Broker(AsyncObject):
         target_domain = frames.pop(0)
         target_connection = self.__get_connection_for(target_domain)
 
-        if not target_connection:
-            raise CallError(
-                code=404,
-                message="No such domain: %s." % target_domain,
-            )
-
         if type_ == b'transmit':
             type_ = frames.pop(0)
             source_domain = frames.pop(0)
@@ -422,6 +1227,29 @@ class Broker(AsyncObject):
             source_domain = domain
             source_token = connection.domains.get(domain)
 
+        # Queued notifications must be delivered first, to preserve ordering.
+        if self.__notification_queue is not None and (
+            target_domain in self.__replaying_domains or (
+                not target_connection and
+                self.__notification_queue.is_known(target_domain)
+            )
+        ):
+            self.__queued_notifications[target_domain] = \
+                self.__queued_notifications.get(target_domain, 0) + 1
+            await self.__run_notification_queue(
+                self.__notification_queue.append,
+                target_domain,
+                [source_domain, source_token or b'', type_] + frames,
+            )
+            logger.debug("Queued notification for %s.", target_domain)
+            return
+
+        if not target_connection:
+            raise CallError(
+                code=404,
+                message="No such domain: %s." % target_domain,
+            )
+
         await target_connection.notification(
             domain=target_domain,
             source_domain=source_domain,
@@ -430,8 +1258,110 @@ class Broker(AsyncObject):
             args=frames,
         )
 
-    async def __register_request(self, connection, domain, frames):
+    async def __publish_request(self, connection, domain, frames, header):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
+
+        topic = frames.pop(0)
+        type_ = frames.pop(0)
+        subscribers = self.__topics.match(topic)
+
+        if not subscribers:
+            logger.debug("No subscribers for topic %s.", topic)
+            return
+
+        # All subscribers share the same frames.
+        args = [topic]
+        args.extend(frames)
+        source_token = connection.domains[domain]
+
+        for target_connection, target_domain in subscribers:
+            target_connection.add_task(
+                target_connection.notification(
+                    domain=target_domain,
+                    source_domain=domain,
+                    source_token=source_token,
+                    type_=type_,
+                    args=args,
+                ),
+            )
+
+    async def __broadcast_request(self, connection, domain, frames, header):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
+
+        target_domain = frames.pop(0)
+        type_ = frames.pop(0)
+        target_connections = self.__connections_by_domain.get(target_domain)
+
+        if not target_connections:
+            raise CallError(
+                code=404,
+                message="No such domain: %s." % target_domain,
+            )
+
+        source_token = connection.domains[domain]
+
+        # All the connections share the same frames.
+        for target_connection in target_connections:
+            target_connection.add_task(
+                target_connection.notification(
+                    domain=target_domain,
+                    source_domain=domain,
+                    source_token=source_token,
+                    type_=type_,
+                    args=frames,
+                ),
+            )
+
+    async def __register_request(self, connection, domain, frames, header):
         credentials = frames.pop(0)
+        token = await self.__register_domain(connection, domain, credentials)
+
+        return [token]
+
+    async def __register_many_request(self, connection, frames):
+        # All the registrations are processed concurrently so that the user
+        # authentications end up in the same batch.
+        results = await asyncio.gather(
+            *[
+                self.__register_domain(connection, domain, credentials)
+                for domain, credentials in zip(frames[::2], frames[1::2])
+            ],
+            return_exceptions=True,
+            loop=self.loop
+        )
+        response = []
+
+        for result in results:
+            if isinstance(result, CallError):
+                response.extend([
+                    ('%d' % result.code).encode('utf-8'),
+                    result.message.encode('utf-8'),
+                ])
+            elif isinstance(result, Exception):
+                logger.error(
+                    "Unexpected error while registering a domain (%s).",
+                    result,
+                )
+                response.extend([b'500', b'Internal error.'])
+            else:
+                response.extend([b'200', result])
+
+        return response
+
+    async def __register_domain(self, connection, domain, credentials):
+        if domain == BROKER_DOMAIN:
+            raise CallError(
+                code=403,
+                message="Reserved domain.",
+            )
 
         # Services are authenticated via a shared secret.
         if domain.startswith(self.SERVICE_DOMAIN_PREFIX):
@@ -443,42 +1373,150 @@ class Broker(AsyncObject):
 
             token = b''
         else:
+            token = await self.__authenticate(domain, credentials)
+
+        if domain in connection.domains:
+            self.__unregister_connection(connection, domain)
+
+        self.__register_connection(connection, domain, token)
+
+        return token
+
+    async def __authenticate(self, domain, credentials):
+        if self.__authentication_cache is not None:
+            key = (domain, digest_credentials(credentials))
+            token = self.__authentication_cache.get(key)
+
+            if token is not None:
+                logger.debug("Using cached authentication for %s.", domain)
+                return token
+
+        future = asyncio.Future(loop=self.loop)
+        self.__authentication_batch.append((domain, credentials, future))
+
+        if len(self.__authentication_batch) >= \
+                self.__authentication_batch_size:
+            self.__flush_authentication_batch()
+        elif self.__authentication_batch_handle is None:
+            self.__authentication_batch_handle = self.loop.call_later(
+                self.__authentication_batch_delay,
+                self.__flush_authentication_batch,
+            )
+
+        token = await future
+
+        if self.__authentication_cache is not None:
+            self.__authentication_cache[key] = token
+
+        return token
+
+    def __flush_authentication_batch(self):
+        if self.__authentication_batch_handle is not None:
+            self.__authentication_batch_handle.cancel()
+            self.__authentication_batch_handle = None
+
+        batch = self.__authentication_batch
+        self.__authentication_batch = []
+
+        if batch:
+            self.add_task(self.__authenticate_batch(batch))
+
+    async def __authenticate_batch(self, batch):
+        try:
             auth_connection = self.__get_connection_for(
                 self.SERVICE_AUTHENTICATION_DOMAIN,
             )
 
             if not auth_connection:
                 logger.warning(
-                    "Received authentication request for %s but no "
+                    "Received %d authentication request(s) but no "
                     "authentication service is currently available !",
-                    domain,
+                    len(batch),
                 )
                 raise CallError(
                     code=503,
                     message="Authentication service unavailable.",
                 )
 
-            token, = await auth_connection.request(
+            args = [b'authenticate_many']
+
+            for domain, credentials, _ in batch:
+                args.extend([domain, credentials])
+
+            frames = await auth_connection.request(
                 domain=self.SERVICE_AUTHENTICATION_DOMAIN,
-                source_domain=domain,
-                source_token=connection.domains.get(domain),
-                args=[
-                    b'authenticate',
-                    credentials,
-                ],
+                source_domain=BROKER_DOMAIN,
+                source_token=b'',
+                args=args,
+                priority=PRIORITY_CONTROL,
             )
 
-        if domain in connection.domains:
-            self.__unregister_connection(connection, domain)
+            if len(frames) != 2 * len(batch):
+                raise InvalidReplyError()
+
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+
+            raise
+        except Exception as ex:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+
+            return
+
+        for (_, _, future), code, value in zip(
+            batch,
+            frames[::2],
+            frames[1::2],
+        ):
+            if future.done():
+                continue
+
+            try:
+                code = int(code)
+            except ValueError:
+                future.set_exception(InvalidReplyError())
+                continue
+
+            if code == 200:
+                future.set_result(value)
+            else:
+                future.set_exception(
+                    CallError(
+                        code=code,
+                        message=value.decode('utf-8', 'replace'),
+                    ),
+                )
 
-        self.__register_connection(connection, domain, token)
+    async def __unregister_request(self, connection, domain, frames, header):
+        self.__unregister_connection(connection, domain)
 
-        return [token]
+    async def __drain_request(self, connection, domain, frames, header):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
 
-    async def __unregister_request(self, connection, domain, frames):
-        self.__unregister_connection(connection, domain)
+        if domain in connection.draining_domains:
+            return
 
-    async def __request_request(self, connection, domain, frames):
+        # The domain stays registered, so that the requests in progress can
+        # still be answered and make calls of their own, but it gets nothing
+        # new.
+        self.__remove_route(connection, domain)
+        self.__topics.remove_subscriber((connection, domain))
+        connection.draining_domains.add(domain)
+        self.__mark_session_dirty(connection)
+        logger.debug(
+            "Draining domain %s for connection %s.",
+            domain,
+            connection,
+        )
+
+    async def __request_request(self, connection, domain, frames, header):
         if domain not in connection.domains:
             raise CallError(
                 code=412,
@@ -486,7 +1524,19 @@ class Broker(AsyncObject):
             )
 
         target_domain = frames.pop(0)
-        target_connection = self.__get_connection_for(target_domain)
+        hedge = header.get('hedge')
+
+        if not isinstance(hedge, (str, int)):
+            hedge_key = None
+            first_connection = None
+        else:
+            hedge_key = (connection, domain, target_domain, hedge)
+            first_connection = self.__hedged_connections.get(hedge_key)
+
+        target_connection = self.__get_connection_for(
+            target_domain,
+            exclude=first_connection,
+        )
 
         if not target_connection:
             raise CallError(
@@ -494,14 +1544,19 @@ class Broker(AsyncObject):
                 message="No such domain: %s." % target_domain,
             )
 
+        if hedge_key is not None and first_connection is None:
+            self.__hedged_connections[hedge_key] = target_connection
+
         return await target_connection.request(
             domain=target_domain,
             source_domain=domain,
             source_token=connection.domains[domain],
             args=frames,
+            priority=get_priority(header),
+            timeout=get_timeout(header, self.loop),
         )
 
-    async def __query_request(self, connection, domain, frames):
+    async def __query_request(self, connection, domain, frames, header):
         if domain not in connection.domains:
             raise CallError(
                 code=412,
@@ -520,7 +1575,7 @@ class Broker(AsyncObject):
                 message="No such domain: %s." % target_domain,
             )
 
-    async def __transmit_request(self, connection, domain, frames):
+    async def __transmit_request(self, connection, domain, frames, header):
         if domain not in connection.domains:
             raise CallError(
                 code=412,
@@ -547,12 +1602,190 @@ class Broker(AsyncObject):
             source_domain=source_domain,
             source_token=source_token,
             args=frames,
+            priority=get_priority(header),
+            timeout=get_timeout(header, self.loop),
+        )
+
+    async def __revoke_request(self, connection, domain, frames, header):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
+
+        if domain != self.SERVICE_AUTHENTICATION_DOMAIN:
+            raise CallError(
+                code=403,
+                message="Only the authentication service may revoke.",
+            )
+
+        target_domain = frames.pop(0)
+        logger.info("Revoking cached authentications for %s.", target_domain)
+        self.revoke(target_domain)
+
+    async def __subscribe_request(self, connection, domain, frames, header):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
+
+        topic = frames.pop(0)
+        self.__topics.subscribe(topic, (connection, domain))
+        self.__mark_session_dirty(connection)
+        logger.debug("%s subscribed to topic %s.", domain, topic)
+
+    async def __unsubscribe_request(
+        self,
+        connection,
+        domain,
+        frames,
+        header,
+    ):
+        if domain not in connection.domains:
+            raise CallError(
+                code=412,
+                message="Not registered.",
+            )
+
+        topic = frames.pop(0)
+        self.__topics.unsubscribe(topic, (connection, domain))
+        self.__mark_session_dirty(connection)
+        logger.debug("%s unsubscribed from topic %s.", domain, topic)
+
+    async def __peer_request(self, connection, frames):
+        credentials = frames.pop(0)
+
+        if not self.__verify_credentials(Peer.PEER_IDENTIFIER, credentials):
+            raise CallError(
+                code=401,
+                message="Invalid shared secret.",
+            )
+
+        self.__peer_connections.add(connection)
+        logger.info("Connection %s is now peering.", connection)
+
+        return [connection.uid] + list(self.__connections_by_domain)
+
+    async def __replicate_request(self, connection, frames):
+        credentials = frames.pop(0)
+
+        if not self.__verify_credentials(
+            Replica.REPLICA_IDENTIFIER,
+            credentials,
+        ):
+            raise CallError(
+                code=401,
+                message="Invalid shared secret.",
+            )
+
+        self.__replica_connections.add(connection)
+        logger.info("Connection %s is now replicating.", connection)
+        result = [connection.uid]
+
+        for connection in self.__connections.values():
+            if connection.session is not None and connection.domains:
+                result.extend([
+                    connection.session,
+                    self.__get_session_record(connection),
+                ])
+
+        return result
+
+    async def __forward_request(self, connection, domain, frames, header):
+        if connection not in self.__peer_connections:
+            raise CallError(
+                code=403,
+                message="Not a peer.",
+            )
+
+        # Forwarded requests are only ever dispatched locally, to avoid
+        # loops between peers.
+        target_connection = self.__get_connection_for(
+            domain,
+            allow_link=False,
+        )
+
+        if not target_connection:
+            raise CallError(
+                code=404,
+                message="No such domain: %s." % domain,
+            )
+
+        source_domain = frames.pop(0)
+        source_token = frames.pop(0)
+
+        return await target_connection.request(
+            domain=domain,
+            source_domain=source_domain,
+            source_token=source_token,
+            args=frames,
+            priority=get_priority(header),
+            timeout=get_timeout(header, self.loop),
+        )
+
+    async def __forward_notification_request(
+        self,
+        connection,
+        domain,
+        frames,
+        header,
+    ):
+        if connection not in self.__peer_connections:
+            raise CallError(
+                code=403,
+                message="Not a peer.",
+            )
+
+        target_connection = self.__get_connection_for(
+            domain,
+            allow_link=False,
+        )
+
+        if not target_connection:
+            raise CallError(
+                code=404,
+                message="No such domain: %s." % domain,
+            )
+
+        source_domain = frames.pop(0)
+        source_token = frames.pop(0)
+        type_ = frames.pop(0)
+
+        await target_connection.notification(
+            domain=domain,
+            source_domain=source_domain,
+            source_token=source_token,
+            type_=type_,
+            args=frames,
         )
 
     def __verify_service_credentials(self, service_name, credentials):
-        salt_len, = struct.unpack('B', credentials[0:1])
+        identifier = service_name[service_name.index(b'/') + 1:]
+
+        return self.__verify_credentials(identifier[:16], credentials)
+
+    def __verify_credentials(self, identifier, credentials):
+        key = (identifier, credentials)
+
+        if self.__credentials_cache is not None and \
+                key in self.__credentials_cache:
+            return True
+
+        if not credentials:
+            return False
+
+        salt_len = credentials[0]
         salt = credentials[1:salt_len + 1]
         hash = credentials[salt_len + 1:]
-        identifier = service_name[service_name.index(b'/') + 1:]
 
-        return verify_hash(self.shared_secret, salt, identifier[:16], hash)
+        if len(salt) != salt_len or not hash:
+            return False
+
+        if not verify_hash(self.shared_secret, salt, identifier, hash):
+            return False
+
+        if self.__credentials_cache is not None:
+            self.__credentials_cache[key] = True
+
+        return True
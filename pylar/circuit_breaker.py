@@ -0,0 +1,160 @@
+"""
+Circuit breakers.
+"""
+
+from collections import deque
+
+from .errors import CircuitOpenError
+from .log import logger as main_logger
+
+logger = main_logger.getChild('circuit_breaker')
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of the recent calls to a target and fails new calls
+    immediately once too many of them failed or were slow.
+
+    After `open_duration` seconds, a few probe calls are let through: the
+    circuit closes again if they succeed, and opens for another
+    `open_duration` otherwise.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(
+        self,
+        *,
+        name,
+        loop,
+        window_size=20,
+        min_calls=10,
+        failure_rate_threshold=0.5,
+        slow_call_duration=None,
+        open_duration=5.0,
+        probe_calls=1
+    ):
+        """
+        :param name: The name of the target, for logging.
+        :param loop: The event loop.
+        :param window_size: The number of recent calls to consider.
+        :param min_calls: The number of calls required before the circuit can
+            open.
+        :param failure_rate_threshold: The proportion of failed calls in the
+            window above which the circuit opens.
+        :param slow_call_duration: Calls that take more than this number of
+            seconds count as failed. `None` means calls are never too slow.
+        :param open_duration: The number of seconds the circuit stays open
+            before probe calls are let through.
+        :param probe_calls: The number of probe calls to let through when
+            half-open. They must all succeed for the circuit to close.
+        """
+        self.name = name
+        self.loop = loop
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.probe_calls = probe_calls
+
+        self.__state = self.CLOSED
+        self.__outcomes = deque(maxlen=window_size)
+        self.__opened_at = None
+        self.__pending_probes = 0
+        self.__successful_probes = 0
+
+    @property
+    def state(self):
+        if self.__state == self.OPEN and \
+                self.loop.time() >= self.__opened_at + self.open_duration:
+            self.__set_state(self.HALF_OPEN)
+            self.__pending_probes = 0
+            self.__successful_probes = 0
+
+        return self.__state
+
+    @property
+    def failure_rate(self):
+        if not self.__outcomes:
+            return 0.0
+
+        return self.__outcomes.count(False) / len(self.__outcomes)
+
+    def acquire(self):
+        """
+        Get permission to make a call.
+
+        :returns: Whether the call is a probe call.
+        :raises CircuitOpenError: If the circuit is open, or half-open with
+            enough probe calls in progress already.
+
+        Each successful call to `acquire` must be followed by a call to
+        `release`.
+        """
+        state = self.state
+
+        if state == self.OPEN:
+            raise CircuitOpenError(self.name)
+
+        if state == self.HALF_OPEN:
+            if self.__pending_probes + self.__successful_probes >= \
+                    self.probe_calls:
+                raise CircuitOpenError(self.name)
+
+            self.__pending_probes += 1
+
+            return True
+
+        return False
+
+    def release(self, duration, failed, probe):
+        """
+        Record the outcome of a call.
+
+        :param duration: The call duration, in seconds.
+        :param failed: Whether the call failed. `None` means the call was
+            abandoned by the caller and doesn't count either way.
+        :param probe: The value returned by `acquire`.
+        """
+        state = self.__state
+
+        if probe:
+            self.__pending_probes = max(self.__pending_probes - 1, 0)
+
+        if failed is None:
+            return
+
+        if self.slow_call_duration is not None and \
+                duration > self.slow_call_duration:
+            failed = True
+
+        # Calls that started before the circuit opened tell nothing about
+        # the target's recovery.
+        if state == self.HALF_OPEN and probe:
+            if failed:
+                self.__open()
+            else:
+                self.__successful_probes += 1
+
+                if self.__successful_probes >= self.probe_calls:
+                    self.__outcomes.clear()
+                    self.__set_state(self.CLOSED)
+        elif state == self.CLOSED:
+            self.__outcomes.append(not failed)
+
+            if len(self.__outcomes) >= self.min_calls and \
+                    self.failure_rate > self.failure_rate_threshold:
+                self.__open()
+
+    # Private methods.
+
+    def __open(self):
+        self.__opened_at = self.loop.time()
+        self.__set_state(self.OPEN)
+
+    def __set_state(self, state):
+        if state != self.__state:
+            log = logger.warning if state == self.OPEN else logger.info
+            log("Circuit breaker for %s is now %s.", self.name, state)
+            self.__state = state
@@ -4,32 +4,106 @@ A client class.
 
 import asyncio
 
+from collections import deque
+from functools import partial
 from math import ceil
+from uuid import uuid4
 
 from .client_proxy import ClientProxy
-from .errors import CallError
+from .common import (
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+)
+from .errors import (
+    CallError,
+    ConnectionLostError,
+    InvalidReplyError,
+)
 from .generic_client import GenericClient
 from .log import logger as main_logger
 
+from pyslot import Signal
+
 logger = main_logger.getChild('client')
 
 
 class Client(GenericClient):
-    def __init__(self, *, socket, **kwargs):
+    def __init__(
+        self,
+        *,
+        socket,
+        endpoints=(),
+        ping_interval=5.0,
+        ping_timeout=5.0,
+        **kwargs
+    ):
+        """
+        :param socket: The socket to talk to the broker through.
+        :param endpoints: The endpoints of the broker, followed by those of
+            its standby brokers. If specified, the socket is connected to the
+            first one and moved to the next one whenever the broker stops
+            answering. Otherwise, the socket must be connected already.
+        :param ping_interval: The number of seconds between two pings.
+        :param ping_timeout: The number of seconds after which a broker that
+            doesn't answer a ping is considered lost.
+        """
         super().__init__(**kwargs)
         self.socket = socket
+        self.endpoints = list(endpoints)
+
+        if self.endpoints:
+            socket.connect(self.endpoints[0])
+
+        # The session identifier lets a restarted broker resume our
+        # registrations from its snapshot. It must remain secret.
+        self.session = uuid4().bytes
         self._token = None
         self._registered = asyncio.Event(loop=self.loop)
         self._unregistered = asyncio.Event(loop=self.loop)
         self._unregistered.set()
-        self.__ping_timeout = 5.0
-        self.__ping_interval = 5.0
+        self.__ping_timeout = ping_timeout
+        self.__ping_interval = ping_interval
         self.__has_connection = asyncio.Event(loop=self.loop)
         self.__has_client_proxies = asyncio.Event(loop=self.loop)
         self.__client_proxies = set()
         self.__client_proxies_by_domain = {}
+        self.__inflight_semaphores = {}
         self.__remote_uid = None
+        self.__ping_requested = asyncio.Event(loop=self.loop)
+        self.__connection_lost = False
+
+        # Registrations that happen at the same time are sent to the broker
+        # as a single request.
+        self.__registration_batch = []
+        self.__registration_batch_handle = None
+
+        # Exposed signals.
+        self.on_connected = Signal()
+
+        # Ping as soon as a connection is established, so that the broker
+        # knows who we are before we send anything else, and as soon as one
+        # is lost, so that we notice a dead broker without waiting for the
+        # ping timeout.
+        for signal_name, callback in (
+            ('on_connection_ready', self.__on_connection_ready),
+            ('on_connection_lost', self.__on_connection_lost),
+        ):
+            signal = getattr(socket, signal_name, None)
+
+            if signal is not None:
+                signal.connect(callback)
+                self.add_cleanup(partial(signal.disconnect, callback))
+
+        # Outgoing frames are queued per priority and source domain. The most
+        # urgent priority is always served first and, within a priority,
+        # source domains are served in a weighted round-robin fashion so that
+        # one busy client proxy cannot starve the others.
+        self.__outbound_queues = {}
+        self.__outbound_domains = {}
+        self.__outbound_event = asyncio.Event(loop=self.loop)
+
         self.add_task(self.__ping_loop())
+        self.__writing_task = self.add_task(self.__writing_loop())
 
     @property
     def has_connection(self):
@@ -48,6 +122,11 @@ class Client(GenericClient):
 
         self.__client_proxies.add(client_proxy)
         self.__client_proxies_by_domain[client_proxy.domain] = client_proxy
+
+        if client_proxy.max_inflight:
+            self.__inflight_semaphores[client_proxy.domain] = \
+                asyncio.Semaphore(client_proxy.max_inflight, loop=self.loop)
+
         self.__has_client_proxies.set()
         self.add_cleanup(client_proxy.close)
         self.add_cleanup(client_proxy.wait_closed)
@@ -57,6 +136,7 @@ class Client(GenericClient):
 
         self.__client_proxies.remove(client_proxy)
         del self.__client_proxies_by_domain[client_proxy.domain]
+        self.__inflight_semaphores.pop(client_proxy.domain, None)
 
         if not self.__client_proxies:
             self.__has_client_proxies.clear()
@@ -74,6 +154,22 @@ class Client(GenericClient):
             if client_proxy.registered
         ]
 
+    async def drain(self, timeout=None):
+        """
+        Drain all the client proxies, then close.
+
+        :param timeout: The maximum number of seconds to wait for the
+            requests in progress, or `None` to wait for as long as needed.
+        """
+        await asyncio.gather(
+            *[
+                client_proxy.drain(timeout)
+                for client_proxy in self.client_proxies
+            ],
+            loop=self.loop
+        )
+        self.close()
+
     def get_client_proxy(self, domain):
         """
         Get an active client proxy with the specified domain.
@@ -83,7 +179,16 @@ class Client(GenericClient):
         """
         return self.__client_proxies_by_domain.get(domain)
 
-    async def request(self, source_domain, target_domain, command, args=()):
+    async def request(
+        self,
+        source_domain,
+        target_domain,
+        command,
+        args=(),
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        hedge=None,
+    ):
         """
         Send a generic request to a specified domain.
 
@@ -91,6 +196,10 @@ class Client(GenericClient):
         :param target_domain: The target domain.
         :param command: The command.
         :param args: A list of frames to pass.
+        :param priority: The request priority. Lower values are more urgent.
+        :param timeout: The request timeout, in seconds.
+        :param hedge: An identifier shared by the copies of a hedged request.
+            The broker sends each copy to a different connection when it can.
         :returns: The request result.
         """
         frames = [
@@ -101,7 +210,13 @@ class Client(GenericClient):
         ]
         frames.extend(args)
 
-        return await self._request(frames)
+        return await self.__request_from(
+            source_domain,
+            frames,
+            priority,
+            timeout,
+            header=None if hedge is None else {'hedge': hedge},
+        )
 
     async def notification(self, source_domain, target_domain, type_, args=()):
         """
@@ -121,6 +236,66 @@ class Client(GenericClient):
 
         return await self._notification(frames)
 
+    async def broadcast(self, source_domain, target_domain, type_, args=()):
+        """
+        Send a notification to all the connections registered for a domain.
+
+        :param source_domain: The source domain.
+        :param target_domain: The target domain.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        frames = [
+            b'broadcast',
+            source_domain,
+            target_domain,
+            type_.encode('utf-8'),
+        ]
+        frames.extend(args)
+
+        await self.__request_from(source_domain, frames)
+
+    async def publish(self, source_domain, topic, type_, args=()):
+        """
+        Publish a notification to all the subscribers of a topic.
+
+        :param source_domain: The source domain.
+        :param topic: The topic.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        frames = [
+            b'publish',
+            source_domain,
+            topic,
+            type_.encode('utf-8'),
+        ]
+        frames.extend(args)
+
+        await self.__request_from(source_domain, frames)
+
+    async def subscribe(self, source_domain, topic):
+        """
+        Subscribe to a topic.
+
+        :param source_domain: The domain that subscribes.
+        :param topic: The topic.
+        """
+        frames = [b'subscribe', source_domain, topic]
+
+        return await self._request(frames, PRIORITY_CONTROL)
+
+    async def unsubscribe(self, source_domain, topic):
+        """
+        Unsubscribe from a topic.
+
+        :param source_domain: The domain that unsubscribes.
+        :param topic: The topic.
+        """
+        frames = [b'unsubscribe', source_domain, topic]
+
+        return await self._request(frames, PRIORITY_CONTROL)
+
     async def query(self, source_domain, target_domain):
         """
         Query the broker for a given domain.
@@ -130,7 +305,18 @@ class Client(GenericClient):
         """
         frames = [b'query', source_domain, target_domain]
 
-        return await self._request(frames)
+        return await self.__request_from(source_domain, frames)
+
+    async def revoke(self, source_domain, target_domain):
+        """
+        Ask the broker to revoke the cached authentications of a domain.
+
+        :param source_domain: The domain that revokes.
+        :param target_domain: The domain whose authentications are revoked.
+        """
+        frames = [b'revoke', source_domain, target_domain]
+
+        return await self._request(frames, PRIORITY_CONTROL)
 
     async def transmit(
         self,
@@ -151,7 +337,7 @@ class Client(GenericClient):
             x_token,
         ] + list(frames)
 
-        return await self._request(frames)
+        return await self.__request_from(source_domain, frames)
 
     async def notification_transmit(
         self,
@@ -185,14 +371,38 @@ class Client(GenericClient):
 
         return frames
 
-    async def _write(self, frames):
+    async def _write(self, frames, priority=PRIORITY_NORMAL):
         """
         Write frames.
 
         :param frames: The frames to write.
+        :param priority: The priority of the frames.
         """
+        domain = self.__get_outbound_domain(frames)
         frames.insert(0, b'')
-        await self.socket.send_multipart(frames)
+
+        # Responses and broker-level commands are not scheduled.
+        if domain is None:
+            await self.socket.send_multipart(frames)
+            return
+
+        # Nothing would ever send the frames.
+        if self.__writing_task.done():
+            raise asyncio.CancelledError()
+
+        future = asyncio.Future(loop=self.loop)
+        queue = self.__outbound_queues.get((priority, domain))
+
+        if queue is None:
+            queue = self.__outbound_queues[priority, domain] = deque()
+            self.__outbound_domains.setdefault(priority, deque()).append(
+                domain,
+            )
+            self.__outbound_event.set()
+
+        queue.append((frames, future))
+
+        await future
 
     async def _register(self, domain, credentials):
         """
@@ -201,11 +411,19 @@ class Client(GenericClient):
         :param domain: The domain to register for.
         :param credentials: The credentials for the domain.
         :returns: The authentication token.
+
+        Registrations requested during the same event loop iteration are
+        sent together.
         """
-        frames = [b'register', domain, credentials]
-        token, = await self._request(frames)
+        future = asyncio.Future(loop=self.loop)
+        self.__registration_batch.append((domain, credentials, future))
+
+        if self.__registration_batch_handle is None:
+            self.__registration_batch_handle = self.loop.call_soon(
+                self.__flush_registration_batch,
+            )
 
-        return token
+        return await future
 
     async def _unregister(self, domain):
         """
@@ -213,21 +431,35 @@ class Client(GenericClient):
         """
         frames = [b'unregister', domain]
 
-        await self._request(frames)
+        await self._request(frames, PRIORITY_CONTROL)
+
+    async def _drain(self, domain):
+        """
+        Ask the broker to stop routing requests to a domain.
+
+        :param domain: The domain, which remains registered.
+        """
+        frames = [b'drain', domain]
+
+        await self._request(frames, PRIORITY_CONTROL)
 
     async def _ping(self):
         """
         Ping the broker.
         """
-        remote_uid, = await self._request([b'ping'])
+        remote_uid, = await self._request(
+            [b'ping', self.session],
+            PRIORITY_CONTROL,
+        )
 
         return remote_uid
 
-    async def _on_request(self, frames):
+    async def _on_request(self, frames, header):
         """
         Called whenever a request is received.
 
         :param frames: The request frames.
+        :param header: The request header.
         :returns: A list of frames that constitute the reply.
         """
         domain = frames.pop(0)
@@ -281,6 +513,181 @@ class Client(GenericClient):
                 "Unexpected error while handling an incoming notification.",
             )
 
+    def __flush_registration_batch(self):
+        self.__registration_batch_handle = None
+        batch = [
+            (domain, credentials, future)
+            for domain, credentials, future in self.__registration_batch
+            if not future.done()
+        ]
+        self.__registration_batch = []
+
+        if batch:
+            self.add_task(self.__register_batch(batch))
+
+    async def __register_batch(self, batch):
+        try:
+            if len(batch) == 1:
+                domain, credentials, future = batch[0]
+                results = [b'200']
+                results.extend(
+                    await self._request(
+                        [b'register', domain, credentials],
+                        PRIORITY_CONTROL,
+                    ),
+                )
+            else:
+                logger.debug(
+                    "Registering %d domain(s) at once.",
+                    len(batch),
+                )
+                frames = [b'register_many']
+
+                for domain, credentials, _ in batch:
+                    frames.extend([domain, credentials])
+
+                results = await self._request(frames, PRIORITY_CONTROL)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+
+            raise
+        except Exception as ex:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+
+            return
+
+        for (_, _, future), code, value in zip(
+            batch,
+            results[::2],
+            results[1::2],
+        ):
+            if future.done():
+                continue
+
+            if code == b'200':
+                future.set_result(value)
+            else:
+                future.set_exception(
+                    CallError(
+                        code=int(code),
+                        message=value.decode('utf-8', 'replace'),
+                    ),
+                )
+
+        # The broker replied with fewer results than expected.
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(InvalidReplyError())
+
+    def __get_outbound_domain(self, frames):
+        # Requests are laid out as: type, id, header, command, domain, ...
+        # while notifications are laid out as: type, id, notification type,
+        # domain, ...
+        if frames[0] == b'request':
+            if frames[3] == b'ping':
+                return None
+
+            return frames[4]
+        elif frames[0] == b'notification':
+            return frames[3]
+
+    def __get_weight(self, domain):
+        client_proxy = self.__client_proxies_by_domain.get(domain)
+
+        if client_proxy is None:
+            return 1
+
+        return client_proxy.weight
+
+    async def __request_from(
+        self,
+        source_domain,
+        frames,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        header=None,
+    ):
+        semaphore = self.__inflight_semaphores.get(source_domain)
+
+        if semaphore is None:
+            return await self._request(frames, priority, timeout, header)
+
+        async with semaphore:
+            return await self._request(frames, priority, timeout, header)
+
+    async def __writing_loop(self):
+        try:
+            await self.__write_outbound_queues()
+        finally:
+            # The writers waiting for their frames to be sent would wait
+            # forever.
+            for queue in self.__outbound_queues.values():
+                for _, future in queue:
+                    future.cancel()
+
+            self.__outbound_queues.clear()
+            self.__outbound_domains.clear()
+
+    async def __write_outbound_queues(self):
+        while True:
+            await self.__outbound_event.wait()
+            self.__outbound_event.clear()
+
+            while self.__outbound_domains:
+                priority = min(self.__outbound_domains)
+                domains = self.__outbound_domains[priority]
+                domain = domains[0]
+                queue = self.__outbound_queues[priority, domain]
+
+                for _ in range(self.__get_weight(domain)):
+                    if not queue:
+                        break
+
+                    frames, future = queue.popleft()
+
+                    if future.done():
+                        continue
+
+                    try:
+                        await self.socket.send_multipart(frames)
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as ex:
+                        future.set_exception(ex)
+                    else:
+                        if not future.done():
+                            future.set_result(None)
+
+                if queue:
+                    domains.rotate(-1)
+                else:
+                    domains.popleft()
+                    del self.__outbound_queues[priority, domain]
+
+                    if not domains:
+                        del self.__outbound_domains[priority]
+
+    def __on_connection_ready(self, *args):
+        self.__ping_requested.set()
+
+    def __on_connection_lost(self, *args):
+        # Connections we drop ourselves while reconnecting are expected.
+        if not self.__has_connection.is_set():
+            return
+
+        logger.debug("Connection to the broker was lost.")
+        self.__has_connection.clear()
+        self.__connection_lost = True
+        self.__ping_requested.set()
+
+        # Pending requests are left alone: the socket may reconnect to the
+        # same broker before it forgets about us. They only fail once the
+        # ping tells us the broker is gone, or that it restarted.
+
     async def __reset(self):
         # Flush the outgoing queues.
         self.__has_connection.clear()
@@ -289,38 +696,61 @@ class Client(GenericClient):
         for client_proxy in self.client_proxies:
             client_proxy.token = None
 
+        self.fail_pending_requests(ConnectionLostError())
         await self.socket.reset_all()
 
+    async def __reconnect(self):
+        # Registrations are kept: if the broker that answers next knows our
+        # session (because it was restarted from a snapshot, or is a standby
+        # that took over), it will reply with the same unique identifier and
+        # we won't have to register again. The replies to our pending
+        # requests won't reach us though, as we drop the connection.
+        self.__has_connection.clear()
+        self.fail_pending_requests(ConnectionLostError())
+
+        if len(self.endpoints) > 1:
+            endpoint = self.endpoints.pop(0)
+            self.endpoints.append(endpoint)
+            await self.socket.disconnect(endpoint)
+            self.socket.connect(self.endpoints[0])
+            logger.info("Failing over to %s.", self.endpoints[0])
+        else:
+            await self.socket.reset_all()
+
     async def __ping_loop(self):
         while not self.closing:
             await self.__has_client_proxies.wait()
 
+            # There is no point waiting for the lost broker to come back
+            # when there are others to try.
+            if self.__connection_lost:
+                self.__connection_lost = False
+
+                if len(self.endpoints) > 1:
+                    await self.__reconnect()
+
             try:
                 remote_uid = await asyncio.wait_for(
                     self._ping(),
                     self.__ping_timeout,
+                    loop=self.loop,
                 )
             except asyncio.CancelledError:
                 raise
             except asyncio.TimeoutError:
                 if self.active_client_proxies:
                     logger.warning(
-                        "Broker did not reply in %s second(s). Performing "
-                        "implicit unregistration.",
+                        "Broker did not reply in %s second(s). Reconnecting.",
                         self.__ping_timeout,
                     )
 
-                await self.__reset()
+                await self.__reconnect()
 
             except Exception as ex:
                 if self.active_client_proxies:
-                    logger.error(
-                        "Ping request failed (%s). Performing implicit "
-                        "unregistration.",
-                        ex,
-                    )
+                    logger.error("Ping request failed (%s). Reconnecting.", ex)
 
-                await self.__reset()
+                await self.__reconnect()
             else:
                 if self.__remote_uid is None:
                     self.__remote_uid = remote_uid
@@ -334,6 +764,17 @@ class Client(GenericClient):
                     # Let's not sleep when we know the connection is alive.
                     continue
 
-                self.__has_connection.set()
+                if not self.__has_connection.is_set():
+                    self.__has_connection.set()
+                    self.on_connected.emit(self)
+
+            try:
+                await asyncio.wait_for(
+                    self.__ping_requested.wait(),
+                    self.__ping_interval,
+                    loop=self.loop,
+                )
+            except asyncio.TimeoutError:
+                pass
 
-            await asyncio.sleep(self.__ping_interval, loop=self.loop)
+            self.__ping_requested.clear()
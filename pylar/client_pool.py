@@ -0,0 +1,499 @@
+"""
+A pool of clients connected to several brokers.
+"""
+
+import asyncio
+
+from functools import partial
+
+from .async_object import AsyncObject
+from .client import Client
+from .client_proxy import ClientProxy
+from .common import PRIORITY_NORMAL
+from .errors import CallError
+from .log import logger as main_logger
+
+from pyslot import Signal
+
+logger = main_logger.getChild('client_pool')
+
+
+class PooledClientProxy(ClientProxy):
+    """
+    The registration of a client proxy on one of the brokers of a pool.
+
+    Incoming requests and notifications are handed over to the pooled client
+    proxy.
+    """
+    def __init__(self, *, owner, **kwargs):
+        super().__init__(
+            domain=owner.domain,
+            credentials=owner.credentials,
+            weight=owner.weight,
+            max_inflight=owner.max_inflight,
+            **kwargs
+        )
+        self.owner = owner
+
+    async def on_request(self, *args, **kwargs):
+        return await self.owner.on_request(*args, **kwargs)
+
+    async def on_notification(self, *args, **kwargs):
+        return await self.owner.on_notification(*args, **kwargs)
+
+
+class ClientPool(AsyncObject):
+    """
+    A drop-in replacement for `Client` that is connected to several brokers
+    at once.
+
+    Client proxies registered on the pool are registered on every broker.
+    Outgoing requests and notifications are sent through the least loaded of
+    the brokers that are currently reachable: a broker whose connection is
+    lost gets no new requests but the ones in flight are left to complete.
+    They only fail with a `ConnectionLostError` if the broker then misses a
+    ping or comes back with a different unique identifier.
+    """
+    def __init__(self, *, sockets, **kwargs):
+        """
+        :param sockets: The sockets to the brokers, one per broker.
+        """
+        super().__init__(**kwargs)
+        self.clients = [
+            Client(socket=socket, loop=self.loop)
+            for socket in sockets
+        ]
+
+        # Exposed signals.
+        self.on_connected = Signal()
+
+        # Brokers whose connection was lost get no new requests, without
+        # waiting for the clients to notice it through their pings.
+        self.__disconnected_clients = set()
+
+        for client in self.clients:
+            client.on_connected.connect(self.__on_client_connected)
+
+            for signal, callback in (
+                (
+                    getattr(client.socket, 'on_connection_ready', None),
+                    partial(self.__on_connection_ready, client),
+                ),
+                (
+                    getattr(client.socket, 'on_connection_lost', None),
+                    partial(self.__on_connection_lost, client),
+                ),
+            ):
+                if signal is not None:
+                    signal.connect(callback)
+                    self.add_cleanup(partial(signal.disconnect, callback))
+
+            self.add_cleanup(client.close)
+            self.add_cleanup(client.wait_closed)
+
+        self.__client_proxies_by_domain = {}
+        self.__pooled_client_proxies = {}
+        self.__inflight_requests = {client: 0 for client in self.clients}
+        self.__registrations = {}
+        self.__next_index = 0
+
+    @property
+    def has_connection(self):
+        return any(client.has_connection for client in self.clients)
+
+    async def wait_connection(self):
+        if self.has_connection:
+            return
+
+        tasks = [
+            asyncio.ensure_future(client.wait_connection(), loop=self.loop)
+            for client in self.clients
+        ]
+
+        try:
+            await asyncio.wait(
+                tasks,
+                return_when=asyncio.FIRST_COMPLETED,
+                loop=self.loop,
+            )
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def register_client_proxy(self, client_proxy):
+        assert client_proxy.domain not in self.__client_proxies_by_domain, (
+            "A client proxy with the same domain was already registered."
+        )
+
+        self.__client_proxies_by_domain[client_proxy.domain] = client_proxy
+        self.__registrations[client_proxy.domain] = asyncio.Event(
+            loop=self.loop,
+        )
+        pooled_client_proxies = self.__pooled_client_proxies[
+            client_proxy.domain
+        ] = {}
+
+        for client in self.clients:
+            pooled_client_proxy = PooledClientProxy(
+                owner=client_proxy,
+                client=client,
+                loop=self.loop,
+            )
+            pooled_client_proxy.on_registered.connect(
+                self.__on_pooled_client_proxy_registered,
+            )
+            pooled_client_proxy.on_unregistered.connect(
+                self.__on_pooled_client_proxy_unregistered,
+            )
+            pooled_client_proxies[client] = pooled_client_proxy
+
+        self.add_cleanup(client_proxy.close)
+        self.add_cleanup(client_proxy.wait_closed)
+
+    def unregister_client_proxy(self, client_proxy):
+        assert self.__client_proxies_by_domain.get(client_proxy.domain) is \
+            client_proxy
+
+        del self.__client_proxies_by_domain[client_proxy.domain]
+        del self.__registrations[client_proxy.domain]
+
+        for pooled_client_proxy in self.__pooled_client_proxies.pop(
+            client_proxy.domain,
+        ).values():
+            pooled_client_proxy.close()
+
+        client_proxy.close()
+
+    @property
+    def client_proxies(self):
+        return list(self.__client_proxies_by_domain.values())
+
+    @property
+    def active_client_proxies(self):
+        return [
+            client_proxy for client_proxy in self.client_proxies
+            if client_proxy.registered
+        ]
+
+    async def drain(self, timeout=None):
+        """
+        Drain all the client proxies, then close.
+
+        :param timeout: The maximum number of seconds to wait for the
+            requests in progress, or `None` to wait for as long as needed.
+        """
+        await asyncio.gather(
+            *[
+                client_proxy.drain(timeout)
+                for client_proxy in self.client_proxies
+            ],
+            loop=self.loop
+        )
+        self.close()
+
+    def get_client_proxy(self, domain):
+        """
+        Get an active client proxy with the specified domain.
+
+        :param domain: The domain.
+        :returns: The client proxy, or `None` if no such client proxy is found.
+        """
+        return self.__client_proxies_by_domain.get(domain)
+
+    async def request(
+        self,
+        source_domain,
+        target_domain,
+        command,
+        args=(),
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        hedge=None,
+    ):
+        """
+        Send a generic request to a specified domain.
+
+        :param source domain: The source domain.
+        :param target_domain: The target domain.
+        :param command: The command.
+        :param args: A list of frames to pass.
+        :param priority: The request priority. Lower values are more urgent.
+        :param timeout: The request timeout, in seconds.
+        :param hedge: An identifier shared by the copies of a hedged request.
+        :returns: The request result.
+        """
+        return await self.__call(
+            source_domain,
+            'request',
+            target_domain=target_domain,
+            command=command,
+            args=args,
+            priority=priority,
+            timeout=timeout,
+            hedge=hedge,
+        )
+
+    async def notification(self, source_domain, target_domain, type_, args=()):
+        """
+        Send a generic notification to a specified domain.
+
+        :param source domain: The source domain.
+        :param target_domain: The target domain.
+        :param type_: The type.
+        :param args: A list of frames to pass.
+        """
+        return await self.__call(
+            source_domain,
+            'notification',
+            target_domain=target_domain,
+            type_=type_,
+            args=args,
+        )
+
+    async def broadcast(self, source_domain, target_domain, type_, args=()):
+        """
+        Send a notification to all the connections registered for a domain.
+
+        :param source_domain: The source domain.
+        :param target_domain: The target domain.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        return await self.__call(
+            source_domain,
+            'broadcast',
+            target_domain=target_domain,
+            type_=type_,
+            args=args,
+        )
+
+    async def publish(self, source_domain, topic, type_, args=()):
+        """
+        Publish a notification to all the subscribers of a topic.
+
+        :param source_domain: The source domain.
+        :param topic: The topic.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        return await self.__call(
+            source_domain,
+            'publish',
+            topic=topic,
+            type_=type_,
+            args=args,
+        )
+
+    async def subscribe(self, source_domain, topic):
+        """
+        Subscribe to a topic on all the brokers.
+
+        :param source_domain: The domain that subscribes.
+        :param topic: The topic.
+
+        Brokers that are unavailable get the subscription as soon as the
+        domain registers on them.
+        """
+        await self.__for_each_broker(source_domain, 'subscribe', topic)
+
+    async def unsubscribe(self, source_domain, topic):
+        """
+        Unsubscribe from a topic on all the brokers.
+
+        :param source_domain: The domain that unsubscribes.
+        :param topic: The topic.
+        """
+        await self.__for_each_broker(source_domain, 'unsubscribe', topic)
+
+    async def query(self, source_domain, target_domain):
+        """
+        Query a broker for a given domain.
+
+        :param domain: The domain that queries.
+        :param target_domain: The target domain to query.
+        """
+        return await self.__call(
+            source_domain,
+            'query',
+            target_domain=target_domain,
+        )
+
+    async def revoke(self, source_domain, target_domain):
+        """
+        Ask all the brokers to revoke the cached authentications of a domain.
+
+        :param source_domain: The domain that revokes.
+        :param target_domain: The domain whose authentications are revoked.
+        """
+        await self.__for_each_broker(source_domain, 'revoke', target_domain)
+
+    async def transmit(
+        self,
+        source_domain,
+        target_domain,
+        x_domain,
+        x_token,
+        frames,
+    ):
+        """
+        Perform a request on behalf of another domain.
+        """
+        return await self.__call(
+            source_domain,
+            'transmit',
+            target_domain=target_domain,
+            x_domain=x_domain,
+            x_token=x_token,
+            frames=frames,
+        )
+
+    async def notification_transmit(
+        self,
+        source_domain,
+        target_domain,
+        type_,
+        x_domain,
+        x_token,
+        frames,
+    ):
+        """
+        Send a notification on behalf of another domain.
+        """
+        return await self.__call(
+            source_domain,
+            'notification_transmit',
+            target_domain=target_domain,
+            type_=type_,
+            x_domain=x_domain,
+            x_token=x_token,
+            frames=frames,
+        )
+
+    # Protected methods.
+
+    async def _register(self, domain, credentials):
+        """
+        Wait for a domain to be registered on at least one broker.
+
+        :param domain: The domain to register for.
+        :param credentials: The credentials for the domain. Unused: each
+            broker registration is handled separately.
+        :returns: The authentication token of one of the registrations.
+        """
+        await self.__registrations[domain].wait()
+
+        for pooled_client_proxy in self.__pooled_client_proxies[
+            domain
+        ].values():
+            if pooled_client_proxy.registered:
+                return pooled_client_proxy.token
+
+        raise CallError(code=503, message="No broker available.")
+
+    async def _drain(self, domain):
+        """
+        Ask all the brokers to stop routing requests to a domain.
+
+        :param domain: The domain.
+        """
+        pooled_client_proxies = self.__pooled_client_proxies[domain]
+        await asyncio.gather(
+            *[
+                client._drain(domain)
+                for client, client_proxy in pooled_client_proxies.items()
+                if client_proxy.registered
+            ],
+            return_exceptions=True,
+            loop=self.loop
+        )
+
+    # Private methods.
+
+    def __on_pooled_client_proxy_registered(self, pooled_client_proxy):
+        self.__registrations[pooled_client_proxy.domain].set()
+
+    def __on_pooled_client_proxy_unregistered(self, pooled_client_proxy):
+        domain = pooled_client_proxy.domain
+        pooled_client_proxies = self.__pooled_client_proxies.get(domain)
+
+        if not pooled_client_proxies or any(
+            p.registered for p in pooled_client_proxies.values()
+        ):
+            return
+
+        # The domain is no longer registered anywhere.
+        self.__registrations[domain].clear()
+        self.__client_proxies_by_domain[domain].token = None
+
+    def __on_client_connected(self, client):
+        self.on_connected.emit(self)
+
+    def __on_connection_ready(self, client, *args):
+        self.__disconnected_clients.discard(client)
+
+    def __on_connection_lost(self, client, *args):
+        if client not in self.__disconnected_clients:
+            logger.warning(
+                "Lost connection to a broker: sending new requests to the "
+                "other ones.",
+            )
+            self.__disconnected_clients.add(client)
+
+    def __select_client(self, source_domain):
+        pooled_client_proxies = self.__pooled_client_proxies.get(
+            source_domain,
+            {},
+        )
+        clients = [
+            client for client in self.clients
+            if client in pooled_client_proxies and
+            pooled_client_proxies[client].registered
+        ]
+        healthy_clients = [
+            client for client in clients
+            if client.has_connection and
+            client not in self.__disconnected_clients
+        ]
+
+        if healthy_clients:
+            clients = healthy_clients
+
+        if not clients:
+            raise CallError(code=503, message="No broker available.")
+
+        # Least loaded first, in a round-robin fashion for equal loads.
+        self.__next_index = (self.__next_index + 1) % len(clients)
+        clients = clients[self.__next_index:] + clients[:self.__next_index]
+
+        return min(clients, key=self.__inflight_requests.__getitem__)
+
+    async def __call(self, source_domain, method, **kwargs):
+        client = self.__select_client(source_domain)
+        self.__inflight_requests[client] += 1
+
+        try:
+            return await getattr(client, method)(
+                source_domain=source_domain,
+                **kwargs
+            )
+        finally:
+            self.__inflight_requests[client] -= 1
+
+    async def __for_each_broker(self, source_domain, method, *args):
+        tasks = []
+
+        for pooled_client_proxy in self.__pooled_client_proxies.get(
+            source_domain,
+            {},
+        ).values():
+            coro = getattr(pooled_client_proxy, method)(*args)
+
+            if pooled_client_proxy.registered:
+                tasks.append(
+                    asyncio.ensure_future(coro, loop=self.loop),
+                )
+            else:
+                pooled_client_proxy.add_task(coro)
+
+        if tasks:
+            await asyncio.gather(*tasks, loop=self.loop)
@@ -3,12 +3,15 @@ A client proxy class.
 """
 
 import asyncio
+import random
 
+from contextlib import contextmanager
 from functools import partial
-from math import ceil
 
 from .async_object import AsyncObject
+from .circuit_breaker import CircuitBreaker
 from .client_context import ClientContext
+from .common import PRIORITY_NORMAL
 from .errors import CallError
 from .log import logger as main_logger
 
@@ -82,24 +85,88 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
 
         return decorator
 
-    def __init__(self, *, client, domain, credentials, **kwargs):
+    def __init__(
+        self,
+        *,
+        client,
+        domain,
+        credentials,
+        weight=1,
+        max_inflight=None,
+        registration_timeout=5.0,
+        circuit_breaker=None,
+        **kwargs
+    ):
+        """
+        :param client: The client to register on.
+        :param domain: The domain to register as.
+        :param credentials: The credentials for the domain.
+        :param weight: The share of the client's outgoing bandwidth this
+            client proxy gets, relative to the other ones. A positive
+            integer.
+        :param max_inflight: The maximum number of concurrent requests this
+            client proxy can have pending on the client. `None` means no
+            limit.
+        :param registration_timeout: The number of seconds after which a
+            registration attempt is abandoned.
+        :param circuit_breaker: Enables a circuit breaker per target domain,
+            so that requests to a failing target fail right away instead of
+            adding to its load. Either `True` to use the default settings, or
+            a dictionary of `CircuitBreaker` parameters.
+        """
+        # The client sends `weight` messages in a row for each client proxy:
+        # anything less than one would never let its queue empty.
+        if not isinstance(weight, int) or weight < 1:
+            raise ValueError(
+                "The weight must be a positive integer, not %r." % (weight,),
+            )
+
         super().__init__(**kwargs)
         self.client = client
         self.domain = domain
         self.credentials = credentials
+        self.weight = weight
+        self.max_inflight = max_inflight
         self.task = self.add_task(self.__register_loop()),
 
         # Exposed signals.
         self.on_registered = Signal()
         self.on_unregistered = Signal()
 
-        self.__registration_timeout = 5.0
+        self.__registration_timeout = registration_timeout
         self.__registered = asyncio.Event(loop=client.loop)
         self.__unregistered = asyncio.Event(loop=client.loop)
 
+        # Failed registrations are retried right away when the client gets
+        # a connection back, instead of waiting for the backoff delay.
+        self.__registration_retry = asyncio.Event(loop=client.loop)
+        client.on_connected.connect(self.__on_client_connected)
+        self.add_cleanup(
+            partial(
+                client.on_connected.disconnect,
+                self.__on_client_connected,
+            ),
+        )
+
         self.__token = None
         self.token = None
 
+        # The topics to subscribe to again whenever we register.
+        self.__subscriptions = set()
+
+        # The incoming requests and notifications being processed, which a
+        # drain waits for.
+        self.__draining = False
+        self.__work_in_progress = 0
+        self.__idle = asyncio.Event(loop=client.loop)
+        self.__idle.set()
+
+        if circuit_breaker is True:
+            circuit_breaker = {}
+
+        self.__circuit_breaker_options = circuit_breaker
+        self.__circuit_breakers = {}
+
         self.client.register_client_proxy(self)
         self.add_cleanup(partial(self.client.unregister_client_proxy, self))
 
@@ -148,27 +215,181 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
     async def wait_unregistered(self):
         await self.__unregistered.wait()
 
-    async def request(self, target_domain, command, args=()):
+    @property
+    def draining(self):
+        return self.__draining
+
+    async def drain(self, timeout=None):
+        """
+        Stop receiving new requests, wait for the ones in progress to
+        complete and close.
+
+        :param timeout: The maximum number of seconds to wait for the
+            requests in progress, or `None` to wait for as long as needed.
+
+        The broker stops routing requests to this client proxy but the
+        registration is kept until the client proxy closes, so that the
+        requests in progress can still make calls of their own.
+        """
+        if not self.__draining:
+            self.__draining = True
+
+            if self.registered:
+                logger.info("Draining %s.", self.context)
+
+                try:
+                    await asyncio.wait_for(
+                        self.client._drain(self.domain),
+                        self.__registration_timeout,
+                        loop=self.loop,
+                    )
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    logger.warning(
+                        "Could not drain %s on the broker (%s).",
+                        self.context,
+                        ex,
+                    )
+
+        try:
+            await asyncio.wait_for(self.__idle.wait(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%d request(s) still in progress for %s after %s second(s). "
+                "Closing anyway.",
+                self.__work_in_progress,
+                self.context,
+                timeout,
+            )
+
+        self.close()
+
+    async def request(
+        self,
+        target_domain,
+        command,
+        args=(),
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        hedge=None,
+    ):
+        """
+        Send a request to a specified domain.
+
+        :param target_domain: The target domain.
+        :param command: The command.
+        :param args: A list of frames to pass.
+        :param priority: The request priority. Lower values are more urgent.
+        :param timeout: The number of seconds after which the request is
+            abandoned, or `None` to wait forever. The target stops processing
+            the request once the timeout expires.
+        :param hedge: An identifier shared by the copies of a hedged request,
+            so that the broker sends them to different connections.
+        :returns: The request result.
+        """
         await self.wait_registered()
 
         client_proxy = self.client.get_client_proxy(target_domain)
 
         # If we have a local client proxy that matches, we don't need to
         # contact the broker about it and can make the request locally.
-        if client_proxy:
-            return await client_proxy.on_request(
-                source_domain=self.domain,
-                source_token=self.token,
-                command=command,
-                args=args,
+        # Draining ones take nothing new: the broker knows where else to go.
+        if client_proxy and not client_proxy.draining:
+            return await asyncio.wait_for(
+                client_proxy.on_request(
+                    source_domain=self.domain,
+                    source_token=self.token,
+                    command=command,
+                    args=args,
+                ),
+                timeout,
+                loop=self.loop,
             )
         else:
-            return await self.client.request(
-                source_domain=self.domain,
-                target_domain=target_domain,
-                command=command,
-                args=args,
-            )
+            circuit_breaker = self.get_circuit_breaker(target_domain)
+
+            if circuit_breaker is None:
+                return await self.client.request(
+                    source_domain=self.domain,
+                    target_domain=target_domain,
+                    command=command,
+                    args=args,
+                    priority=priority,
+                    timeout=timeout,
+                    hedge=hedge,
+                )
+
+            probe = circuit_breaker.acquire()
+            started_at = self.loop.time()
+            failed = None
+
+            try:
+                result = await self.client.request(
+                    source_domain=self.domain,
+                    target_domain=target_domain,
+                    command=command,
+                    args=args,
+                    priority=priority,
+                    timeout=timeout,
+                    hedge=hedge,
+                )
+            except asyncio.TimeoutError:
+                failed = True
+                raise
+            except CallError as ex:
+                # Errors caused by the request itself don't mean the target
+                # is in trouble.
+                failed = ex.code >= 500
+                raise
+            else:
+                failed = False
+                return result
+            finally:
+                circuit_breaker.release(
+                    duration=self.loop.time() - started_at,
+                    failed=failed,
+                    probe=probe,
+                )
+
+    def get_circuit_breaker(self, target_domain):
+        """
+        Get the circuit breaker for a target domain.
+
+        :param target_domain: The target domain.
+        :returns: The circuit breaker, or `None` if circuit breakers are not
+            enabled.
+        """
+        if self.__circuit_breaker_options is None:
+            return None
+
+        circuit_breaker = self.__circuit_breakers.get(target_domain)
+
+        if circuit_breaker is None:
+            circuit_breaker = self.__circuit_breakers[target_domain] = \
+                CircuitBreaker(
+                    name=target_domain.decode('utf-8'),
+                    loop=self.loop,
+                    **self.__circuit_breaker_options
+                )
+
+        return circuit_breaker
+
+    @contextmanager
+    def local_work(self):
+        """
+        Account for work done on behalf of a co-located caller, that doesn't
+        go through `on_request`, so that draining waits for it too.
+
+        Callers should not start new work once the client proxy is
+        draining.
+        """
+        self.__begin_work()
+
+        try:
+            yield
+        finally:
+            self.__end_work()
 
     async def on_request(
         self,
@@ -186,6 +407,25 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
         :param args: The additional frames.
         :returns: The result.
         """
+        self.__begin_work()
+
+        try:
+            return await self.__dispatch_request(
+                source_domain,
+                source_token,
+                command,
+                args,
+            )
+        finally:
+            self.__end_work()
+
+    async def __dispatch_request(
+        self,
+        source_domain,
+        source_token,
+        command,
+        args,
+    ):
         command_attrs = self._commands.get(command)
 
         if command_attrs is None:
@@ -215,7 +455,8 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
 
         # If we have a local client proxy that matches, we don't need to
         # contact the broker about it and can make the request locally.
-        if client_proxy:
+        # Draining ones take nothing new: the broker knows where else to go.
+        if client_proxy and not client_proxy.draining:
             return await client_proxy.on_notification(
                 source_domain=self.domain,
                 source_token=self.token,
@@ -245,6 +486,25 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
         :param type_: The type, as a string.
         :param args: The additional frames.
         """
+        self.__begin_work()
+
+        try:
+            return await self.__dispatch_notification(
+                source_domain,
+                source_token,
+                type_,
+                args,
+            )
+        finally:
+            self.__end_work()
+
+    async def __dispatch_notification(
+        self,
+        source_domain,
+        source_token,
+        type_,
+        args,
+    ):
         notification_attrs = self._notifications.get(type_)
         context = ClientContext(
             domain=source_domain,
@@ -269,6 +529,77 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
 
         await notification(*notification_args)
 
+    async def broadcast(self, target_domain, type_, args=()):
+        """
+        Send a notification to every replica of a domain.
+
+        Unlike `notification`, which reaches only one of the connections
+        registered for the target domain, the broker delivers a broadcast to
+        all of them.
+
+        :param target_domain: The target domain.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        await self.wait_registered()
+
+        return await self.client.broadcast(
+            source_domain=self.domain,
+            target_domain=target_domain,
+            type_=type_,
+            args=args,
+        )
+
+    async def subscribe(self, topic):
+        """
+        Subscribe to a topic.
+
+        Notifications published to the topic or to any of its subtopics are
+        delivered to this client proxy, with the topic as their first
+        argument. Subscriptions are restored automatically after a
+        re-registration.
+
+        :param topic: The topic.
+        """
+        self.__subscriptions.add(topic)
+        await self.wait_registered()
+
+        return await self.client.subscribe(
+            source_domain=self.domain,
+            topic=topic,
+        )
+
+    async def unsubscribe(self, topic):
+        """
+        Unsubscribe from a topic.
+
+        :param topic: The topic.
+        """
+        self.__subscriptions.discard(topic)
+        await self.wait_registered()
+
+        return await self.client.unsubscribe(
+            source_domain=self.domain,
+            topic=topic,
+        )
+
+    async def publish(self, topic, type_, args=()):
+        """
+        Publish a notification to all the subscribers of a topic.
+
+        :param topic: The topic.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        await self.wait_registered()
+
+        return await self.client.publish(
+            source_domain=self.domain,
+            topic=topic,
+            type_=type_,
+            args=args,
+        )
+
     async def query(self, target_domain):
         """
         Query the broker for a given domain.
@@ -282,6 +613,19 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
             target_domain=target_domain,
         )
 
+    async def revoke(self, target_domain):
+        """
+        Ask the broker to revoke the cached authentications of a domain.
+
+        :param target_domain: The domain whose authentications are revoked.
+        """
+        await self.wait_registered()
+
+        return await self.client.revoke(
+            source_domain=self.domain,
+            target_domain=target_domain,
+        )
+
     async def transmit(self, target_domain, x_domain, x_token, frames):
         """
         Transmit a message to the broken on behalf of another domain.
@@ -321,16 +665,48 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
             frames=frames,
         )
 
+    def __begin_work(self):
+        self.__work_in_progress += 1
+        self.__idle.clear()
+
+    def __end_work(self):
+        self.__work_in_progress -= 1
+
+        if not self.__work_in_progress:
+            self.__idle.set()
+
+    def __on_client_connected(self, client):
+        self.__registration_retry.set()
+
+    async def __wait_registration_retry(self, delay):
+        # The actual delay is randomized so that the many clients that lost
+        # the same broker don't all register again at the same time.
+        delay = random.uniform(delay / 2, delay)
+        self.__registration_retry.clear()
+
+        try:
+            await asyncio.wait_for(
+                self.__registration_retry.wait(),
+                delay,
+                loop=self.loop,
+            )
+        except asyncio.TimeoutError:
+            pass
+
     async def __register_loop(self):
-        min_delay = 1
+        min_delay = 0.5
         max_delay = 60
-        factor = 1.5
-        delay = 1
+        factor = 2
+        delay = min_delay
 
         while not self.closing:
             await self.wait_unregistered()
             await self.client.wait_connection()
 
+            # A draining client proxy must not come back.
+            if self.__draining:
+                return
+
             try:
                 logger.debug(
                     "Registration for %s in progress...",
@@ -349,19 +725,40 @@ class ClientProxy(AsyncObject, metaclass=ClientProxyMeta):
             except asyncio.TimeoutError:
                 logger.warning(
                     "Registration did not complete within %s second(s). "
-                    "Retrying in %s second(s).",
+                    "Retrying in up to %s second(s).",
                     self.__registration_timeout,
                     delay,
                 )
-                await asyncio.sleep(delay, loop=self.loop)
-                delay = min(ceil(delay * factor), max_delay)
+                await self.__wait_registration_retry(delay)
+                delay = min(delay * factor, max_delay)
             except Exception as ex:
                 logger.error(
-                    "Registration failed (%s): retrying in %s second(s).",
+                    "Registration failed (%s): retrying in up to %s "
+                    "second(s).",
                     ex,
                     delay,
                 )
-                await asyncio.sleep(delay, loop=self.loop)
-                delay = min(ceil(delay * factor), max_delay)
+                await self.__wait_registration_retry(delay)
+                delay = min(delay * factor, max_delay)
             else:
                 delay = min_delay
+
+                if self.__subscriptions:
+                    self.add_task(self.__resubscribe())
+
+    async def __resubscribe(self):
+        for topic in list(self.__subscriptions):
+            try:
+                await self.client.subscribe(
+                    source_domain=self.domain,
+                    topic=topic,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.error(
+                    "Could not subscribe %s to topic %s again (%s).",
+                    self.context,
+                    topic,
+                    ex,
+                )
@@ -3,6 +3,12 @@ Common class and utilities.
 """
 
 import json
+import math
+import struct
+
+from .errors import CallError
+
+FRAME_SIZE = struct.Struct('!I')
 
 
 def serialize(value):
@@ -23,3 +29,141 @@ def deserialize(value):
     :returns: The value.
     """
     return json.loads(value.decode('utf-8'))
+
+
+def pack_frames(frames):
+    """
+    Pack a list of frames into a single buffer.
+
+    :param frames: A list of frames.
+    :returns: Bytes.
+    """
+    parts = [FRAME_SIZE.pack(len(frames))]
+
+    for frame in frames:
+        parts.append(FRAME_SIZE.pack(len(frame)))
+        parts.append(frame)
+
+    return b''.join(parts)
+
+
+def unpack_frames(data):
+    """
+    Unpack a buffer created by `pack_frames`.
+
+    :param data: The buffer.
+    :returns: A list of frames.
+    """
+    count, = FRAME_SIZE.unpack_from(data)
+    offset = FRAME_SIZE.size
+    frames = []
+
+    for _ in range(count):
+        size, = FRAME_SIZE.unpack_from(data, offset)
+        offset += FRAME_SIZE.size
+        frames.append(bytes(data[offset:offset + size]))
+        offset += size
+
+    return frames
+
+
+# Request priorities: lower values are more urgent.
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BULK = 20
+
+
+def serialize_header(header):
+    """
+    Serialize a request header.
+
+    :param header: A dictionary of header fields.
+    :returns: Bytes. An empty header is serialized as an empty frame.
+    """
+    if not header:
+        return b''
+
+    return serialize(header)
+
+
+def deserialize_header(value):
+    """
+    Deserialize a request header.
+
+    :param value: The header frame.
+    :returns: A dictionary of header fields. Invalid headers are ignored.
+    """
+    if not value:
+        return {}
+
+    try:
+        header = deserialize(value)
+    except ValueError:
+        return {}
+
+    if not isinstance(header, dict):
+        return {}
+
+    return header
+
+
+def get_deadline(header, loop):
+    """
+    Turn the relative timeout of a request header into a local deadline.
+
+    :param header: A dictionary of header fields.
+    :param loop: The event loop.
+    :returns: The deadline, in the event loop's time, or `None` if the request
+        has no timeout.
+    :raises CallError: With a 400 code if the timeout is not a non-negative
+        number.
+    """
+    timeout = header.get('timeout')
+
+    if timeout is None:
+        return None
+
+    if isinstance(timeout, bool) or \
+            not isinstance(timeout, (int, float)) or \
+            not math.isfinite(timeout) or \
+            timeout < 0:
+        raise CallError(
+            code=400,
+            message="Invalid request timeout: %r." % (timeout,),
+        )
+
+    return loop.time() + timeout
+
+
+def get_timeout(header, loop):
+    """
+    Get the time left to process a request from its header.
+
+    :param header: A dictionary of header fields, whose deadline was set
+        locally with `get_deadline`.
+    :param loop: The event loop.
+    :returns: The remaining time, in seconds, or `None` if the request has no
+        deadline.
+    """
+    deadline = header.get('deadline')
+
+    if deadline is None:
+        return None
+
+    return max(0.0, deadline - loop.time())
+
+
+def get_priority(header):
+    """
+    Get the priority of a request from its header.
+
+    :param header: A dictionary of header fields.
+    :returns: The request priority, clamped to the defined priorities. Invalid
+        ones are treated as normal.
+    """
+    priority = header.get('priority', PRIORITY_NORMAL)
+
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        return PRIORITY_NORMAL
+
+    return min(max(priority, PRIORITY_CONTROL), PRIORITY_BULK)
@@ -6,6 +6,7 @@ Domain related functions and constants.
 DOMAIN_SEPARATOR = b'/'
 USER_DOMAIN_PREFIX = b'user'
 SERVICE_DOMAIN_PREFIX = b'service'
+BROKER_DOMAIN = b'broker'
 
 
 def user_domain(username):
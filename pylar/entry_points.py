@@ -3,25 +3,25 @@ Entry-points.
 """
 
 import asyncio
-import azmq
-import chromalog
 import click
-import entrypoints
 import importlib
 import logging
 import signal
 import sys
 import traceback
 
-from azmq import Context
 from base64 import b64decode
 from contextlib import contextmanager
+from functools import lru_cache
 
-from .broker import Broker
-from .client import Client
+# Most dependencies are imported where they are used: this module is loaded
+# by every command-line invocation, including the ones that just print their
+# help.
 
 
 def setup_logging(debug):
+    import chromalog
+
     chromalog.basicConfig(
         level=logging.DEBUG if debug else logging.INFO,
         format='[%(levelname)s] %(message)s',
@@ -32,23 +32,27 @@ def setup_logging(debug):
         logging.getLogger('azmq').setLevel(logging.WARNING)
 
 
-if sys.platform == 'win32':
-    from asyncio import ProactorEventLoop as LoopClass
-else:
-    try:
-        from uvloop import EventLoop as LoopClass
-    except ImportError:
-        from asyncio import SelectorEventLoop as LoopClass
+def get_loop_class():
+    if sys.platform == 'win32':
+        from asyncio import ProactorEventLoop as LoopClass
+    else:
+        try:
+            from uvloop import EventLoop as LoopClass
+        except ImportError:
+            from asyncio import SelectorEventLoop as LoopClass
+
+    return LoopClass
 
 
 def set_event_loop():
-    loop = LoopClass()
+    loop = get_loop_class()()
     asyncio.set_event_loop(loop)
     return loop
 
 
 DEFAULT_ENDPOINT = 'tcp://127.0.0.1:3333'
 DEFAULT_SHARED_SECRET = b'changethissecret'
+DEFAULT_DRAIN_TIMEOUT = 10.0
 
 
 @contextmanager
@@ -80,6 +84,7 @@ def allow_interruption(*callbacks):
                 loop.call_soon_threadsafe(cb)
 
         signal.signal(signal.SIGINT, handler)
+        signal.signal(signal.SIGTERM, handler)
 
     try:
         yield
@@ -89,6 +94,107 @@ def allow_interruption(*callbacks):
                 raise WindowsError()
         else:
             signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def drain_then_close(loop, obj, timeout):
+    """
+    Get a callback that drains an object the first time it is called and
+    closes it right away the next time.
+
+    :param loop: The event loop.
+    :param obj: An object with `drain` and `close` methods.
+    :param timeout: The drain timeout, in seconds.
+    """
+    drain_task = None
+
+    def callback():
+        nonlocal drain_task
+
+        if drain_task is not None:
+            click.echo("Interrupted again: stopping now.")
+            drain_task.cancel()
+            obj.close()
+        else:
+            click.echo(
+                "Draining (for up to %s second(s)). Interrupt again to stop "
+                "now." % timeout,
+            )
+            drain_task = asyncio.ensure_future(obj.drain(timeout), loop=loop)
+
+    return callback
+
+
+def bind_sockets(context, endpoints, loop):
+    """
+    Create listening sockets for the specified endpoints.
+
+    All ZMQ endpoints share the same ROUTER socket while each `shm://`
+    endpoint gets its own.
+    """
+    import azmq
+
+    from .shm import (
+        ShmRouterSocket,
+        is_shm_endpoint,
+    )
+
+    sockets = []
+    zmq_endpoints = [
+        endpoint for endpoint in endpoints
+        if not is_shm_endpoint(endpoint)
+    ]
+
+    if zmq_endpoints:
+        socket = context.socket(azmq.ROUTER)
+
+        for endpoint in zmq_endpoints:
+            socket.bind(endpoint)
+
+        sockets.append(socket)
+
+    for endpoint in endpoints:
+        if is_shm_endpoint(endpoint):
+            socket = ShmRouterSocket(loop=loop)
+            socket.bind(endpoint)
+            sockets.append(socket)
+
+    return sockets
+
+
+def connect_socket(context, endpoint, loop):
+    """
+    Create a socket connected to the specified endpoint.
+    """
+    import azmq
+
+    from .shm import (
+        ShmDealerSocket,
+        is_shm_endpoint,
+    )
+
+    if is_shm_endpoint(endpoint):
+        socket = ShmDealerSocket(loop=loop)
+    else:
+        socket = context.socket(azmq.DEALER)
+
+    socket.connect(endpoint)
+
+    return socket
+
+
+def close_sockets(context, sockets, loop):
+    """
+    Close the specified sockets and their context.
+    """
+    for socket in sockets:
+        socket.close()
+
+    for socket in sockets:
+        loop.run_until_complete(socket.wait_closed())
+
+    context.close()
+    loop.run_until_complete(context.wait_closed())
 
 
 def import_class(dotted_name):
@@ -98,18 +204,45 @@ def import_class(dotted_name):
     return getattr(module, class_name)
 
 
+@lru_cache()
+def get_entry_points(group):
+    """
+    Get the entry points of a group.
+
+    :param group: The entry points group.
+    :returns: A dictionary of entry points, indexed by name.
+
+    Installed distributions are scanned once per group and per process:
+    nothing is kept between runs.
+    """
+    import entrypoints
+
+    return entrypoints.get_group_named(group)
+
+
+def load_entry_point(group, name):
+    entry_point = get_entry_points(group).get(name)
+
+    if entry_point is None:
+        raise LookupError(
+            "No entry point named %s in group %s." % (name, group),
+        )
+
+    return entry_point.load()
+
+
 def import_service(name):
     if '.' in name:
         return import_class(name)
     else:
-        return entrypoints.get_single('pylar_services', name).load()
+        return load_entry_point('pylar_services', name)
 
 
 def import_iservice(name):
     if '.' in name:
         return import_class(name)
     else:
-        return entrypoints.get_single('pylar_iservices', name).load()
+        return load_entry_point('pylar_iservices', name)
 
 
 def check_shared_secret(shared_secret):
@@ -143,7 +276,76 @@ def check_shared_secret(shared_secret):
     "use too.",
 )
 @click.option('-l', '--listen', nargs=1, metavar='endpoint', multiple=True)
-def broker(debug, shared_secret, listen):
+@click.option(
+    '-p',
+    '--peer',
+    nargs=1,
+    metavar='endpoint',
+    multiple=True,
+    help="The endpoint of a remote broker to peer with.",
+)
+@click.option(
+    '-q',
+    '--notification-queue',
+    default=None,
+    metavar='directory',
+    help="A directory in which to keep the notifications for unavailable "
+    "domains until they register.",
+)
+@click.option(
+    '--snapshot',
+    default=None,
+    metavar='path',
+    help="A file in which to save the registry, so that clients don't have "
+    "to register again after a restart.",
+)
+@click.option(
+    '--standby-of',
+    default=None,
+    metavar='endpoint',
+    help="The endpoint of a primary broker to replicate. The broker only "
+    "starts listening once the primary becomes unreachable.",
+)
+@click.option(
+    '--max-missed-pings',
+    default=3,
+    type=click.IntRange(min=1),
+    metavar='N',
+    help="With --standby-of, the number of consecutive pings the primary "
+    "must miss before the broker takes over.",
+)
+@click.option(
+    '--drain-timeout',
+    default=DEFAULT_DRAIN_TIMEOUT,
+    type=float,
+    metavar='seconds',
+    help="When interrupted, the number of seconds to wait for the requests "
+    "in flight before stopping.",
+)
+@click.option(
+    '--max-concurrent-requests',
+    default=None,
+    type=click.IntRange(min=1),
+    metavar='N',
+    help="The number of requests from a single client to process at once. "
+    "Requests in excess wait their turn, the most urgent first.",
+)
+def broker(
+    debug,
+    shared_secret,
+    listen,
+    peer,
+    notification_queue,
+    snapshot,
+    standby_of,
+    max_missed_pings,
+    drain_timeout,
+    max_concurrent_requests,
+):
+    from azmq import Context
+
+    from .broker import Broker
+
     setup_logging(debug=debug)
 
     shared_secret = check_shared_secret(shared_secret)
@@ -155,21 +357,50 @@ def broker(debug, shared_secret, listen):
 
     loop = set_event_loop()
     context = Context(loop=loop)
-    socket = context.socket(azmq.ROUTER)
-
-    for endpoint in listen:
-        socket.bind(endpoint)
+    sockets = []
+    peer_sockets = [
+        connect_socket(context, endpoint, loop)
+        for endpoint in peer
+    ]
+
+    if standby_of:
+        replica_socket = connect_socket(context, standby_of, loop)
+        other_sockets = peer_sockets + [replica_socket]
+    else:
+        sockets.extend(bind_sockets(context, listen, loop))
+        replica_socket = None
+        other_sockets = peer_sockets
 
     broker = Broker(
-        socket=socket,
+        sockets=sockets,
         shared_secret=shared_secret,
+        peer_sockets=peer_sockets,
+        notification_queue_directory=notification_queue,
+        snapshot_path=snapshot,
+        replicate_from=replica_socket,
+        replication_max_missed_pings=max_missed_pings,
+        max_concurrent_requests=max_concurrent_requests,
         loop=loop,
     )
 
-    click.echo("Broker started on %s." % ', '.join(listen))
+    @broker.on_promoted.connect
+    def on_promoted(broker):
+        for socket in bind_sockets(context, listen, loop):
+            sockets.append(socket)
+            broker.add_socket(socket)
+
+        click.echo("Broker took over on %s." % ', '.join(listen))
+
+    if standby_of:
+        click.echo("Broker standing by for %s." % standby_of)
+    else:
+        click.echo("Broker started on %s." % ', '.join(listen))
+
+    if peer:
+        click.echo("Peering with %s." % ', '.join(peer))
 
     with allow_interruption(
-        (loop, broker.close),
+        (loop, drain_then_close(loop, broker, drain_timeout)),
     ):
         try:
             loop.run_until_complete(broker.wait_closed())
@@ -182,8 +413,7 @@ def broker(debug, shared_secret, listen):
                 err=True,
             )
 
-    context.close()
-    loop.run_until_complete(context.wait_closed())
+    close_sockets(context, sockets + other_sockets, loop)
 
     click.echo("Broker stopped.")
 
@@ -203,22 +433,135 @@ def broker(debug, shared_secret, listen):
     help="A shared secret in base64 format that the authentication services "
     "use too.",
 )
-@click.option('-c', '--connect', default=DEFAULT_ENDPOINT)
+@click.option(
+    '-c',
+    '--connect',
+    default=[DEFAULT_ENDPOINT],
+    multiple=True,
+    help="The endpoint of the broker. Additional endpoints are those of "
+    "standby brokers to fail over to.",
+)
+@click.option(
+    '--pool',
+    is_flag=True,
+    default=False,
+    help="Connect to all the specified brokers at once, registering on each "
+    "of them and spreading requests over them.",
+)
+@click.option(
+    '-P',
+    '--processes',
+    default=1,
+    type=click.IntRange(min=1),
+    metavar='N',
+    help="The number of worker processes to run the services in. Each "
+    "worker registers the same domains and the broker spreads the requests "
+    "over them.",
+)
+@click.option(
+    '--drain-timeout',
+    default=DEFAULT_DRAIN_TIMEOUT,
+    type=float,
+    metavar='seconds',
+    help="When interrupted, the number of seconds to wait for the requests "
+    "in progress before stopping.",
+)
 @click.argument('names', nargs=-1, metavar='name...')
-def service(debug, shared_secret, connect, names):
+def service(
+    debug,
+    shared_secret,
+    connect,
+    pool,
+    processes,
+    drain_timeout,
+    names,
+):
+    from .shm import is_shm_endpoint
+
     setup_logging(debug=debug)
 
     shared_secret = check_shared_secret(shared_secret)
 
+    if not pool and len(connect) > 1 and any(
+        is_shm_endpoint(endpoint) for endpoint in connect
+    ):
+        raise click.BadParameter(
+            "Standby brokers can't be reached through shared memory.",
+            param_hint='connect',
+        )
+
+    args = (debug, shared_secret, connect, pool, drain_timeout, names)
+
+    if processes == 1:
+        run_service(*args)
+        return
+
+    from .supervisor import Supervisor
+
+    click.echo("Starting %d worker(s)." % processes)
+    Supervisor(
+        target=service_worker,
+        args=args,
+        processes=processes,
+        # Leave the workers the time to drain before terminating them.
+        drain_timeout=drain_timeout + 5.0,
+    ).run()
+    click.echo("All workers stopped.")
+
+
+def service_worker(debug, *args):
+    """
+    Run services in a worker process.
+    """
+    setup_logging(debug=debug)
+    run_service(debug, *args)
+
+
+def run_service(debug, shared_secret, connect, pool, drain_timeout, names):
+    """
+    Run services until interrupted.
+
+    :param debug: Whether to print tracebacks.
+    :param shared_secret: The shared secret, decoded.
+    :param connect: The endpoints to connect to.
+    :param pool: Whether to connect to all the endpoints at once.
+    :param drain_timeout: The number of seconds to wait for the requests in
+        progress when interrupted.
+    :param names: The names of the services to run.
+    """
+    import azmq
+
+    from azmq import Context
+
+    from .client import Client
+    from .client_pool import ClientPool
+
     loop = set_event_loop()
     context = Context(loop=loop)
-    socket = context.socket(azmq.DEALER)
-    socket.connect(connect)
 
-    client = Client(
-        socket=socket,
-        loop=loop,
-    )
+    if pool:
+        sockets = [
+            connect_socket(context, endpoint, loop)
+            for endpoint in connect
+        ]
+        client = ClientPool(
+            sockets=sockets,
+            loop=loop,
+        )
+    elif len(connect) > 1:
+        # The client moves from one endpoint to the next by itself.
+        sockets = [context.socket(azmq.DEALER)]
+        client = Client(
+            socket=sockets[0],
+            endpoints=connect,
+            loop=loop,
+        )
+    else:
+        sockets = [connect_socket(context, connect[0], loop)]
+        client = Client(
+            socket=sockets[0],
+            loop=loop,
+        )
 
     registered_services = []
 
@@ -259,11 +602,11 @@ def service(debug, shared_secret, connect, names):
     else:
         click.echo("Service(s) %s started and connected to %s." % (
             ', '.join(registered_services),
-            connect
+            ', '.join(connect),
         ))
 
     with allow_interruption(
-        (loop, client.close),
+        (loop, drain_then_close(loop, client, drain_timeout)),
     ):
         try:
             loop.run_until_complete(client.wait_closed())
@@ -276,8 +619,7 @@ def service(debug, shared_secret, connect, names):
                 err=True,
             )
 
-    context.close()
-    loop.run_until_complete(context.wait_closed())
+    close_sockets(context, sockets, loop)
 
     if registered_services:
         click.echo("Service stopped.")
@@ -303,6 +645,10 @@ def service(debug, shared_secret, connect, names):
 @click.option('-c', '--connect', default=[DEFAULT_ENDPOINT], multiple=True)
 @click.argument('names', nargs=-1, metavar='name...')
 def iservice(debug, shared_secret, connect, names):
+    from azmq import Context
+
+    from .client import Client
+
     setup_logging(debug=debug)
 
     shared_secret = check_shared_secret(shared_secret)
@@ -310,12 +656,13 @@ def iservice(debug, shared_secret, connect, names):
     loop = set_event_loop()
     context = Context(loop=loop)
 
+    sockets = []
     clients = []
     iservices = []
 
     for conn in connect:
-        socket = context.socket(azmq.DEALER)
-        socket.connect(conn)
+        socket = connect_socket(context, conn, loop)
+        sockets.append(socket)
 
         client = Client(
             socket=socket,
@@ -387,8 +734,7 @@ def iservice(debug, shared_secret, connect, names):
                 err=True,
             )
 
-    context.close()
-    loop.run_until_complete(context.wait_closed())
+    close_sockets(context, sockets, loop)
 
     if registered_services:
         click.echo("I-Service stopped.")
@@ -21,9 +21,34 @@ class CallError(PylarError):
         self.message = message
 
 
+class ConnectionLostError(CallError):
+    def __init__(self):
+        super().__init__(
+            code=503,
+            message="The connection was lost before a reply was received.",
+        )
+
+
 class InvalidReplyError(CallError):
     def __init__(self):
         super().__init__(
             code=0,
             message="The received reply is invalid.",
         )
+
+
+class CircuitOpenError(CallError):
+    def __init__(self, target):
+        super().__init__(
+            code=503,
+            message="The circuit breaker for %s is open." % target,
+        )
+        self.target = target
+
+
+class NotificationQueueFullError(CallError):
+    def __init__(self):
+        super().__init__(
+            code=507,
+            message="The notification queue is full.",
+        )
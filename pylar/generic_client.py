@@ -3,12 +3,22 @@ A generic client class.
 """
 
 import asyncio
+import heapq
 
 from binascii import hexlify
 from itertools import count
 from functools import partial
 
 from .async_object import AsyncObject
+from .common import (
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+    deserialize_header,
+    get_deadline,
+    get_priority,
+    get_timeout,
+    serialize_header,
+)
 from .errors import (
     CallError,
     InvalidReplyError,
@@ -20,12 +30,22 @@ logger = main_logger.getChild('generic_client')
 
 
 class GenericClient(AsyncObject):
-    def __init__(self, **kwargs):
+    def __init__(self, *, max_concurrent_requests=None, **kwargs):
+        """
+        :param max_concurrent_requests: The maximum number of incoming
+            requests to process concurrently. Requests in excess wait for a
+            slot, the most urgent first. `None` means no limit.
+        """
         super().__init__(**kwargs)
+        self.max_concurrent_requests = max_concurrent_requests
 
         # Private members.
         self.__request_id_generator = count()
         self.__pending_requests = {}
+        self.__processing_requests = {}
+        self.__active_requests = 0
+        self.__waiting_requests = []
+        self.__waiting_requests_counter = count()
 
         # Make sure we cancel all pending requests upon closure.
         self.add_cleanup(self.cancel_pending_requests)
@@ -41,6 +61,16 @@ class GenericClient(AsyncObject):
             if not future.done():
                 future.cancel()
 
+    def fail_pending_requests(self, exception):
+        """
+        Fail all pending requests.
+
+        :param exception: The exception to raise in the requesters.
+        """
+        for future in self.__pending_requests.values():
+            if not future.done():
+                future.set_exception(exception)
+
     # Protected methods.
 
     async def _read(self):
@@ -53,40 +83,54 @@ class GenericClient(AsyncObject):
         """
         raise NotImplementedError
 
-    async def _write(self, frames):
+    async def _write(self, frames, priority=PRIORITY_NORMAL):
         """
         Write frames.
 
         :param frames: The frames to write.
+        :param priority: The priority of the frames.
 
         Must be reimplemented by child classes.
         """
         raise NotImplementedError
 
-    async def _request(self, frames):
+    async def _request(
+        self,
+        frames,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        header=None,
+    ):
         """
         Send a request and wait for the result.
 
         :params frames: The frames to send.
+        :param priority: The request priority. Lower values are more urgent.
+        :param timeout: The number of seconds after which the request is
+            abandoned, or `None` to wait forever. The deadline is propagated
+            to the remote end which stops processing the request once it is
+            exceeded.
+        :param header: A dictionary of additional header fields.
         :returns: The request results.
-        """
-        request_id = self.__request_id()
 
-        await self.__send_request(request_id, frames)
+        If the request is cancelled or times out after it was sent, the remote
+        end is told to cancel it as well.
+        """
+        if timeout is None:
+            return await self.__request(frames, priority, None, header)
 
-        future = asyncio.Future(loop=self.loop)
-        future.add_done_callback(
-            partial(self.__remove_request, request_id=request_id),
+        return await asyncio.wait_for(
+            self.__request(frames, priority, timeout, header),
+            timeout,
+            loop=self.loop,
         )
-        self.__pending_requests[request_id] = future
-
-        return await future
 
-    async def _on_request(self, frames):
+    async def _on_request(self, frames, header):
         """
         Called whenever a request is received.
 
         :param frames: The request frames.
+        :param header: The request header, as a dictionary.
         :returns: A list of frames that constitute the reply.
 
         Must be reimplemented by child classes.
@@ -118,7 +162,7 @@ class GenericClient(AsyncObject):
     def __set_request_result(self, request_id, frames):
         future = self.__pending_requests.get(request_id)
 
-        if future:
+        if future and not future.cancelled():
             assert not future.done(), (
                 "Request %s's result was set already." % request_id
             )
@@ -127,12 +171,39 @@ class GenericClient(AsyncObject):
     def __set_request_exception(self, request_id, frames):
         future = self.__pending_requests.get(request_id)
 
-        if future:
+        if future and not future.cancelled():
             assert not future.done(), (
                 "Request %s's result was set already." % request_id
             )
             future.set_exception(frames)
 
+    async def __request(self, frames, priority, timeout, header=None):
+        request_id = self.__request_id()
+        header = dict(header or {})
+
+        if priority != PRIORITY_NORMAL:
+            header['priority'] = priority
+
+        if timeout is not None:
+            header['timeout'] = timeout
+
+        await self.__send_request(request_id, header, frames, priority)
+
+        future = asyncio.Future(loop=self.loop)
+        future.add_done_callback(
+            partial(self.__remove_request, request_id=request_id),
+        )
+        self.__pending_requests[request_id] = future
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Nobody will read the result: let the remote end know.
+            if not self.closing:
+                self.add_task(self.__send_cancel(request_id))
+
+            raise
+
     def __request_id(self):
         return ('%s' % next(self.__request_id_generator)).encode('utf-8')
 
@@ -151,20 +222,127 @@ class GenericClient(AsyncObject):
                 continue
 
             if type_ == b'request':
-                self.add_task(self.__process_request(request_id, frames))
+                try:
+                    header = deserialize_header(frames.pop(0))
+                except IndexError:
+                    continue
+
+                # Relative timeouts are turned into local deadlines as soon as
+                # possible. Deadlines sent by the remote end are meaningless
+                # here and get overwritten.
+                try:
+                    header['deadline'] = get_deadline(header, self.loop)
+                except CallError as ex:
+                    self.add_task(
+                        self.__send_error_response(
+                            request_id,
+                            ex.code,
+                            ex.message,
+                            get_priority(header),
+                        ),
+                    )
+                    continue
+
+                self.add_task(
+                    self.__process_request(request_id, frames, header),
+                )
+            elif type_ == b'cancel':
+                self.__cancel_request(request_id)
             elif type_ == b'response':
                 self.add_task(self.__process_response(request_id, frames))
             elif type_ == b'notification':
                 self.add_task(self.__process_notification(request_id, frames))
 
-    async def __process_request(self, request_id, frames):
+    async def __acquire_request_slot(self, priority):
+        if self.max_concurrent_requests is None:
+            return
+
+        if self.__active_requests < self.max_concurrent_requests and \
+                not self.__waiting_requests:
+            self.__active_requests += 1
+            return
+
+        future = asyncio.Future(loop=self.loop)
+        heapq.heappush(
+            self.__waiting_requests,
+            (priority, next(self.__waiting_requests_counter), future),
+        )
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # We may have been handed a slot right before being cancelled.
+            if future.done() and not future.cancelled():
+                self.__release_request_slot()
+
+            raise
+
+    def __release_request_slot(self):
+        if self.max_concurrent_requests is None:
+            return
+
+        # The slot is handed over directly to the most urgent waiting
+        # request.
+        while self.__waiting_requests:
+            _, _, future = heapq.heappop(self.__waiting_requests)
+
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.__active_requests -= 1
+
+    def __cancel_request(self, request_id):
+        task = self.__processing_requests.pop(request_id, None)
+
+        if task:
+            logger.debug(
+                "Request %s was cancelled by the remote end.",
+                hexlify(request_id),
+            )
+            task.cancel()
+
+    async def __handle_request(self, frames, header, priority):
+        await self.__acquire_request_slot(priority)
+
+        try:
+            # Don't waste time on requests that expired while queued.
+            if get_timeout(header, self.loop) == 0:
+                raise asyncio.TimeoutError
+
+            return await self._on_request(frames, header)
+        finally:
+            self.__release_request_slot()
+
+    async def __process_request(self, request_id, frames, header):
+        priority = get_priority(header)
+        task = asyncio.ensure_future(
+            self.__handle_request(frames, header, priority),
+            loop=self.loop,
+        )
+        self.__processing_requests[request_id] = task
+
         try:
-            response = await self._on_request(frames)
+            response = await asyncio.wait_for(
+                task,
+                get_timeout(header, self.loop),
+                loop=self.loop,
+            )
         except asyncio.CancelledError:
+            # Requests cancelled by the remote end expect no reply.
+            if request_id in self.__processing_requests:
+                await self.__send_error_response(
+                    request_id,
+                    408,
+                    "Request was cancelled.",
+                    priority,
+                )
+        except asyncio.TimeoutError:
             await self.__send_error_response(
                 request_id,
-                408,
-                "Request was cancelled.",
+                504,
+                "Request deadline exceeded.",
+                priority,
             )
         except RequestAborted:
             # The request was aborted: we exit without sending a reply.
@@ -174,6 +352,7 @@ class GenericClient(AsyncObject):
                 request_id,
                 ex.code,
                 ex.message,
+                priority,
             )
         except Exception as ex:
             logger.exception(
@@ -184,9 +363,12 @@ class GenericClient(AsyncObject):
                 request_id,
                 500,
                 "Internal error.",
+                priority,
             )
         else:
-            await self.__send_response(request_id, response or [])
+            await self.__send_response(request_id, response or [], priority)
+        finally:
+            self.__processing_requests.pop(request_id, None)
 
     async def __process_response(self, request_id, frames):
         try:
@@ -219,15 +401,24 @@ class GenericClient(AsyncObject):
     async def __process_notification(self, request_id, frames):
         await self._on_notification(frames)
 
-    async def __send_error_response(self, request_id, code, message):
-        await self._write([
-            b'response',
-            request_id,
-            ('%d' % code).encode('utf-8'),
-            message.encode('utf-8'),
-        ])
+    async def __send_error_response(
+        self,
+        request_id,
+        code,
+        message,
+        priority,
+    ):
+        await self._write(
+            [
+                b'response',
+                request_id,
+                ('%d' % code).encode('utf-8'),
+                message.encode('utf-8'),
+            ],
+            priority,
+        )
 
-    async def __send_response(self, request_id, args):
+    async def __send_response(self, request_id, args, priority):
         frames = [
             b'response',
             request_id,
@@ -235,16 +426,20 @@ class GenericClient(AsyncObject):
         ]
         frames.extend(args)
 
-        await self._write(frames)
+        await self._write(frames, priority)
 
-    async def __send_request(self, request_id, args):
+    async def __send_request(self, request_id, header, args, priority):
         frames = [
             b'request',
             request_id,
+            serialize_header(header),
         ]
         frames.extend(args)
 
-        await self._write(frames)
+        await self._write(frames, priority)
+
+    async def __send_cancel(self, request_id):
+        await self._write([b'cancel', request_id], PRIORITY_CONTROL)
 
     async def __send_notification(self, request_id, args):
         frames = [
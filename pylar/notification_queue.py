@@ -0,0 +1,490 @@
+"""
+Durable notification queues.
+
+Notifications for domains that are momentarily unavailable are appended to
+per-domain queues on disk, then replayed when the domains register again.
+
+Each domain queue lives in its own directory and is made of append-only
+segment files, plus a small memory-mapped acknowledgement index that holds
+the sequence number of the next notification to deliver. Acknowledging
+notifications only touches the memory map: segments are deleted once all
+their notifications are acknowledged, or when the queue exceeds its size
+limit.
+
+Only domains that registered at least once get a queue: their directory is
+created upon registration.
+"""
+
+import mmap
+import os
+import struct
+
+from binascii import (
+    Error as BinasciiError,
+    hexlify,
+    unhexlify,
+)
+
+from .common import (
+    pack_frames,
+    unpack_frames,
+)
+from .errors import NotificationQueueFullError
+from .log import logger as main_logger
+
+logger = main_logger.getChild('notification_queue')
+
+RECORD = struct.Struct('!QI')
+ACK = struct.Struct('!Q')
+
+SEGMENT_SUFFIX = '.seg'
+ACK_FILENAME = 'ack'
+
+
+class DomainQueue(object):
+    """
+    A durable queue of notifications for one domain.
+    """
+    def __init__(self, path, segment_size, max_size):
+        """
+        :param path: The directory of the queue. Created if needed.
+        :param segment_size: The size after which a new segment is started.
+        :param max_size: The size above which the oldest segments are
+            dropped, even if they were not acknowledged.
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+
+        os.makedirs(path, exist_ok=True)
+
+        self.__ack_file = open(self.__get_ack_path(), 'a+b')
+
+        if os.fstat(self.__ack_file.fileno()).st_size < ACK.size:
+            self.__ack_file.truncate(ACK.size)
+
+        self.__ack_map = mmap.mmap(self.__ack_file.fileno(), ACK.size)
+
+        # The first sequence numbers and sizes of the segments, oldest first.
+        self.__segments = []
+        self.__next_seq = self.acked_seq
+        self.__writer = None
+        self.__load_segments()
+
+        # Where the next read starts: a segment, an offset in it and the
+        # sequence number of the record found there. Only valid while that
+        # sequence number is the acknowledged one.
+        self.__cursor = None
+
+    @property
+    def acked_seq(self):
+        """
+        The sequence number of the next notification to deliver.
+        """
+        return ACK.unpack_from(self.__ack_map)[0]
+
+    @property
+    def size(self):
+        """
+        The total size of the segments, in bytes.
+        """
+        return sum(size for _, size in self.__segments)
+
+    @property
+    def empty(self):
+        return self.acked_seq >= self.__next_seq
+
+    def append(self, frames):
+        """
+        Append a notification.
+
+        :param frames: The notification frames.
+        :returns: The sequence number of the notification.
+        """
+        data = pack_frames(frames)
+
+        if self.__writer is None or \
+                self.__segments[-1][1] >= self.segment_size:
+            self.__start_segment()
+
+        seq = self.__next_seq
+        self.__writer.write(RECORD.pack(seq, len(data)))
+        self.__writer.write(data)
+        self.__writer.flush()
+        self.__next_seq += 1
+
+        first_seq, size = self.__segments[-1]
+        self.__segments[-1] = (first_seq, size + RECORD.size + len(data))
+        self.__enforce_max_size()
+
+        return seq
+
+    def read(self, limit):
+        """
+        Read unacknowledged notifications.
+
+        :param limit: The maximum number of notifications to read.
+        :returns: A list of `(seq, frames)` tuples, oldest first.
+
+        Reads resume where the previous one stopped as long as everything it
+        returned was acknowledged.
+        """
+        acked_seq = self.acked_seq
+        segments = [first_seq for first_seq, _ in self.__segments]
+        result = []
+
+        if self.__cursor is not None and self.__cursor[2] == acked_seq and \
+                self.__cursor[0] in segments:
+            index = segments.index(self.__cursor[0])
+            offset = self.__cursor[1]
+        else:
+            index = max(
+                sum(1 for first_seq in segments if first_seq <= acked_seq) -
+                1,
+                0,
+            )
+            offset = 0
+
+        for first_seq in segments[index:]:
+            try:
+                for seq, data, offset in self.__read_segment(
+                    first_seq,
+                    offset,
+                ):
+                    if seq < acked_seq:
+                        continue
+
+                    result.append((seq, unpack_frames(data)))
+                    self.__cursor = (first_seq, offset, seq + 1)
+
+                    if len(result) >= limit:
+                        return result
+            except FileNotFoundError:
+                # The segment was dropped to enforce the size limit.
+                pass
+
+            offset = 0
+
+        return result
+
+    def ack(self, seq):
+        """
+        Acknowledge all the notifications up to a sequence number.
+
+        :param seq: The sequence number of the last delivered notification.
+        """
+        if seq + 1 > self.acked_seq:
+            ACK.pack_into(self.__ack_map, 0, seq + 1)
+
+        # Drop the segments that were entirely delivered. The one being
+        # written to is only dropped once everything was delivered, so that
+        # delivered notifications don't count towards the size limits.
+        if self.empty:
+            if self.__writer is not None:
+                self.__writer.close()
+                self.__writer = None
+
+            while self.__segments:
+                self.__drop_oldest_segment()
+        else:
+            while len(self.__segments) > 1 and \
+                    self.__segments[1][0] <= self.acked_seq:
+                self.__drop_oldest_segment()
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+        self.__ack_map.close()
+        self.__ack_file.close()
+
+    # Private methods.
+
+    def __get_ack_path(self):
+        return os.path.join(self.path, ACK_FILENAME)
+
+    def __get_segment_path(self, first_seq):
+        return os.path.join(self.path, '%020d%s' % (first_seq, SEGMENT_SUFFIX))
+
+    def __load_segments(self):
+        segments = sorted(
+            int(filename[:-len(SEGMENT_SUFFIX)])
+            for filename in os.listdir(self.path)
+            if filename.endswith(SEGMENT_SUFFIX)
+        )
+
+        for first_seq in segments:
+            size = os.path.getsize(self.__get_segment_path(first_seq))
+            self.__segments.append((first_seq, size))
+
+        if not segments:
+            return
+
+        # Only the last segment may have been interrupted in the middle of a
+        # write.
+        last_seq = None
+        offset = 0
+
+        for last_seq, _, offset in self.__read_segment(segments[-1]):
+            pass
+
+        if offset != self.__segments[-1][1]:
+            logger.warning(
+                "Truncating incomplete notification in %s.",
+                self.path,
+            )
+
+            with open(self.__get_segment_path(segments[-1]), 'r+b') as file:
+                file.truncate(offset)
+
+            self.__segments[-1] = (segments[-1], offset)
+
+        if last_seq is None:
+            self.__next_seq = max(self.__next_seq, segments[-1])
+        else:
+            self.__next_seq = max(self.__next_seq, last_seq + 1)
+
+    def __read_segment(self, first_seq, offset=0):
+        with open(self.__get_segment_path(first_seq), 'rb') as file:
+            file.seek(offset)
+
+            while True:
+                header = file.read(RECORD.size)
+
+                if len(header) < RECORD.size:
+                    return
+
+                seq, size = RECORD.unpack(header)
+                data = file.read(size)
+
+                if len(data) < size:
+                    return
+
+                offset += RECORD.size + size
+                yield seq, data, offset
+
+    def __start_segment(self):
+        if self.__writer is not None:
+            self.__writer.close()
+
+        if not self.__segments or self.__segments[-1][1]:
+            self.__segments.append((self.__next_seq, 0))
+
+        self.__writer = open(
+            self.__get_segment_path(self.__segments[-1][0]),
+            'ab',
+        )
+
+    def __drop_oldest_segment(self):
+        first_seq, _ = self.__segments.pop(0)
+        os.unlink(self.__get_segment_path(first_seq))
+
+    def __enforce_max_size(self):
+        while len(self.__segments) > 1 and self.size > self.max_size:
+            next_first_seq = self.__segments[1][0]
+            lost = max(0, next_first_seq - self.acked_seq)
+
+            if lost:
+                logger.warning(
+                    "Notification queue %s is full: dropping %d "
+                    "notification(s).",
+                    self.path,
+                    lost,
+                )
+                ACK.pack_into(self.__ack_map, 0, next_first_seq)
+
+            self.__drop_oldest_segment()
+
+
+class NotificationQueue(object):
+    """
+    A set of durable notification queues, one per domain.
+
+    Queues do blocking IO and are not thread-safe: all their methods must be
+    called from the same thread.
+    """
+    def __init__(
+        self,
+        directory,
+        segment_size=4 * 1024 * 1024,
+        max_size=64 * 1024 * 1024,
+        max_queues=1024,
+        max_total_size=1024 * 1024 * 1024,
+    ):
+        """
+        :param directory: The directory in which the queues are stored.
+        :param segment_size: The size of each segment file.
+        :param max_size: The maximum size of a domain queue. Once reached, the
+            oldest notifications are dropped.
+        :param max_queues: The maximum number of queues open at once.
+        :param max_total_size: The maximum size of all the queues together.
+            Past it, notifications are refused.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_queues = max_queues
+        self.max_total_size = max_total_size
+        self.__queues = {}
+        self.__sizes = {}
+        self.__total_size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.__load_domains()
+
+    @property
+    def size(self):
+        """
+        The total size of the queues, in bytes.
+        """
+        return self.__total_size
+
+    def add_domain(self, domain):
+        """
+        Allow notifications to be queued for a domain.
+
+        :param domain: The domain.
+        """
+        if domain not in self.__sizes:
+            os.makedirs(self.__get_path(domain), exist_ok=True)
+            self.__sizes[domain] = 0
+
+    def is_known(self, domain):
+        """
+        Check whether notifications can be queued for a domain.
+
+        :param domain: The domain.
+        :returns: `True` if the domain was added, now or in a previous run.
+        """
+        return domain in self.__sizes
+
+    def get(self, domain):
+        """
+        Get the queue for a domain, opening it if needed.
+
+        :param domain: The domain, which must be known.
+        :returns: The domain queue.
+        """
+        queue = self.__queues.get(domain)
+
+        if queue is None:
+            queue = self.__queues[domain] = DomainQueue(
+                path=self.__get_path(domain),
+                segment_size=self.segment_size,
+                max_size=self.max_size,
+            )
+
+        return queue
+
+    def append(self, domain, frames):
+        """
+        Append a notification to the queue of a domain.
+
+        :param domain: The domain, which must be known.
+        :param frames: The notification frames.
+        :returns: The sequence number of the notification.
+        :raises NotificationQueueFullError: If too many queues are open or
+            if they are too large already.
+        """
+        if domain not in self.__queues and \
+                len(self.__queues) >= self.max_queues:
+            raise NotificationQueueFullError()
+
+        if self.__total_size >= self.max_total_size:
+            raise NotificationQueueFullError()
+
+        queue = self.get(domain)
+        seq = queue.append(frames)
+        self.__update_size(domain, queue)
+
+        return seq
+
+    def ack(self, domain, seq):
+        """
+        Acknowledge the notifications of a domain up to a sequence number.
+
+        :param domain: The domain.
+        :param seq: The sequence number of the last delivered notification.
+        """
+        queue = self.get(domain)
+        queue.ack(seq)
+        self.__update_size(domain, queue)
+
+    def read(self, domain, limit):
+        """
+        Read the unacknowledged notifications of a domain.
+
+        :param domain: The domain.
+        :param limit: The maximum number of notifications to read.
+        :returns: A list of `(seq, frames)` tuples, oldest first.
+        """
+        if not self.has_pending(domain):
+            return []
+
+        return self.get(domain).read(limit)
+
+    def has_pending(self, domain):
+        """
+        Check whether there are notifications waiting for a domain.
+
+        :param domain: The domain.
+        :returns: `True` if some notifications were not acknowledged yet.
+        """
+        if domain not in self.__queues and not self.__sizes.get(domain):
+            return False
+
+        if self.get(domain).empty:
+            self.release(domain)
+            return False
+
+        return True
+
+    def release(self, domain):
+        """
+        Close the queue of a domain if it has nothing left to deliver, so
+        that it doesn't keep files open.
+
+        :param domain: The domain.
+        """
+        queue = self.__queues.get(domain)
+
+        if queue is not None and queue.empty:
+            queue.close()
+            del self.__queues[domain]
+
+    def close(self):
+        for queue in self.__queues.values():
+            queue.close()
+
+        self.__queues.clear()
+
+    # Private methods.
+
+    def __get_path(self, domain):
+        return os.path.join(self.directory, hexlify(domain).decode('ascii'))
+
+    def __load_domains(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            if not os.path.isdir(path):
+                continue
+
+            try:
+                domain = unhexlify(name)
+            except (BinasciiError, ValueError):
+                continue
+
+            size = sum(
+                os.path.getsize(os.path.join(path, filename))
+                for filename in os.listdir(path)
+                if filename.endswith(SEGMENT_SUFFIX)
+            )
+            self.__sizes[domain] = size
+            self.__total_size += size
+
+    def __update_size(self, domain, queue):
+        size = queue.size
+        self.__total_size += size - self.__sizes.get(domain, 0)
+        self.__sizes[domain] = size
@@ -0,0 +1,277 @@
+"""
+A broker peer class.
+"""
+
+import asyncio
+
+from pyslot import Signal
+
+from .common import (
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+)
+from .errors import CallError
+from .generic_client import GenericClient
+from .log import logger as main_logger
+from .security import generate_credentials
+
+logger = main_logger.getChild('peer')
+
+
+class Peer(GenericClient):
+    """
+    A direct link to a remote broker.
+
+    Requests and notifications for domains hosted by the remote broker are
+    forwarded natively, without going through a link service.
+    """
+    PEER_IDENTIFIER = b'peer'
+
+    def __init__(self, *, socket, shared_secret, **kwargs):
+        super().__init__(**kwargs)
+        self.socket = socket
+        self.shared_secret = shared_secret
+
+        # Like services, we send the same credentials every time so that the
+        # remote broker only has to verify them once.
+        self.__credentials = generate_credentials(
+            shared_secret,
+            self.PEER_IDENTIFIER,
+        )
+
+        self.domains = set()
+
+        # Exposed signals.
+        self.on_domain_available = Signal()
+        self.on_domain_unavailable = Signal()
+        self.on_revoked = Signal()
+
+        self.__ping_timeout = 5.0
+        self.__ping_interval = 5.0
+        self.__remote_uid = None
+        self.add_cleanup(self.__clear_domains)
+        self.add_task(self.__peering_loop())
+
+    @property
+    def peered(self):
+        return self.__remote_uid is not None
+
+    async def forward(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        args,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+    ):
+        """
+        Forward a request to the remote broker.
+
+        :param domain: The domain for which the request is destined.
+        :param source_domain: The source domain in behalf of which the request
+            is made.
+        :param source_token: The token for the source domain.
+        :param args: A list of frames to pass.
+        :param priority: The request priority.
+        :param timeout: The request timeout, in seconds.
+        :returns: The request result.
+        """
+        frames = [
+            b'forward',
+            domain,
+            source_domain,
+            source_token or b'',
+        ]
+        frames.extend(args)
+
+        return await self._request(frames, priority, timeout)
+
+    async def forward_notification(
+        self,
+        domain,
+        source_domain,
+        source_token,
+        type_,
+        args,
+    ):
+        """
+        Forward a notification to the remote broker.
+
+        :param domain: The domain for which the notification is destined.
+        :param source_domain: The source domain in behalf of which the
+            notification is sent.
+        :param source_token: The token for the source domain.
+        :param type_: The notification type.
+        :param args: A list of frames to pass.
+        """
+        frames = [
+            b'forward_notification',
+            domain,
+            source_domain,
+            source_token or b'',
+            type_,
+        ]
+        frames.extend(args)
+
+        await self._request(frames)
+
+    # Protected methods.
+
+    async def _read(self):
+        """
+        Read frames.
+
+        :returns: The read frames.
+        """
+        frames = await self.socket.recv_multipart()
+        frames.pop(0)  # Empty frame.
+
+        return frames
+
+    async def _write(self, frames, priority=PRIORITY_NORMAL):
+        """
+        Write frames.
+
+        :param frames: The frames to write.
+        :param priority: The priority of the frames.
+        """
+        frames.insert(0, b'')
+        await self.socket.send_multipart(frames)
+
+    async def _on_request(self, frames, header):
+        """
+        Called whenever a request is received.
+
+        Remote brokers never send requests over a peering link.
+
+        :param frames: The request frames.
+        :param header: The request header.
+        """
+        raise CallError(code=400, message="Bad request.")
+
+    async def _on_notification(self, frames):
+        """
+        Called whenever a notification is received.
+
+        :param frames: The notification frames.
+        """
+        type_ = frames.pop(0)
+
+        if type_ == b'domain_available':
+            for domain in frames:
+                self.__add_domain(domain)
+        elif type_ == b'domain_unavailable':
+            for domain in frames:
+                self.__remove_domain(domain)
+        elif type_ == b'revoked':
+            for domain in frames:
+                self.on_revoked.emit(self, domain)
+        else:
+            logger.warning(
+                "Ignoring unknown notification '%s' from peer.",
+                type_.decode('utf-8', 'replace'),
+            )
+
+    async def _peer(self):
+        """
+        Establish the peering with the remote broker.
+
+        :returns: The remote unique identifier and the list of domains hosted
+            by the remote broker.
+        """
+        frames = await self._request(
+            [b'peer', self.__credentials],
+            PRIORITY_CONTROL,
+        )
+        remote_uid = frames.pop(0)
+
+        return remote_uid, frames
+
+    async def _ping(self):
+        """
+        Ping the remote broker.
+        """
+        remote_uid, = await self._request([b'ping'], PRIORITY_CONTROL)
+
+        return remote_uid
+
+    # Private methods.
+
+    def __add_domain(self, domain):
+        if domain not in self.domains:
+            self.domains.add(domain)
+            self.on_domain_available.emit(self, domain)
+
+    def __remove_domain(self, domain):
+        if domain in self.domains:
+            self.domains.remove(domain)
+            self.on_domain_unavailable.emit(self, domain)
+
+    def __clear_domains(self):
+        for domain in list(self.domains):
+            self.__remove_domain(domain)
+
+    async def __reset(self):
+        self.__remote_uid = None
+        self.__clear_domains()
+
+        await self.socket.reset_all()
+
+    async def __peering_loop(self):
+        while not self.closing:
+            try:
+                if self.__remote_uid is None:
+                    remote_uid, domains = await asyncio.wait_for(
+                        self._peer(),
+                        self.__ping_timeout,
+                        loop=self.loop,
+                    )
+                    self.__remote_uid = remote_uid
+
+                    for domain in domains:
+                        self.__add_domain(domain)
+
+                    logger.info(
+                        "Peering established (%d remote domain(s)).",
+                        len(domains),
+                    )
+                else:
+                    remote_uid = await asyncio.wait_for(
+                        self._ping(),
+                        self.__ping_timeout,
+                        loop=self.loop,
+                    )
+
+                    if remote_uid != self.__remote_uid:
+                        logger.warning(
+                            "Peer unique identifier changed ! Peering again.",
+                        )
+                        await self.__reset()
+
+                        # Let's not sleep when we know the connection is alive.
+                        continue
+
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                if self.__remote_uid is not None:
+                    logger.warning(
+                        "Peer did not reply in %s second(s). Dropping its "
+                        "domains.",
+                        self.__ping_timeout,
+                    )
+
+                await self.__reset()
+            except Exception as ex:
+                if self.__remote_uid is not None:
+                    logger.error(
+                        "Peer ping failed (%s). Dropping its domains.",
+                        ex,
+                    )
+                else:
+                    logger.debug("Peering failed (%s).", ex)
+
+                await self.__reset()
+
+            await asyncio.sleep(self.__ping_interval, loop=self.loop)
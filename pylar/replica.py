@@ -0,0 +1,215 @@
+"""
+A standby broker replica class.
+"""
+
+import asyncio
+
+from pyslot import Signal
+
+from .common import (
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+)
+from .errors import CallError
+from .generic_client import GenericClient
+from .log import logger as main_logger
+from .security import generate_credentials
+
+logger = main_logger.getChild('replica')
+
+
+class Replica(GenericClient):
+    """
+    A replication link to a primary broker.
+
+    The primary sends its whole registry upon connection, then streams the
+    changes. If the primary misses several pings in a row, `on_primary_lost`
+    is emitted so that the standby broker can take over.
+    """
+    REPLICA_IDENTIFIER = b'replica'
+
+    def __init__(
+        self,
+        *,
+        socket,
+        shared_secret,
+        ping_interval=1.0,
+        ping_timeout=3.0,
+        max_missed_pings=3,
+        **kwargs
+    ):
+        """
+        :param socket: The socket connected to the primary broker.
+        :param shared_secret: The shared secret.
+        :param ping_interval: The number of seconds between two pings.
+        :param ping_timeout: The number of seconds after which a ping is
+            considered missed.
+        :param max_missed_pings: The number of consecutive pings the primary
+            must miss to be considered lost. Replication goes on until then.
+        """
+        super().__init__(**kwargs)
+        self.socket = socket
+        self.shared_secret = shared_secret
+
+        # Like services, we send the same credentials every time so that the
+        # remote broker only has to verify them once.
+        self.__credentials = generate_credentials(
+            shared_secret,
+            self.REPLICA_IDENTIFIER,
+        )
+
+        # The packed session records, indexed by session.
+        self.sessions = {}
+
+        # Exposed signals.
+        self.on_primary_lost = Signal()
+
+        self.__ping_interval = ping_interval
+        self.__ping_timeout = ping_timeout
+        self.__max_missed_pings = max_missed_pings
+        self.__missed_pings = 0
+        self.__remote_uid = None
+        self.add_task(self.__replication_loop())
+
+    @property
+    def synchronized(self):
+        return self.__remote_uid is not None
+
+    # Protected methods.
+
+    async def _read(self):
+        """
+        Read frames.
+
+        :returns: The read frames.
+        """
+        frames = await self.socket.recv_multipart()
+        frames.pop(0)  # Empty frame.
+
+        return frames
+
+    async def _write(self, frames, priority=PRIORITY_NORMAL):
+        """
+        Write frames.
+
+        :param frames: The frames to write.
+        :param priority: The priority of the frames.
+        """
+        frames.insert(0, b'')
+        await self.socket.send_multipart(frames)
+
+    async def _on_request(self, frames, header):
+        """
+        Called whenever a request is received.
+
+        Primary brokers never send requests over a replication link.
+
+        :param frames: The request frames.
+        :param header: The request header.
+        """
+        raise CallError(code=400, message="Bad request.")
+
+    async def _on_notification(self, frames):
+        """
+        Called whenever a notification is received.
+
+        :param frames: The notification frames.
+        """
+        type_ = frames.pop(0)
+
+        if type_ == b'session_update':
+            for session, record in zip(frames[::2], frames[1::2]):
+                self.sessions[session] = record
+        elif type_ == b'session_removed':
+            for session in frames:
+                self.sessions.pop(session, None)
+        else:
+            logger.warning(
+                "Ignoring unknown notification '%s' from primary.",
+                type_.decode('utf-8', 'replace'),
+            )
+
+    async def _replicate(self):
+        """
+        Start replicating the primary broker.
+
+        :returns: The remote unique identifier and a flat list of sessions
+            and session records.
+        """
+        frames = await self._request(
+            [b'replicate', self.__credentials],
+            PRIORITY_CONTROL,
+        )
+        remote_uid = frames.pop(0)
+
+        return remote_uid, frames
+
+    async def _ping(self):
+        """
+        Ping the primary broker.
+        """
+        remote_uid, = await self._request([b'ping'], PRIORITY_CONTROL)
+
+        return remote_uid
+
+    # Private methods.
+
+    async def __replication_loop(self):
+        while not self.closing:
+            try:
+                if self.__remote_uid is None:
+                    remote_uid, frames = await asyncio.wait_for(
+                        self._replicate(),
+                        self.__ping_timeout,
+                        loop=self.loop,
+                    )
+                    self.__remote_uid = remote_uid
+                    self.sessions = dict(zip(frames[::2], frames[1::2]))
+
+                    logger.info(
+                        "Replicating primary broker (%d session(s)).",
+                        len(self.sessions),
+                    )
+                else:
+                    remote_uid = await asyncio.wait_for(
+                        self._ping(),
+                        self.__ping_timeout,
+                        loop=self.loop,
+                    )
+                    self.__missed_pings = 0
+
+                    if remote_uid != self.__remote_uid:
+                        logger.warning(
+                            "Primary broker restarted. Replicating again.",
+                        )
+                        self.__remote_uid = None
+                        await self.socket.reset_all()
+
+                        continue
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if self.__remote_uid is not None:
+                    self.__missed_pings += 1
+
+                    # A short network outage must not cause a failover.
+                    if self.__missed_pings < self.__max_missed_pings:
+                        logger.warning(
+                            "Primary broker missed a ping (%s): %d/%d.",
+                            str(ex) or ex.__class__.__name__,
+                            self.__missed_pings,
+                            self.__max_missed_pings,
+                        )
+                    else:
+                        logger.error(
+                            "Primary broker is unreachable (%s).",
+                            str(ex) or ex.__class__.__name__,
+                        )
+                        self.on_primary_lost.emit(self)
+                        return
+                else:
+                    logger.debug("Replication failed (%s).", ex)
+                    await self.socket.reset_all()
+
+            await asyncio.sleep(self.__ping_interval, loop=self.loop)
@@ -2,11 +2,23 @@
 A RPC client proxy class.
 """
 
+import asyncio
+import random
+
+from collections import deque
+from copy import deepcopy
+from functools import partial
+
 from .client_proxy import ClientProxy
 from .common import (
+    PRIORITY_NORMAL,
     deserialize,
     serialize,
 )
+from .errors import (
+    CallError,
+    CircuitOpenError,
+)
 from .log import logger as main_logger
 from .rpc import deserialize_function
 
@@ -14,6 +26,44 @@ logger = main_logger.getChild('rpc_client_proxy')
 
 
 class RPCClientProxy(ClientProxy):
+    # Calls to RPC services hosted by the same client pass arguments and
+    # results by reference. Set this to `True` to get copies instead.
+    copy_local_calls = False
+
+    # Identical concurrent remote calls (same target, method and arguments)
+    # can share a single request. Only enable this for side-effect free
+    # methods.
+    coalesce_method_calls = False
+
+    # Calls to idempotent methods that fail with one of these error codes are
+    # retried, up to `max_retries` times, with a jittered exponential delay
+    # starting at `retry_delay` seconds.
+    retriable_error_codes = frozenset([503])
+    max_retries = 2
+    retry_delay = 0.05
+
+    # Retries and hedged requests are taken from a budget that each call to
+    # an idempotent method refills by `retry_budget_ratio`, so that they
+    # can't add more than that much load when a service is failing.
+    retry_budget_ratio = 0.1
+    retry_budget_size = 10.0
+
+    # Set this to `True` to send a second copy of slow calls to idempotent
+    # methods, once they take longer than `hedge_percentile` of the recent
+    # calls. The broker routes it to another instance of the service when
+    # there is one, and the first result wins.
+    hedge_method_calls = False
+    hedge_percentile = 0.95
+    hedge_min_samples = 20
+    hedge_window_size = 100
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.__inflight_method_calls = {}
+        self.__idempotent_methods = {}
+        self.__retry_budget = self.retry_budget_size
+        self.__latencies = {}
+
     async def describe(self, target_domain):
         """
         Ask a remote service to describe its available methods.
@@ -24,8 +74,16 @@ class RPCClientProxy(ClientProxy):
             target_domain=target_domain,
             command='describe',
         )
+        description = deserialize(result[0])
 
-        return deserialize(result[0])
+        # Remember which methods can be retried.
+        self.__idempotent_methods[target_domain] = {
+            method_name
+            for method_name, method_desc in description['methods'].items()
+            if method_desc.get('idempotent')
+        }
+
+        return description
 
     async def method_call(
         self,
@@ -33,6 +91,9 @@ class RPCClientProxy(ClientProxy):
         method,
         args=None,
         kwargs=None,
+        priority=PRIORITY_NORMAL,
+        timeout=None,
+        idempotent=None,
     ):
         """
         Remote call to a specified domain.
@@ -42,20 +103,294 @@ class RPCClientProxy(ClientProxy):
         :param method: The method to call.
         :param args: A list of arguments to pass.
         :param kwargs: A list of named arguments to pass.
+        :param priority: The call priority. Lower values are more urgent.
+        :param timeout: The call timeout, in seconds, retries included.
+        :param idempotent: Whether the method is idempotent, in which case
+            failed calls are retried and slow ones may be hedged. If `None`,
+            the last description of the target domain tells.
         :returns: The method call results.
         """
-        result = await self.request(
+        args = list(args or [])
+        kwargs = dict(kwargs or {})
+        client_proxy = self.client.get_client_proxy(target_domain)
+        local_method_call = getattr(client_proxy, 'local_method_call', None)
+
+        # If the target service lives in the same client, we can skip the
+        # serialization entirely and call it directly. A draining service
+        # takes no new calls: the broker sends those to another instance.
+        if local_method_call is not None:
+            await self.wait_registered()
+
+        if local_method_call is not None and not client_proxy.draining:
+            if self.copy_local_calls:
+                args = deepcopy(args)
+                kwargs = deepcopy(kwargs)
+
+            with client_proxy.local_work():
+                result = await asyncio.wait_for(
+                    local_method_call(
+                        context=self.context,
+                        method_name=method,
+                        args=args,
+                        kwargs=kwargs,
+                    ),
+                    timeout,
+                    loop=self.loop,
+                )
+
+            if self.copy_local_calls:
+                result = deepcopy(result)
+
+            return result
+
+        frames = [
+            method.encode('utf-8'),
+            serialize(args),
+            serialize(kwargs),
+        ]
+
+        request = partial(
+            self.request,
             target_domain=target_domain,
             command='method_call',
-            args=[
-                method.encode('utf-8'),
-                serialize(list(args) or []),
-                serialize(dict(kwargs or {})),
-            ],
+            args=frames,
+            priority=priority,
         )
 
+        if self.coalesce_method_calls:
+            send = partial(
+                self.__coalesced_request,
+                target_domain=target_domain,
+                frames=frames,
+                priority=priority,
+            )
+        else:
+            send = request
+
+        if idempotent is None:
+            idempotent = method in self.__idempotent_methods.get(
+                target_domain,
+                (),
+            )
+
+        if idempotent:
+            result = await self.__idempotent_request(
+                send=send,
+                request=request,
+                key=(target_domain, method),
+                timeout=timeout,
+            )
+        else:
+            result = await send(timeout=timeout)
+
         return deserialize(result[0])
 
+    async def __idempotent_request(self, send, request, key, timeout):
+        self.__retry_budget = min(
+            self.__retry_budget + self.retry_budget_ratio,
+            self.retry_budget_size,
+        )
+
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = self.loop.time() + timeout
+
+        retries = 0
+
+        while True:
+            try:
+                return await self.__hedged_request(
+                    send=send,
+                    request=request,
+                    key=key,
+                    timeout=self.__get_remaining_time(deadline),
+                )
+            except CallError as ex:
+                retries += 1
+                delay = random.uniform(0, self.retry_delay * 2 ** retries)
+
+                # An open circuit means the target is known to be failing:
+                # retrying would only add to its load.
+                if isinstance(ex, CircuitOpenError) or \
+                        ex.code not in self.retriable_error_codes or \
+                        retries > self.max_retries or \
+                        self.__get_remaining_time(deadline, delay) == 0 or \
+                        not self.__withdraw_retry():
+                    raise
+
+                logger.debug(
+                    "Call to %s on %s failed (%s): retrying in %.3f "
+                    "second(s).",
+                    key[1],
+                    key[0].decode('utf-8'),
+                    ex,
+                    delay,
+                )
+
+            await asyncio.sleep(delay, loop=self.loop)
+
+    async def __hedged_request(self, send, request, key, timeout):
+        hedge_delay = self.__get_hedge_delay(key)
+
+        if hedge_delay is not None and (
+            timeout is None or hedge_delay < timeout
+        ):
+            # The copies share an identifier so that the broker sends them to
+            # different instances of the service. They must not join a
+            # coalesced call either.
+            send = partial(request, hedge='%016x' % random.getrandbits(64))
+        else:
+            hedge_delay = None
+
+        started_at = {}
+
+        def start(timeout):
+            task = asyncio.ensure_future(send(timeout=timeout), loop=self.loop)
+            started_at[task] = self.loop.time()
+            return task
+
+        tasks = {start(timeout)}
+
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=hedge_delay,
+                    loop=self.loop,
+                )
+
+                if not done and self.__withdraw_retry():
+                    logger.debug(
+                        "Call to %s on %s is slower than %.3f second(s): "
+                        "hedging it.",
+                        key[1],
+                        key[0].decode('utf-8'),
+                        hedge_delay,
+                    )
+                    if timeout is not None:
+                        timeout -= hedge_delay
+
+                    tasks.add(start(timeout))
+
+            while True:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    return_when=asyncio.FIRST_COMPLETED,
+                    loop=self.loop,
+                )
+
+                for task in done:
+                    tasks.remove(task)
+
+                    # A failed copy only counts if no other one can succeed.
+                    if task.exception() is not None and tasks:
+                        continue
+
+                    result = task.result()
+                    self.__add_latency(
+                        key,
+                        self.loop.time() - started_at[task],
+                    )
+
+                    return result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def __get_remaining_time(self, deadline, delay=0):
+        if deadline is None:
+            return None
+
+        return max(deadline - self.loop.time() - delay, 0)
+
+    def __withdraw_retry(self):
+        if self.__retry_budget < 1:
+            return False
+
+        self.__retry_budget -= 1
+
+        return True
+
+    def __add_latency(self, key, latency):
+        if not self.hedge_method_calls:
+            return
+
+        latencies = self.__latencies.get(key)
+
+        if latencies is None:
+            latencies = self.__latencies[key] = deque(
+                maxlen=self.hedge_window_size,
+            )
+
+        latencies.append(latency)
+
+    def __get_hedge_delay(self, key):
+        if not self.hedge_method_calls:
+            return None
+
+        latencies = self.__latencies.get(key, ())
+
+        if len(latencies) < self.hedge_min_samples:
+            return None
+
+        latencies = sorted(latencies)
+
+        return latencies[int(self.hedge_percentile * (len(latencies) - 1))]
+
+    async def __coalesced_request(
+        self,
+        target_domain,
+        frames,
+        priority,
+        timeout,
+    ):
+        key = (target_domain,) + tuple(frames)
+        call = self.__inflight_method_calls.get(key)
+
+        if call is None:
+            # The shared request has no timeout of its own: each caller waits
+            # as long as it wants to.
+            task = asyncio.ensure_future(
+                self.request(
+                    target_domain=target_domain,
+                    command='method_call',
+                    args=frames,
+                    priority=priority,
+                ),
+                loop=self.loop,
+            )
+            call = self.__inflight_method_calls[key] = [task, 0]
+            task.add_done_callback(
+                partial(self.__remove_method_call, key=key, call=call),
+            )
+        else:
+            logger.debug(
+                "Joining in-flight call to %s on %s.",
+                frames[0].decode('utf-8'),
+                target_domain.decode('utf-8'),
+            )
+
+        task = call[0]
+        call[1] += 1
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(task, loop=self.loop),
+                timeout,
+                loop=self.loop,
+            )
+        finally:
+            call[1] -= 1
+
+            # Nobody is waiting for the result anymore.
+            if not call[1]:
+                task.cancel()
+
+    def __remove_method_call(self, task, *, key, call):
+        if self.__inflight_method_calls.get(key) is call:
+            del self.__inflight_method_calls[key]
+
     async def get_rpc_service_proxy(self, target_domain):
         """
         Get a RPC service proxy.
@@ -67,7 +402,7 @@ class RPCClientProxy(ClientProxy):
 
         class ServiceProxyMeta(type):
             @staticmethod
-            def make_method(name, signature, documentation):
+            def make_method(name, signature, documentation, idempotent):
                 async def method(self, *args, **kwargs):
                     bound_arguments = signature.bind(*args, **kwargs)
 
@@ -76,6 +411,7 @@ class RPCClientProxy(ClientProxy):
                         method=name,
                         args=bound_arguments.args,
                         kwargs=bound_arguments.kwargs,
+                        idempotent=idempotent,
                     )
 
                 method.__doc__ = documentation
@@ -93,6 +429,7 @@ class RPCClientProxy(ClientProxy):
                         name=name,
                         signature=signature,
                         documentation=documentation,
+                        idempotent=method_desc.get('idempotent', False),
                     )
 
                 return super().__new__(cls, name, bases, attrs)
@@ -5,6 +5,10 @@ A service class.
 import struct
 
 from asyncio import iscoroutinefunction
+from cachetools import (
+    LRUCache,
+    TTLCache,
+)
 
 from .common import (
     deserialize,
@@ -22,9 +26,46 @@ logger = main_logger.getChild('rpc_service')
 class MethodAttributes(dict):
     def __init__(self, **kwargs):
         kwargs.setdefault('use_context', False)
+        kwargs.setdefault('cache', None)
+        kwargs.setdefault('idempotent', False)
         super().__init__(**kwargs)
 
 
+class MethodCache(object):
+    """
+    A bounded cache of serialized method call results.
+    """
+    def __init__(self, size, ttl=None):
+        """
+        :param size: The maximum number of results to keep.
+        :param ttl: The number of seconds results remain valid, or `None` to
+            keep them until they get evicted.
+        """
+        if ttl is None:
+            self.results = LRUCache(maxsize=size)
+        else:
+            self.results = TTLCache(maxsize=size, ttl=ttl)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.results.get(key)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return result
+
+    def set(self, key, result):
+        self.results[key] = result
+
+    def clear(self):
+        self.results.clear()
+
+
 class RPCServiceMeta(ClientProxyMeta):
     EXPOSED_METHODS_DECORATED = 'decorated'
     EXPOSED_METHODS_PUBLIC = 'public'
@@ -70,30 +111,91 @@ class RPCServiceMeta(ClientProxyMeta):
 
 
 class RPCService(Service, metaclass=RPCServiceMeta):
+    DEFAULT_CACHE_SIZE = 256
+
     @staticmethod
-    def method(use_context=False):
+    def method(use_context=False, cache=None, idempotent=False):
         """
         Register a method as a method handler.
 
         :param use_context: A boolean flag that indicates whether the specified
             method expects a context as its first unnamed parameter.
+        :param cache: Caches the serialized results of remote calls to the
+            method. Either `True` to use a LRU cache of the default size, or a
+            dictionary with a `size` and an optional `ttl` (in seconds). Only
+            use it on methods whose result only depends on their arguments
+            (and the caller, for methods that use the context).
+        :param idempotent: Whether calling the method several times has the
+            same effect as calling it once. Callers may then retry failed
+            calls and send hedged requests.
         """
+        if cache is True:
+            cache = {}
+
         def decorator(func):
             func._pylar_method_attrs = MethodAttributes(
                 use_context=use_context,
+                cache=cache,
+                idempotent=idempotent,
             )
 
             return func
 
         return decorator
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._method_caches = {
+            method_name: MethodCache(
+                size=method_attrs['cache'].get(
+                    'size',
+                    self.DEFAULT_CACHE_SIZE,
+                ),
+                ttl=method_attrs['cache'].get('ttl'),
+            )
+            for method_name, method_attrs in self._methods.items()
+            if method_attrs['cache'] is not None
+        }
+
+    def invalidate_cache(self, method_name=None):
+        """
+        Drop cached results.
+
+        :param method_name: The method whose results must be dropped. If
+            `None`, the results of all methods are dropped.
+        """
+        if method_name is None:
+            for method_cache in self._method_caches.values():
+                method_cache.clear()
+        else:
+            self._method_caches[method_name].clear()
+
+    def get_cache_stats(self, method_name):
+        """
+        Get the cache statistics of a method.
+
+        :param method_name: The method name.
+        :returns: A dictionary with the `hits`, `misses` and `size` of the
+            method's cache.
+        """
+        method_cache = self._method_caches[method_name]
+
+        return {
+            'hits': method_cache.hits,
+            'misses': method_cache.misses,
+            'size': len(method_cache.results),
+        }
+
     @Service.command()
     async def describe(self):
         description = {
             'methods': {
-                method_name: serialize_function(
-                    getattr(self, method_name),
-                    use_context=method_attrs['use_context'],
+                method_name: dict(
+                    serialize_function(
+                        getattr(self, method_name),
+                        use_context=method_attrs['use_context'],
+                    ),
+                    idempotent=method_attrs['idempotent'],
                 )
                 for method_name, method_attrs in self._methods.items()
             },
@@ -110,8 +212,43 @@ class RPCService(Service, metaclass=RPCServiceMeta):
         method_kwargs,
     ):
         method_name = method_name.decode('utf-8')
-        method_args = deserialize(method_args)
-        method_kwargs = deserialize(method_kwargs)
+        method_cache = self._method_caches.get(method_name)
+
+        if method_cache is not None:
+            key = (method_args, method_kwargs)
+
+            if self._methods[method_name]['use_context']:
+                key += (context.domain,)
+
+            result = method_cache.get(key)
+
+            if result is not None:
+                return [result]
+
+        result = serialize(
+            await self.local_method_call(
+                context=context,
+                method_name=method_name,
+                args=deserialize(method_args),
+                kwargs=deserialize(method_kwargs),
+            ),
+        )
+
+        if method_cache is not None:
+            method_cache.set(key, result)
+
+        return [result]
+
+    async def local_method_call(self, context, method_name, args, kwargs):
+        """
+        Call a method directly, without any serialization.
+
+        :param context: The caller's context.
+        :param method_name: The name of the method to call.
+        :param args: A list of arguments to pass.
+        :param kwargs: A dictionary of named arguments to pass.
+        :returns: The method call result.
+        """
         method_attrs = self._methods.get(method_name)
 
         if method_attrs is None:
@@ -121,19 +258,18 @@ class RPCService(Service, metaclass=RPCServiceMeta):
             )
 
         method = getattr(self, method_name)
+        method_args = list(args)
 
         if method_attrs['use_context']:
             method_args.insert(0, context)
 
         if iscoroutinefunction(method):
-            result = await method(
+            return await method(
                 *method_args,
-                **method_kwargs
+                **kwargs
             )
         else:
-            result = method(
+            return method(
                 *method_args,
-                **method_kwargs
+                **kwargs
             )
-
-        return [serialize(result)]
@@ -2,11 +2,19 @@
 Security utils.
 """
 
+import hashlib
+import hmac
+import struct
+
+from io import BytesIO
+
 from csodium import (
     crypto_generichash_blake2b_salt_personal,
     randombytes,
 )
 
+PASSWORD_HASH_ITERATIONS = 100000
+
 
 def generate_salt():
     """
@@ -39,4 +47,62 @@ def verify_hash(shared_secret, salt, identifier, hash):
     """
     reference = generate_hash(shared_secret, salt, identifier)
 
-    return hash == reference
+    return hmac.compare_digest(hash, reference)
+
+
+def generate_credentials(shared_secret, identifier):
+    """
+    Generate shared-secret credentials for the specified identifier.
+
+    :param shared_secret: The shared secret.
+    :param identifier: The identifier to generate credentials for.
+    :returns: The credentials, as bytes.
+    """
+    salt = generate_salt()
+    hash = generate_hash(shared_secret, salt, identifier)
+
+    buf = BytesIO()
+    buf.write(struct.pack('B', len(salt)))
+    buf.write(salt)
+    buf.write(hash)
+    return buf.getvalue()
+
+
+def digest_credentials(credentials):
+    """
+    Compute a digest of some credentials, suitable for caching purposes.
+
+    :param credentials: The credentials.
+    :returns: The digest, as bytes.
+    """
+    return hashlib.sha256(credentials).digest()
+
+
+def hash_password(password, salt):
+    """
+    Hash a password for storage.
+
+    This is deliberately slow and should not be called from the event loop.
+
+    :param password: The password, as bytes.
+    :param salt: The salt.
+    :returns: The password hash.
+    """
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        password,
+        salt,
+        PASSWORD_HASH_ITERATIONS,
+    )
+
+
+def verify_password(password, salt, hash):
+    """
+    Verify a password against a stored hash, in constant time.
+
+    :param password: The password, as bytes.
+    :param salt: The salt.
+    :param hash: The stored hash.
+    :returns: `True` if the password matches.
+    """
+    return hmac.compare_digest(hash_password(password, salt), hash)
@@ -2,16 +2,9 @@
 A service class.
 """
 
-import struct
-
-from io import BytesIO
-
 from .rpc_client_proxy import RPCClientProxy
 from .log import logger as main_logger
-from .security import (
-    generate_hash,
-    generate_salt,
-)
+from .security import generate_credentials
 
 logger = main_logger.getChild('service')
 
@@ -30,11 +23,4 @@ class Service(RPCClientProxy):
 
     @staticmethod
     def get_credentials(name, shared_secret):
-        salt = generate_salt()
-        hash = generate_hash(shared_secret, salt, name)
-
-        buf = BytesIO()
-        buf.write(struct.pack('B', len(salt)))
-        buf.write(salt)
-        buf.write(hash)
-        return buf.getvalue()
+        return generate_credentials(shared_secret, name)
@@ -0,0 +1,557 @@
+"""
+A shared-memory transport for clients and brokers running on the same host.
+
+The sockets in this module can be used in place of ZMQ sockets wherever a
+`Client`, a `Broker` or a `Peer` takes one. They are selected by using an
+`shm://name` endpoint.
+
+Each connection is made of two memory-mapped ring buffers (one per
+direction) and a UNIX domain socket. Frames are written straight into the
+ring buffers: the UNIX socket only carries small control records used as
+doorbells and to release ring space, plus the odd message that is too large
+to fit in a ring.
+"""
+
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from uuid import uuid4
+
+from pyslot import Signal
+
+from .async_object import AsyncObject
+from .log import logger as main_logger
+
+logger = main_logger.getChild('shm')
+
+SHM_SCHEME = 'shm://'
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+RECORD = struct.Struct('!BQQ')
+RECORD_HELLO = 0
+RECORD_DATA = 1
+RECORD_INLINE = 2
+RECORD_RELEASE = 3
+
+SIZE = struct.Struct('!I')
+
+# Errors that indicate a link is gone.
+LINK_ERRORS = (
+    asyncio.IncompleteReadError,
+    ConnectionError,
+    OSError,
+    ValueError,
+)
+
+
+def is_shm_endpoint(endpoint):
+    """
+    Check whether an endpoint designates a shared-memory transport.
+
+    :param endpoint: The endpoint.
+    :returns: `True` if `endpoint` uses the `shm://` scheme.
+    """
+    return endpoint.startswith(SHM_SCHEME)
+
+
+def get_socket_path(endpoint):
+    """
+    Get the path of the rendez-vous UNIX socket for an endpoint.
+
+    :param endpoint: The `shm://` endpoint.
+    :returns: The path.
+    """
+    name = endpoint[len(SHM_SCHEME):]
+
+    return os.path.join(tempfile.gettempdir(), 'pylar-%s.sock' % name)
+
+
+def get_ring_path(link_id, direction):
+    """
+    Get the path of a ring buffer file.
+
+    :param link_id: The link identifier, as bytes.
+    :param direction: The ring direction, as a string.
+    :returns: The path.
+    """
+    if os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    else:
+        directory = tempfile.gettempdir()
+
+    return os.path.join(
+        directory,
+        'pylar-%s-%s' % (link_id.hex(), direction),
+    )
+
+
+def get_message_size(frames):
+    """
+    Get the encoded size of a message.
+
+    :param frames: The message frames.
+    :returns: The size, in bytes.
+    """
+    return SIZE.size * (len(frames) + 1) + sum(map(len, frames))
+
+
+def write_message(buffer, offset, frames):
+    """
+    Encode a message into a buffer.
+
+    :param buffer: The buffer to write to.
+    :param offset: The offset in the buffer.
+    :param frames: The message frames.
+    """
+    SIZE.pack_into(buffer, offset, len(frames))
+    offset += SIZE.size
+
+    for frame in frames:
+        size = len(frame)
+        SIZE.pack_into(buffer, offset, size)
+        offset += SIZE.size
+        buffer[offset:offset + size] = frame
+        offset += size
+
+
+def read_message(buffer, offset):
+    """
+    Decode a message from a buffer.
+
+    :param buffer: The buffer to read from.
+    :param offset: The offset in the buffer.
+    :returns: The message frames.
+    """
+    count, = SIZE.unpack_from(buffer, offset)
+    offset += SIZE.size
+    frames = []
+
+    for _ in range(count):
+        size, = SIZE.unpack_from(buffer, offset)
+        offset += SIZE.size
+        frames.append(bytes(buffer[offset:offset + size]))
+        offset += size
+
+    return frames
+
+
+class RingBuffer(object):
+    """
+    A memory-mapped buffer, shared between two processes.
+    """
+    def __init__(self, path, capacity=None):
+        """
+        Open or create a ring buffer.
+
+        :param path: The path of the file that backs the buffer.
+        :param capacity: If specified, the buffer is created with that
+            capacity. Otherwise, an existing buffer is opened.
+        """
+        if capacity is None:
+            fd = os.open(path, os.O_RDWR)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+
+        try:
+            if capacity is None:
+                capacity = os.fstat(fd).st_size
+            else:
+                os.ftruncate(fd, capacity)
+
+            self.memory = mmap.mmap(fd, capacity)
+        finally:
+            os.close(fd)
+
+        self.path = path
+        self.capacity = capacity
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Link(object):
+    """
+    A shared-memory connection between two processes.
+    """
+    def __init__(self, *, reader, writer, tx, rx, remote_identity, loop):
+        self.reader = reader
+        self.writer = writer
+        self.tx = tx
+        self.rx = rx
+        self.remote_identity = remote_identity
+        self.loop = loop
+        self.closed = False
+
+        # Positions are virtual: they only ever increase and are mapped onto
+        # the rings modulo their capacity.
+        self.__head = 0
+        self.__tail = 0
+        self.__read_position = 0
+        self.__release_handle = None
+        self.__space = asyncio.Event(loop=loop)
+        self.__send_lock = asyncio.Lock(loop=loop)
+
+    async def send(self, frames):
+        """
+        Send a message.
+
+        :param frames: The message frames.
+        """
+        size = get_message_size(frames)
+
+        async with self.__send_lock:
+            if size > self.tx.capacity:
+                buffer = bytearray(size)
+                write_message(buffer, 0, frames)
+                self.__check_closed()
+                self.writer.write(RECORD.pack(RECORD_INLINE, size, 0))
+                self.writer.write(buffer)
+            else:
+                while True:
+                    self.__check_closed()
+                    offset = self.__tail % self.tx.capacity
+
+                    if offset + size > self.tx.capacity:
+                        padding = self.tx.capacity - offset
+                    else:
+                        padding = 0
+
+                    free = self.tx.capacity - (self.__tail - self.__head)
+
+                    # An empty ring can always take the message at its start.
+                    if free >= padding + size or self.__tail == self.__head:
+                        break
+
+                    self.__space.clear()
+                    await self.__space.wait()
+
+                self.__tail += padding
+                offset = self.__tail % self.tx.capacity
+                write_message(self.tx.memory, offset, frames)
+                self.__tail += size
+                self.writer.write(RECORD.pack(RECORD_DATA, offset, size))
+
+        await self.writer.drain()
+
+    async def recv(self):
+        """
+        Receive a message.
+
+        :returns: The message frames.
+        """
+        while True:
+            kind, a, b = RECORD.unpack(
+                await self.reader.readexactly(RECORD.size),
+            )
+
+            if kind == RECORD_DATA:
+                self.__check_closed()
+                capacity = self.rx.capacity
+                position = self.__read_position % capacity
+
+                # The sender skips the end of the ring when a message does not
+                # fit there.
+                if a != position:
+                    self.__read_position += capacity - position
+
+                frames = read_message(self.rx.memory, a)
+                self.__read_position += b
+                self.__schedule_release()
+
+                return frames
+            elif kind == RECORD_INLINE:
+                return read_message(await self.reader.readexactly(a), 0)
+            elif kind == RECORD_RELEASE:
+                self.__head = a
+                self.__space.set()
+            else:
+                raise ValueError("Unexpected record type %d." % kind)
+
+    def close(self):
+        """
+        Close the link.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.__space.set()
+
+        if self.__release_handle is not None:
+            self.__release_handle.cancel()
+            self.__release_handle = None
+
+        self.writer.close()
+        self.tx.close()
+        self.rx.close()
+
+    # Private methods.
+
+    def __check_closed(self):
+        if self.closed:
+            raise ConnectionResetError("The link is closed.")
+
+    def __schedule_release(self):
+        # Releases are coalesced so that a burst of messages only costs one
+        # control record.
+        if self.__release_handle is None:
+            self.__release_handle = self.loop.call_soon(self.__release)
+
+    def __release(self):
+        self.__release_handle = None
+
+        if not self.closed:
+            self.writer.write(
+                RECORD.pack(RECORD_RELEASE, self.__read_position, 0),
+            )
+
+
+def check_platform():
+    if sys.platform == 'win32':
+        raise NotImplementedError(
+            "The shared-memory transport requires UNIX domain sockets.",
+        )
+
+
+class ShmRouterSocket(AsyncObject):
+    """
+    The listening side of the shared-memory transport, similar to a ZMQ
+    ROUTER socket.
+    """
+    def __init__(self, *, capacity=DEFAULT_CAPACITY, **kwargs):
+        check_platform()
+        super().__init__(**kwargs)
+        self.capacity = capacity
+
+        # Exposed signals.
+        self.on_connection_ready = Signal()
+        self.on_connection_lost = Signal()
+
+        self.__links = {}
+        self.__incoming = asyncio.Queue(loop=self.loop)
+
+    def bind(self, endpoint):
+        """
+        Listen on an endpoint.
+
+        :param endpoint: The `shm://` endpoint.
+        """
+        self.add_task(self.__serve(get_socket_path(endpoint)))
+
+    async def send_multipart(self, frames):
+        """
+        Send a message to a connected peer.
+
+        :param frames: The message frames, starting with the identity of the
+            peer. Messages for unknown peers are silently dropped.
+        """
+        link = self.__links.get(frames[0])
+
+        if link is None:
+            return
+
+        try:
+            await link.send(frames[1:])
+        except LINK_ERRORS:
+            pass
+
+    async def recv_multipart(self):
+        """
+        Receive a message from any connected peer.
+
+        :returns: The message frames, starting with the identity of the peer.
+        """
+        return await self.__incoming.get()
+
+    # Private methods.
+
+    async def __serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server = await asyncio.start_unix_server(
+            self.__on_connection,
+            path=path,
+            loop=self.loop,
+        )
+
+        try:
+            await self.wait_closing()
+        finally:
+            server.close()
+
+            for link in list(self.__links.values()):
+                link.close()
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def __on_connection(self, reader, writer):
+        self.add_task(self.__handle_link(reader, writer))
+
+    async def __handle_link(self, reader, writer):
+        link_id = uuid4().bytes
+        tx = RingBuffer(get_ring_path(link_id, 's2c'), self.capacity)
+        rx = RingBuffer(get_ring_path(link_id, 'c2s'), self.capacity)
+        link = Link(
+            reader=reader,
+            writer=writer,
+            tx=tx,
+            rx=rx,
+            remote_identity=link_id,
+            loop=self.loop,
+        )
+        writer.write(RECORD.pack(RECORD_HELLO, self.capacity, len(link_id)))
+        writer.write(link_id)
+        self.__links[link_id] = link
+        self.on_connection_ready.emit(link)
+
+        try:
+            while True:
+                frames = await link.recv()
+                frames.insert(0, link_id)
+                await self.__incoming.put(frames)
+        except LINK_ERRORS:
+            pass
+        finally:
+            del self.__links[link_id]
+            link.close()
+            tx.unlink()
+            rx.unlink()
+            self.on_connection_lost.emit(link)
+
+
+class ShmDealerSocket(AsyncObject):
+    """
+    The connecting side of the shared-memory transport, similar to a ZMQ
+    DEALER socket.
+
+    The socket reconnects automatically and outgoing messages wait for a
+    connection to be available.
+    """
+    def __init__(self, *, reconnect_delay=0.5, **kwargs):
+        check_platform()
+        super().__init__(**kwargs)
+        self.reconnect_delay = reconnect_delay
+
+        # Exposed signals.
+        self.on_connection_ready = Signal()
+        self.on_connection_lost = Signal()
+
+        self.__link = None
+        self.__connected = asyncio.Event(loop=self.loop)
+        self.__incoming = asyncio.Queue(loop=self.loop)
+
+    def connect(self, endpoint):
+        """
+        Connect to an endpoint.
+
+        :param endpoint: The `shm://` endpoint.
+        """
+        self.add_task(self.__connection_loop(get_socket_path(endpoint)))
+
+    async def send_multipart(self, frames):
+        """
+        Send a message.
+
+        :param frames: The message frames.
+        """
+        while True:
+            await self.__connected.wait()
+
+            try:
+                await self.__link.send(frames)
+            except LINK_ERRORS:
+                continue
+            else:
+                break
+
+    async def recv_multipart(self):
+        """
+        Receive a message.
+
+        :returns: The message frames.
+        """
+        return await self.__incoming.get()
+
+    async def reset_all(self):
+        """
+        Drop the current connection and start a new one.
+        """
+        if self.__link is not None:
+            self.__link.close()
+
+        while not self.__incoming.empty():
+            self.__incoming.get_nowait()
+
+    # Private methods.
+
+    async def __open_link(self, path):
+        reader, writer = await asyncio.open_unix_connection(
+            path,
+            loop=self.loop,
+        )
+
+        try:
+            kind, capacity, size = RECORD.unpack(
+                await reader.readexactly(RECORD.size),
+            )
+
+            if kind != RECORD_HELLO:
+                raise ValueError("Unexpected record type %d." % kind)
+
+            link_id = await reader.readexactly(size)
+            tx = RingBuffer(get_ring_path(link_id, 'c2s'))
+            rx = RingBuffer(get_ring_path(link_id, 's2c'))
+        except BaseException:
+            writer.close()
+            raise
+
+        # Both ends are mapped now: the files are no longer needed.
+        tx.unlink()
+        rx.unlink()
+
+        return Link(
+            reader=reader,
+            writer=writer,
+            tx=tx,
+            rx=rx,
+            remote_identity=link_id,
+            loop=self.loop,
+        )
+
+    async def __connection_loop(self, path):
+        while not self.closing:
+            try:
+                link = await self.__open_link(path)
+            except LINK_ERRORS as ex:
+                logger.debug("Unable to connect to %s (%s).", path, ex)
+                await asyncio.sleep(self.reconnect_delay, loop=self.loop)
+                continue
+
+            self.__link = link
+            self.__connected.set()
+            self.on_connection_ready.emit(link)
+
+            try:
+                while True:
+                    await self.__incoming.put(await link.recv())
+            except LINK_ERRORS:
+                pass
+            finally:
+                self.__connected.clear()
+                self.__link = None
+                link.close()
+                self.on_connection_lost.emit(link)
@@ -0,0 +1,265 @@
+"""
+A supervisor for pre-forked worker processes.
+"""
+
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+from multiprocessing.connection import wait
+
+from .log import logger as main_logger
+
+logger = main_logger.getChild('supervisor')
+
+PARENT_POLL_INTERVAL = 1.0
+
+
+def watch_parent(parent_pid, interval=PARENT_POLL_INTERVAL):
+    """
+    Interrupt the current process once its parent goes away.
+
+    Meant to run in a daemon thread: the interruption is delivered as a
+    SIGINT, so that the worker drains as if the supervisor had asked it to.
+
+    :param parent_pid: The process identifier of the parent.
+    :param interval: The number of seconds between two checks.
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+
+    logger.warning(
+        "Supervisor (pid %s) went away: stopping worker (pid %s).",
+        parent_pid,
+        os.getpid(),
+    )
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def run_worker(target, args):
+    """
+    The entry point of worker processes.
+
+    :param target: The callable to run.
+    :param args: The arguments to pass to `target`.
+    """
+    parent_pid = os.getppid()
+
+    # Forked workers must not inherit the supervisor's signal handlers.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Signals sent to the whole process group, like a Ctrl-C from the
+    # terminal, must not reach workers on top of the one the supervisor
+    # forwards: a second signal makes them stop without draining.
+    if sys.platform != 'win32':
+        os.setpgrp()
+
+        # Being out of its process group, nothing stops a worker whose
+        # supervisor was killed: it would stay registered forever.
+        threading.Thread(
+            target=watch_parent,
+            args=(parent_pid,),
+            name='parent-watcher',
+            daemon=True,
+        ).start()
+
+    target(*args)
+
+
+class Supervisor(object):
+    """
+    Runs several identical worker processes, restarting the ones that exit
+    until asked to stop.
+
+    Workers that exit shortly after being started are restarted with an
+    increasing delay, so that a broken worker doesn't burn the CPU.
+    """
+    def __init__(
+        self,
+        *,
+        target,
+        args=(),
+        processes=1,
+        drain_timeout=10.0,
+        min_uptime=5.0,
+        min_restart_delay=1.0,
+        max_restart_delay=30.0
+    ):
+        """
+        :param target: The callable to run in each worker. Must be picklable.
+        :param args: The arguments to pass to `target`.
+        :param processes: The number of workers.
+        :param drain_timeout: The number of seconds workers get to stop
+            gracefully before they are terminated.
+        :param min_uptime: Workers that run for less than this number of
+            seconds are considered to be failing.
+        :param min_restart_delay: The delay before restarting a worker.
+        :param max_restart_delay: The maximum delay before restarting a
+            failing worker.
+        """
+        self.target = target
+        self.args = args
+        self.processes = processes
+        self.drain_timeout = drain_timeout
+        self.min_uptime = min_uptime
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.__stopping = False
+        self.__workers = {}
+        self.__started_at = {}
+        self.__restart_delays = {}
+        self.__pending_restarts = {}
+
+    def stop(self):
+        """
+        Ask the supervisor to stop its workers and return from `run`.
+
+        Safe to call from a signal handler.
+        """
+        self.__stopping = True
+
+    def run(self):
+        """
+        Start the workers and supervise them until `stop` is called or a
+        SIGINT or SIGTERM is received.
+
+        Workers are then given `drain_timeout` seconds to stop. Another
+        signal in the meantime terminates them right away.
+        """
+        handled_signals = [signal.SIGINT, signal.SIGTERM]
+        previous_handlers = {
+            signum: signal.signal(signum, self.__on_signal)
+            for signum in handled_signals
+        }
+
+        try:
+            for index in range(self.processes):
+                self.__start_worker(index)
+
+            while not self.__stopping:
+                self.__supervise()
+        finally:
+            try:
+                self.__drain()
+            finally:
+                for signum, handler in previous_handlers.items():
+                    signal.signal(signum, handler)
+
+    # Private methods.
+
+    def __on_signal(self, signum, frame):
+        if self.__stopping:
+            logger.warning("Interrupted again: terminating the workers.")
+            self.__terminate()
+
+        self.stop()
+
+    def __terminate(self):
+        for process in list(self.__workers.values()):
+            if process.is_alive():
+                process.terminate()
+
+    def __start_worker(self, index):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(self.target, self.args),
+            name='worker-%d' % index,
+        )
+        process.start()
+        self.__workers[index] = process
+        self.__started_at[index] = time.monotonic()
+        logger.info("Started worker %d (pid %s).", index, process.pid)
+
+    def __supervise(self):
+        now = time.monotonic()
+
+        for index, due in list(self.__pending_restarts.items()):
+            if due <= now:
+                del self.__pending_restarts[index]
+                self.__start_worker(index)
+
+        # Waking up regularly lets us notice stop requests.
+        timeout = min([0.5] + [
+            due - now for due in self.__pending_restarts.values()
+        ])
+        wait(
+            [process.sentinel for process in self.__workers.values()],
+            max(timeout, 0),
+        )
+        now = time.monotonic()
+
+        for index, process in list(self.__workers.items()):
+            if process.is_alive():
+                continue
+
+            process.join()
+            del self.__workers[index]
+
+            if self.__stopping:
+                continue
+
+            if now - self.__started_at[index] < self.min_uptime:
+                delay = min(
+                    self.__restart_delays.get(index, 0) * 2 or
+                    self.min_restart_delay,
+                    self.max_restart_delay,
+                )
+            else:
+                delay = self.min_restart_delay
+
+            self.__restart_delays[index] = delay
+            self.__pending_restarts[index] = now + delay
+            logger.warning(
+                "Worker %d (pid %s) exited with code %s. Restarting it in %s "
+                "second(s).",
+                index,
+                process.pid,
+                process.exitcode,
+                delay,
+            )
+
+    def __interrupt(self, process):
+        if sys.platform == 'win32':
+            process.terminate()
+        else:
+            try:
+                os.kill(process.pid, signal.SIGINT)
+            except OSError:
+                pass
+
+    def __drain(self):
+        self.__pending_restarts.clear()
+        workers = [
+            process for process in self.__workers.values()
+            if process.is_alive()
+        ]
+
+        if not workers:
+            return
+
+        logger.info("Stopping %d worker(s).", len(workers))
+
+        for process in workers:
+            self.__interrupt(process)
+
+        deadline = time.monotonic() + self.drain_timeout
+
+        for process in workers:
+            process.join(max(deadline - time.monotonic(), 0))
+
+        for process in workers:
+            if process.is_alive():
+                logger.warning(
+                    "Worker %s (pid %s) did not stop in time: terminating it.",
+                    process.name,
+                    process.pid,
+                )
+                process.terminate()
+                process.join()
+
+        self.__workers.clear()
@@ -0,0 +1,128 @@
+"""
+Topic subscriptions.
+"""
+
+TOPIC_SEPARATOR = b'/'
+
+
+def split_topic(topic):
+    """
+    Split a topic into its components.
+
+    :param topic: The topic, as bytes.
+    :returns: A tuple of components. The empty topic has no components.
+    """
+    if not topic:
+        return ()
+
+    return tuple(topic.split(TOPIC_SEPARATOR))
+
+
+class TopicNode(object):
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+
+class TopicTrie(object):
+    """
+    A prefix trie of topic subscriptions.
+
+    Topics are domain-like: a subscription to `a/b` matches the `a/b` topic
+    and all its subtopics, like `a/b/c`, but not `a/bc`. A subscription to
+    the empty topic matches all topics.
+    """
+    def __init__(self):
+        self.__root = TopicNode()
+        self.__topics_by_subscriber = {}
+
+    def subscribe(self, topic, subscriber):
+        """
+        Subscribe to a topic.
+
+        :param topic: The topic.
+        :param subscriber: A hashable subscriber.
+        """
+        node = self.__root
+
+        for component in split_topic(topic):
+            node = node.children.setdefault(component, TopicNode())
+
+        node.subscribers.add(subscriber)
+        self.__topics_by_subscriber.setdefault(subscriber, set()).add(topic)
+
+    def unsubscribe(self, topic, subscriber):
+        """
+        Unsubscribe from a topic.
+
+        :param topic: The topic.
+        :param subscriber: The subscriber.
+
+        Unsubscribing from a topic that was not subscribed to does nothing.
+        """
+        topics = self.__topics_by_subscriber.get(subscriber)
+
+        if not topics or topic not in topics:
+            return
+
+        topics.remove(topic)
+
+        if not topics:
+            del self.__topics_by_subscriber[subscriber]
+
+        components = split_topic(topic)
+        path = [self.__root]
+
+        for component in components:
+            path.append(path[-1].children[component])
+
+        path[-1].subscribers.remove(subscriber)
+
+        # Prune the nodes that became useless.
+        for index in range(len(components), 0, -1):
+            node = path[index]
+
+            if node.subscribers or node.children:
+                break
+
+            del path[index - 1].children[components[index - 1]]
+
+    def remove_subscriber(self, subscriber):
+        """
+        Remove all the subscriptions of a subscriber.
+
+        :param subscriber: The subscriber.
+        """
+        for topic in list(self.__topics_by_subscriber.get(subscriber, ())):
+            self.unsubscribe(topic, subscriber)
+
+    def get_topics(self, subscriber):
+        """
+        Get the topics a subscriber is subscribed to.
+
+        :param subscriber: The subscriber.
+        :returns: A set of topics.
+        """
+        return set(self.__topics_by_subscriber.get(subscriber, ()))
+
+    def match(self, topic):
+        """
+        Get the subscribers for a topic.
+
+        :param topic: The topic.
+        :returns: The set of subscribers whose subscriptions match the topic.
+        """
+        node = self.__root
+        subscribers = set(node.subscribers)
+
+        for component in split_topic(topic):
+            node = node.children.get(component)
+
+            if node is None:
+                break
+
+            subscribers.update(node.subscribers)
+
+        return subscribers
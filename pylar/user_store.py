@@ -0,0 +1,161 @@
+"""
+User stores for the authentication service.
+"""
+
+import sqlite3
+import threading
+
+from .log import logger as main_logger
+
+logger = main_logger.getChild('user_store')
+
+
+class UserStore(object):
+    """
+    A base class for user stores.
+
+    User stores map user domains to salted password hashes. Their methods may
+    block and are called from a thread pool by the authentication service.
+    """
+    def get(self, domain):
+        """
+        Get a user.
+
+        :param domain: The user domain.
+        :returns: A `(salt, hash)` tuple, or `None` if the user does not
+            exist.
+
+        Must be reimplemented by child classes.
+        """
+        raise NotImplementedError
+
+    def set(self, domain, salt, hash):
+        """
+        Add or replace a user.
+
+        :param domain: The user domain.
+        :param salt: The password salt.
+        :param hash: The password hash.
+
+        Must be reimplemented by child classes.
+        """
+        raise NotImplementedError
+
+    def remove(self, domain):
+        """
+        Remove a user.
+
+        :param domain: The user domain.
+
+        Raises a `KeyError` if the user does not exist.
+
+        Must be reimplemented by child classes.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the resources held by the store.
+        """
+
+
+class MemoryUserStore(UserStore):
+    """
+    A user store that keeps all users in memory.
+    """
+    def __init__(self):
+        self._users = {}
+
+    def get(self, domain):
+        return self._users.get(domain)
+
+    def set(self, domain, salt, hash):
+        self._users[domain] = (salt, hash)
+
+    def remove(self, domain):
+        del self._users[domain]
+
+
+class SQLiteUserStore(UserStore):
+    """
+    A user store backed by an on-disk SQLite database.
+
+    The database is only opened on first use, and each thread gets its own
+    connection. Users are indexed by domain. Closing the store closes all the
+    connections: using it afterwards opens new ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__connections = []
+
+        # Bumped on close, so that threads don't reuse closed connections.
+        self.__generation = 0
+
+    def get(self, domain):
+        row = self.__get_connection().execute(
+            'SELECT salt, hash FROM users WHERE domain = ?',
+            (domain,),
+        ).fetchone()
+
+        if row is not None:
+            return bytes(row[0]), bytes(row[1])
+
+    def set(self, domain, salt, hash):
+        connection = self.__get_connection()
+
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO users (domain, salt, hash) '
+                'VALUES (?, ?, ?)',
+                (domain, salt, hash),
+            )
+
+    def remove(self, domain):
+        connection = self.__get_connection()
+
+        with connection:
+            cursor = connection.execute(
+                'DELETE FROM users WHERE domain = ?',
+                (domain,),
+            )
+
+        if not cursor.rowcount:
+            raise KeyError(domain)
+
+    def close(self):
+        with self.__lock:
+            connections = self.__connections
+            self.__connections = []
+            self.__generation += 1
+
+        for connection in connections:
+            connection.close()
+
+    # Private methods.
+
+    def __get_connection(self):
+        connection = getattr(self.__local, 'connection', None)
+
+        if connection is None or \
+                self.__local.generation != self.__generation:
+            logger.debug("Opening users database at %s.", self.path)
+            connection = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'domain BLOB PRIMARY KEY, '
+                'salt BLOB NOT NULL, '
+                'hash BLOB NOT NULL'
+                ') WITHOUT ROWID',
+            )
+            self.__local.connection = connection
+
+            with self.__lock:
+                self.__local.generation = self.__generation
+                self.__connections.append(connection)
+
+        return connection
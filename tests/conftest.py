@@ -0,0 +1,212 @@
+import asyncio
+import azmq
+import pytest
+
+from itertools import count
+
+from pylar.authentication_service import AuthenticationService
+from pylar.broker import Broker
+from pylar.client import Client
+from pylar.replica import Replica
+from pylar.rpc_client_proxy import RPCClientProxy
+
+SHARED_SECRET = b'secret'
+
+endpoint_ids = count()
+
+
+class Cluster(object):
+    """
+    Brokers, clients and services that talk over in-process sockets.
+
+    Everything created through a cluster is closed with it.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.context = azmq.Context(loop=loop)
+        self.objects = []
+
+    def endpoint(self):
+        """
+        Get a new endpoint.
+
+        :returns: An in-process endpoint that no other test uses.
+        """
+        return 'inproc://broker-%d' % next(endpoint_ids)
+
+    def add(self, obj):
+        """
+        Close an object with the cluster.
+
+        :param obj: An asynchronous object.
+        :returns: `obj`.
+        """
+        self.objects.append(obj)
+
+        return obj
+
+    def listen(self, endpoint):
+        """
+        Get a socket that brokers can accept connections on.
+
+        :param endpoint: The endpoint to bind to.
+        :returns: A ROUTER socket.
+        """
+        socket = self.context.socket(azmq.ROUTER)
+        socket.bind(endpoint)
+
+        return socket
+
+    def connect(self, endpoint):
+        """
+        Get a socket connected to a broker.
+
+        :param endpoint: The endpoint of the broker.
+        :returns: A DEALER socket.
+        """
+        socket = self.context.socket(azmq.DEALER)
+        socket.connect(endpoint)
+
+        return socket
+
+    def broker(self, endpoint=None, **kwargs):
+        """
+        Start a broker.
+
+        :param endpoint: The endpoint to listen on, if any.
+        :param kwargs: Additional arguments for the broker.
+        :returns: The broker.
+        """
+        if endpoint is not None:
+            kwargs['socket'] = self.listen(endpoint)
+
+        return self.add(
+            Broker(shared_secret=SHARED_SECRET, loop=self.loop, **kwargs),
+        )
+
+    def replica(self, endpoint, **kwargs):
+        """
+        Start replicating a broker.
+
+        :param endpoint: The endpoint of the broker.
+        :param kwargs: Additional arguments for the replica.
+        :returns: The replica.
+        """
+        return self.add(
+            Replica(
+                socket=self.connect(endpoint),
+                shared_secret=SHARED_SECRET,
+                loop=self.loop,
+                **kwargs
+            ),
+        )
+
+    def client(self, endpoint=None, **kwargs):
+        """
+        Start a client.
+
+        :param endpoint: The endpoint of the broker. If `None`, `endpoints`
+            must be specified instead.
+        :param kwargs: Additional arguments for the client.
+        :returns: The client.
+        """
+        if endpoint is None:
+            socket = self.context.socket(azmq.DEALER)
+        else:
+            socket = self.connect(endpoint)
+
+        return self.add(Client(socket=socket, loop=self.loop, **kwargs))
+
+    def service(self, service_class, client, **kwargs):
+        """
+        Start a service.
+
+        :param service_class: The service class.
+        :param client: The client the service uses.
+        :param kwargs: Additional arguments for the service.
+        :returns: The service.
+        """
+        return self.add(
+            service_class(
+                client=client,
+                shared_secret=SHARED_SECRET,
+                loop=self.loop,
+                **kwargs
+            ),
+        )
+
+    def authentication_service(self, client):
+        """
+        Start an authentication service that knows `alice` and `bob`, whose
+        password is `password`.
+
+        :param client: The client the service uses.
+        :returns: The service.
+        """
+        return self.service(AuthenticationService, client)
+
+    def user(self, client, username='alice', proxy_class=RPCClientProxy):
+        """
+        Log a user in.
+
+        :param client: The client to log in through.
+        :param username: The username.
+        :param proxy_class: The client proxy class to use.
+        :returns: The client proxy, which may not be registered yet.
+        """
+        return self.add(
+            proxy_class(
+                client=client,
+                domain=('user/%s' % username).encode('utf-8'),
+                credentials=b'password',
+                loop=self.loop,
+            ),
+        )
+
+    async def wait_for(self, predicate, timeout=5.0):
+        """
+        Wait for a condition to become true.
+
+        :param predicate: A callable that tells whether the condition is true.
+        :param timeout: The number of seconds to wait for.
+        """
+        deadline = self.loop.time() + timeout
+
+        while not predicate():
+            assert self.loop.time() < deadline, "The condition was never met."
+            await asyncio.sleep(0.01, loop=self.loop)
+
+    async def close(self):
+        for obj in reversed(self.objects):
+            obj.close()
+
+        for obj in reversed(self.objects):
+            try:
+                await obj.wait_closed()
+            except Exception:
+                pass
+
+        self.context.close()
+        await self.context.wait_closed()
+
+
+@pytest.fixture
+def cluster(request, event_loop):
+    cluster = Cluster(loop=event_loop)
+    request.addfinalizer(
+        lambda: event_loop.run_until_complete(cluster.close()),
+    )
+
+    return cluster
+
+
+@pytest.fixture
+def endpoint(cluster):
+    """
+    The endpoint of a broker that runs an authentication service.
+    """
+    endpoint = cluster.endpoint()
+    cluster.broker(endpoint)
+    cluster.authentication_service(cluster.client(endpoint))
+
+    return endpoint
@@ -0,0 +1,191 @@
+import pytest
+
+from pylar.circuit_breaker import CircuitBreaker
+from pylar.errors import CircuitOpenError
+
+
+class FakeLoop(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+def make_breaker(loop, **kwargs):
+    params = {
+        'name': 'target',
+        'loop': loop,
+        'window_size': 10,
+        'min_calls': 4,
+        'failure_rate_threshold': 0.5,
+        'open_duration': 5.0,
+        'probe_calls': 1,
+    }
+    params.update(kwargs)
+
+    return CircuitBreaker(**params)
+
+
+def call(breaker, failed, duration=0.0):
+    probe = breaker.acquire()
+    breaker.release(duration, failed, probe)
+
+    return probe
+
+
+def open_circuit(breaker):
+    for _ in range(4):
+        call(breaker, failed=True)
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_closed_by_default(loop):
+    breaker = make_breaker(loop)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failure_rate == 0.0
+    assert breaker.acquire() is False
+
+
+def test_stays_closed_below_min_calls(loop):
+    breaker = make_breaker(loop)
+
+    for _ in range(3):
+        call(breaker, failed=True)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failure_rate == 1.0
+
+
+def test_stays_closed_below_threshold(loop):
+    breaker = make_breaker(loop)
+
+    for failed in (False, True, False, True, False, True):
+        call(breaker, failed=failed)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failure_rate == 0.5
+
+
+def test_opens_above_threshold(loop):
+    breaker = make_breaker(loop)
+    open_circuit(breaker)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_slow_calls_count_as_failed(loop):
+    breaker = make_breaker(loop, slow_call_duration=1.0)
+
+    for _ in range(4):
+        call(breaker, failed=False, duration=2.0)
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_abandoned_calls_do_not_count(loop):
+    breaker = make_breaker(loop)
+
+    for _ in range(10):
+        call(breaker, failed=None)
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failure_rate == 0.0
+
+
+def test_half_open_after_open_duration(loop):
+    breaker = make_breaker(loop)
+    open_circuit(breaker)
+    loop.now += 4.9
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+    loop.now += 0.1
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_half_open_limits_probe_calls(loop):
+    breaker = make_breaker(loop)
+    open_circuit(breaker)
+    loop.now += 5.0
+
+    assert breaker.acquire() is True
+
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_half_open_closes_after_successful_probes(loop):
+    breaker = make_breaker(loop, probe_calls=2)
+    open_circuit(breaker)
+    loop.now += 5.0
+
+    assert call(breaker, failed=False) is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert call(breaker, failed=False) is True
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # The failures from before the circuit opened are forgotten.
+    assert breaker.failure_rate == 0.0
+    assert breaker.acquire() is False
+
+
+def test_half_open_reopens_after_failed_probe(loop):
+    breaker = make_breaker(loop)
+    open_circuit(breaker)
+    loop.now += 5.0
+
+    assert call(breaker, failed=True) is True
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # The circuit opens for another full duration.
+    loop.now += 4.9
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+    loop.now += 0.1
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_half_open_reopens_after_slow_probe(loop):
+    breaker = make_breaker(loop, slow_call_duration=1.0)
+    open_circuit(breaker)
+    loop.now += 5.0
+    call(breaker, failed=False, duration=2.0)
+
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_abandoned_probe_frees_its_slot(loop):
+    breaker = make_breaker(loop)
+    open_circuit(breaker)
+    loop.now += 5.0
+
+    assert call(breaker, failed=None) is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert call(breaker, failed=False) is True
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_calls_from_before_opening_are_ignored(loop):
+    breaker = make_breaker(loop)
+    probe = breaker.acquire()
+    open_circuit(breaker)
+    loop.now += 5.0
+
+    # A call that started while closed completes during the probe.
+    breaker.release(0.0, False, probe)
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert call(breaker, failed=False) is True
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,37 @@
+import pytest
+
+from pylar.common import (
+    PRIORITY_BULK,
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+    get_priority,
+)
+
+
+def test_get_priority_default():
+    assert get_priority({}) == PRIORITY_NORMAL
+
+
+@pytest.mark.parametrize('priority', [
+    PRIORITY_CONTROL,
+    PRIORITY_NORMAL,
+    PRIORITY_BULK,
+    15,
+])
+def test_get_priority(priority):
+    assert get_priority({'priority': priority}) == priority
+
+
+@pytest.mark.parametrize('priority, expected', [
+    (-1, PRIORITY_CONTROL),
+    (-10 ** 9, PRIORITY_CONTROL),
+    (PRIORITY_BULK + 1, PRIORITY_BULK),
+    (10 ** 9, PRIORITY_BULK),
+])
+def test_get_priority_out_of_range(priority, expected):
+    assert get_priority({'priority': priority}) == expected
+
+
+@pytest.mark.parametrize('priority', ['0', 1.5, None, True, [0]])
+def test_get_priority_invalid(priority):
+    assert get_priority({'priority': priority}) == PRIORITY_NORMAL
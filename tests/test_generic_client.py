@@ -0,0 +1,300 @@
+import asyncio
+import pytest
+
+from pylar.common import serialize_header
+from pylar.generic_client import GenericClient
+
+
+class QueueClient(GenericClient):
+    """
+    A generic client that reads and writes frames through queues.
+    """
+    def __init__(self, *, inbox, outbox, handler=None, **kwargs):
+        super().__init__(**kwargs)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.handler = handler
+        self.headers = []
+
+    async def _read(self):
+        return await self.inbox.get()
+
+    async def _write(self, frames, priority=None):
+        await self.outbox.put(list(frames))
+
+    async def _on_request(self, frames, header):
+        self.headers.append(header)
+
+        return await self.handler(frames)
+
+    async def request(self, frames, timeout=None):
+        return await self._request(frames, timeout=timeout)
+
+
+class Handler(object):
+    """
+    A request handler that records its calls and waits to be released.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.started = asyncio.Event(loop=loop)
+        self.release = asyncio.Event(loop=loop)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self, frames):
+        self.calls += 1
+        self.started.set()
+
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+        return frames
+
+
+def close(loop, *clients):
+    for client in clients:
+        client.close()
+
+    loop.run_until_complete(
+        asyncio.gather(
+            *(client.wait_closed() for client in clients),
+            loop=loop
+        ),
+    )
+
+
+@pytest.fixture
+def handler(event_loop):
+    return Handler(event_loop)
+
+
+@pytest.fixture
+def server(request, event_loop, handler):
+    """
+    A generic client whose other end is driven by the test, frame by frame.
+    """
+    client = QueueClient(
+        inbox=asyncio.Queue(loop=event_loop),
+        outbox=asyncio.Queue(loop=event_loop),
+        handler=handler,
+        loop=event_loop,
+    )
+    request.addfinalizer(lambda: close(event_loop, client))
+
+    return client
+
+
+@pytest.fixture
+def pair(request, event_loop, handler):
+    """
+    Two generic clients connected to one another.
+    """
+    forward = asyncio.Queue(loop=event_loop)
+    backward = asyncio.Queue(loop=event_loop)
+    client = QueueClient(inbox=backward, outbox=forward, loop=event_loop)
+    server = QueueClient(
+        inbox=forward,
+        outbox=backward,
+        handler=handler,
+        loop=event_loop,
+    )
+    request.addfinalizer(lambda: close(event_loop, client, server))
+
+    return client, server
+
+
+async def send_request(server, header, request_id=b'1'):
+    await server.inbox.put(
+        [b'request', request_id, serialize_header(header), b'foo'],
+    )
+
+
+async def get_response(server, timeout=1.0):
+    return await asyncio.wait_for(
+        server.outbox.get(),
+        timeout,
+        loop=server.loop,
+    )
+
+
+@pytest.mark.asyncio
+async def test_request_timeout_becomes_local_deadline(event_loop, pair):
+    client, server = pair
+    server.handler.release.set()
+    before = event_loop.time()
+    result = await client.request([b'foo'], timeout=5)
+    after = event_loop.time()
+
+    assert result == [b'foo']
+
+    header, = server.headers
+
+    assert header['timeout'] == 5
+    assert before + 5 <= header['deadline'] <= after + 5
+
+
+@pytest.mark.asyncio
+async def test_request_without_timeout_has_no_deadline(pair):
+    client, server = pair
+    server.handler.release.set()
+
+    assert await client.request([b'foo']) == [b'foo']
+    assert server.headers[0]['deadline'] is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('header', [
+    {'deadline': 'soon'},
+    {'deadline': 0},
+    {'deadline': [1, 2]},
+])
+async def test_remote_deadline_is_ignored(server, header):
+    server.handler.release.set()
+    await send_request(server, header)
+
+    assert await get_response(server) == [b'response', b'1', b'200', b'foo']
+    assert server.headers[0]['deadline'] is None
+
+
+@pytest.mark.asyncio
+async def test_remote_deadline_is_overwritten(event_loop, server):
+    server.handler.release.set()
+    before = event_loop.time()
+    await send_request(server, {'timeout': 2, 'deadline': 0})
+
+    assert await get_response(server) == [b'response', b'1', b'200', b'foo']
+    assert server.headers[0]['deadline'] >= before + 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('timeout', [
+    '1',
+    -1,
+    -0.5,
+    True,
+    [1],
+    {'seconds': 1},
+    float('inf'),
+    float('nan'),
+])
+async def test_invalid_timeout(server, timeout):
+    await send_request(server, {'timeout': timeout})
+    response = await get_response(server)
+
+    assert response[:3] == [b'response', b'1', b'400']
+    assert server.handler.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_invalid_timeout_does_not_stop_receiving(server):
+    server.handler.release.set()
+    await send_request(server, {'timeout': 'never'}, request_id=b'1')
+    await send_request(server, {'timeout': 1}, request_id=b'2')
+
+    assert (await get_response(server))[:3] == [b'response', b'1', b'400']
+    assert await get_response(server) == [b'response', b'2', b'200', b'foo']
+
+
+@pytest.mark.asyncio
+async def test_expired_deadline(server):
+    await send_request(server, {'timeout': 0})
+    response = await get_response(server)
+
+    assert response == [
+        b'response',
+        b'1',
+        b'504',
+        b'Request deadline exceeded.',
+    ]
+    assert server.handler.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_deadline_exceeded_while_processing(server):
+    await send_request(server, {'timeout': 0.05})
+    response = await get_response(server)
+
+    assert response[:3] == [b'response', b'1', b'504']
+    assert server.handler.calls == 1
+    assert server.handler.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_deadline_expired_while_queued(event_loop, handler):
+    server = QueueClient(
+        inbox=asyncio.Queue(loop=event_loop),
+        outbox=asyncio.Queue(loop=event_loop),
+        handler=handler,
+        max_concurrent_requests=1,
+        loop=event_loop,
+    )
+
+    try:
+        await send_request(server, {}, request_id=b'1')
+        await handler.started.wait()
+        await send_request(server, {'timeout': 0.05}, request_id=b'2')
+        response = await get_response(server)
+
+        assert response[:3] == [b'response', b'2', b'504']
+        assert handler.calls == 1
+
+        handler.release.set()
+
+        assert await get_response(server) == [
+            b'response',
+            b'1',
+            b'200',
+            b'foo',
+        ]
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_cancel_frame(event_loop, server):
+    await send_request(server, {})
+    await server.handler.started.wait()
+    await server.inbox.put([b'cancel', b'1'])
+    await asyncio.sleep(0.05, loop=event_loop)
+
+    assert server.handler.cancelled == 1
+
+    # Cancelled requests get no reply.
+    assert server.outbox.empty()
+
+
+@pytest.mark.asyncio
+async def test_cancel_frame_for_unknown_request(server):
+    server.handler.release.set()
+    await server.inbox.put([b'cancel', b'2'])
+    await send_request(server, {})
+
+    assert await get_response(server) == [b'response', b'1', b'200', b'foo']
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_cancels_remote(event_loop, pair):
+    client, server = pair
+    task = asyncio.ensure_future(client.request([b'foo']), loop=event_loop)
+    await server.handler.started.wait()
+    task.cancel()
+    await asyncio.sleep(0.05, loop=event_loop)
+
+    assert server.handler.cancelled == 1
+
+
+@pytest.mark.asyncio
+async def test_timed_out_request_cancels_remote(event_loop, pair):
+    client, server = pair
+
+    with pytest.raises(asyncio.TimeoutError):
+        await client.request([b'foo'], timeout=0.05)
+
+    await asyncio.sleep(0.05, loop=event_loop)
+
+    assert server.handler.cancelled == 1
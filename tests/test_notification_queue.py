@@ -0,0 +1,271 @@
+import os
+import pytest
+
+from pylar.errors import NotificationQueueFullError
+from pylar.notification_queue import (
+    DomainQueue,
+    NotificationQueue,
+)
+
+
+def make_frames(index):
+    return [b'notification', b'%d' % index]
+
+
+def get_segments(path):
+    return sorted(
+        filename
+        for filename in os.listdir(path)
+        if filename.endswith('.seg')
+    )
+
+
+@pytest.fixture
+def queue_path(tmpdir):
+    return str(tmpdir.join('queue'))
+
+
+def test_domain_queue_append_read(queue_path):
+    queue = DomainQueue(queue_path, segment_size=1024, max_size=65536)
+
+    try:
+        assert queue.empty
+        assert queue.read(10) == []
+
+        assert [queue.append(make_frames(i)) for i in range(3)] == [0, 1, 2]
+        assert not queue.empty
+        assert queue.read(10) == [(i, make_frames(i)) for i in range(3)]
+
+        # Nothing was acknowledged: reading again returns the same.
+        assert queue.read(2) == [(i, make_frames(i)) for i in range(2)]
+    finally:
+        queue.close()
+
+
+def test_domain_queue_ack(queue_path):
+    queue = DomainQueue(queue_path, segment_size=1024, max_size=65536)
+
+    try:
+        for i in range(5):
+            queue.append(make_frames(i))
+
+        notifications = queue.read(2)
+        queue.ack(notifications[-1][0])
+
+        assert queue.acked_seq == 2
+        assert queue.read(10) == [(i, make_frames(i)) for i in range(2, 5)]
+
+        # Acknowledging older notifications again does nothing.
+        queue.ack(0)
+
+        assert queue.acked_seq == 2
+
+        queue.ack(4)
+
+        assert queue.empty
+        assert queue.read(10) == []
+    finally:
+        queue.close()
+
+
+def test_domain_queue_read_across_segments(queue_path):
+    queue = DomainQueue(queue_path, segment_size=64, max_size=65536)
+
+    try:
+        for i in range(20):
+            queue.append(make_frames(i))
+
+        assert len(get_segments(queue_path)) > 1
+
+        seqs = []
+
+        while not queue.empty:
+            notifications = queue.read(3)
+            seqs.extend(seq for seq, _ in notifications)
+            queue.ack(notifications[-1][0])
+
+        assert seqs == list(range(20))
+    finally:
+        queue.close()
+
+
+def test_domain_queue_ack_drops_delivered_segments(queue_path):
+    queue = DomainQueue(queue_path, segment_size=64, max_size=65536)
+
+    try:
+        for i in range(20):
+            queue.append(make_frames(i))
+
+        segments = get_segments(queue_path)
+        queue.ack(18)
+
+        assert get_segments(queue_path) == segments[-1:]
+        assert queue.read(10) == [(19, make_frames(19))]
+
+        queue.ack(19)
+
+        assert get_segments(queue_path) == []
+        assert queue.size == 0
+
+        # Appending starts a new segment.
+        assert queue.append(make_frames(20)) == 20
+        assert queue.read(10) == [(20, make_frames(20))]
+    finally:
+        queue.close()
+
+
+def test_domain_queue_max_size(queue_path):
+    queue = DomainQueue(queue_path, segment_size=64, max_size=256)
+
+    try:
+        for i in range(100):
+            queue.append(make_frames(i))
+
+        assert queue.size <= 256 + 64
+
+        # The oldest notifications were dropped.
+        notifications = queue.read(100)
+
+        assert notifications[0][0] > 0
+        assert notifications[0][0] == queue.acked_seq
+        assert notifications[-1] == (99, make_frames(99))
+        assert [seq for seq, _ in notifications] == list(
+            range(notifications[0][0], 100),
+        )
+    finally:
+        queue.close()
+
+
+def test_domain_queue_reopen(queue_path):
+    queue = DomainQueue(queue_path, segment_size=64, max_size=65536)
+
+    try:
+        for i in range(10):
+            queue.append(make_frames(i))
+
+        queue.ack(3)
+    finally:
+        queue.close()
+
+    queue = DomainQueue(queue_path, segment_size=64, max_size=65536)
+
+    try:
+        assert queue.acked_seq == 4
+        assert queue.read(100) == [(i, make_frames(i)) for i in range(4, 10)]
+        assert queue.append(make_frames(10)) == 10
+    finally:
+        queue.close()
+
+
+def test_domain_queue_reopen_truncates_incomplete_notification(queue_path):
+    queue = DomainQueue(queue_path, segment_size=1024, max_size=65536)
+
+    try:
+        for i in range(3):
+            queue.append(make_frames(i))
+    finally:
+        queue.close()
+
+    segment_path = os.path.join(queue_path, get_segments(queue_path)[-1])
+
+    with open(segment_path, 'ab') as file:
+        file.write(b'\0\0\0')
+
+    queue = DomainQueue(queue_path, segment_size=1024, max_size=65536)
+
+    try:
+        assert queue.read(100) == [(i, make_frames(i)) for i in range(3)]
+        assert queue.append(make_frames(3)) == 3
+        assert queue.read(100)[-1] == (3, make_frames(3))
+    finally:
+        queue.close()
+
+
+def test_notification_queue_only_queues_known_domains(queue_path):
+    queue = NotificationQueue(queue_path)
+
+    try:
+        assert not queue.is_known(b'user/alice')
+        assert not queue.has_pending(b'user/alice')
+
+        queue.add_domain(b'user/alice')
+
+        assert queue.is_known(b'user/alice')
+        assert not queue.has_pending(b'user/alice')
+
+        queue.append(b'user/alice', make_frames(0))
+
+        assert queue.has_pending(b'user/alice')
+        assert queue.size > 0
+
+        queue.ack(b'user/alice', 0)
+
+        assert not queue.has_pending(b'user/alice')
+        assert queue.size == 0
+    finally:
+        queue.close()
+
+
+def test_notification_queue_reopen(queue_path):
+    queue = NotificationQueue(queue_path)
+
+    try:
+        queue.add_domain(b'user/alice')
+        queue.add_domain(b'user/bob')
+        queue.append(b'user/alice', make_frames(0))
+    finally:
+        queue.close()
+
+    queue = NotificationQueue(queue_path)
+
+    try:
+        assert queue.is_known(b'user/alice')
+        assert queue.is_known(b'user/bob')
+        assert queue.has_pending(b'user/alice')
+        assert not queue.has_pending(b'user/bob')
+        assert queue.get(b'user/alice').read(10) == [(0, make_frames(0))]
+        assert queue.size > 0
+    finally:
+        queue.close()
+
+
+def test_notification_queue_max_queues(queue_path):
+    queue = NotificationQueue(queue_path, max_queues=2)
+
+    try:
+        for domain in (b'user/alice', b'user/bob', b'user/carol'):
+            queue.add_domain(domain)
+
+        queue.append(b'user/alice', make_frames(0))
+        queue.append(b'user/bob', make_frames(0))
+
+        with pytest.raises(NotificationQueueFullError):
+            queue.append(b'user/carol', make_frames(0))
+
+        # Open queues still accept notifications.
+        queue.append(b'user/alice', make_frames(1))
+
+        # Delivered queues are closed, which makes room for others.
+        queue.ack(b'user/bob', 0)
+        queue.release(b'user/bob')
+        queue.append(b'user/carol', make_frames(0))
+    finally:
+        queue.close()
+
+
+def test_notification_queue_max_total_size(queue_path):
+    queue = NotificationQueue(queue_path, max_total_size=256)
+
+    try:
+        queue.add_domain(b'user/alice')
+
+        with pytest.raises(NotificationQueueFullError):
+            for i in range(100):
+                queue.append(b'user/alice', make_frames(i))
+
+        assert 256 <= queue.size < 512
+
+        queue.ack(b'user/alice', i - 1)
+        queue.append(b'user/alice', make_frames(i))
+    finally:
+        queue.close()
@@ -0,0 +1,100 @@
+import pytest
+
+from pylar.arithmetic_service import ArithmeticService
+from pylar.errors import CallError
+from pylar.service import Service
+
+
+class RecordingService(Service):
+    name = 'recording'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = []
+
+    @Service.notification_handler(use_context=True)
+    async def forward(self, context, *args):
+        self.received.append(('forward', context.domain, list(args)))
+
+    @Service.notification_handler(use_context=True)
+    async def hello(self, context, *args):
+        self.received.append(('hello', context.domain, list(args)))
+
+
+@pytest.fixture
+def peers(cluster):
+    """
+    Two peered brokers, with the services on the second one.
+    """
+    endpoint_a = cluster.endpoint()
+    endpoint_b = cluster.endpoint()
+    broker_b = cluster.broker(endpoint_b)
+    broker_a = cluster.broker(
+        endpoint_a,
+        peer_sockets=[cluster.connect(endpoint_b)],
+    )
+    client_b = cluster.client(endpoint_b)
+    cluster.authentication_service(client_b)
+    arithmetic = cluster.service(ArithmeticService, client_b)
+    recording = cluster.service(RecordingService, client_b)
+    alice = cluster.user(cluster.client(endpoint_a))
+
+    return broker_a, broker_b, arithmetic, recording, alice
+
+
+@pytest.mark.asyncio
+async def test_request_through_peer(cluster, peers):
+    _, _, arithmetic, _, alice = peers
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+
+    assert await alice.method_call(
+        b'service/arithmetic',
+        'sum',
+        (1, 2),
+        timeout=5,
+    ) == 3
+
+
+@pytest.mark.asyncio
+async def test_notification_through_peer(cluster, peers):
+    _, _, _, recording, alice = peers
+    await recording.wait_registered()
+    await alice.wait_registered()
+    await alice.notification(b'service/recording', 'hello', [b'world'])
+    await cluster.wait_for(lambda: recording.received)
+
+    assert recording.received == [('hello', b'user/alice', [b'world'])]
+
+
+@pytest.mark.asyncio
+async def test_forward_notification_through_peer(cluster, peers):
+    _, _, _, recording, alice = peers
+    await recording.wait_registered()
+    await alice.wait_registered()
+
+    # Services may use any notification type, including the ones peers use
+    # among themselves.
+    await alice.notification(b'service/recording', 'forward', [b'world'])
+    await cluster.wait_for(lambda: recording.received)
+
+    assert recording.received == [('forward', b'user/alice', [b'world'])]
+
+
+@pytest.mark.asyncio
+async def test_forward_notification_is_reserved_to_peers(cluster, peers):
+    _, _, _, recording, alice = peers
+    await recording.wait_registered()
+    await alice.wait_registered()
+
+    with pytest.raises(CallError) as error:
+        await alice.client._request([
+            b'forward_notification',
+            b'service/recording',
+            b'user/alice',
+            b'token',
+            b'hello',
+        ])
+
+    assert error.value.code == 403
+    assert recording.received == []
@@ -0,0 +1,163 @@
+import asyncio
+import pytest
+
+from pylar.arithmetic_service import ArithmeticService
+
+
+def fast_replica(cluster, endpoint, **kwargs):
+    return cluster.replica(
+        endpoint,
+        ping_interval=0.05,
+        ping_timeout=0.5,
+        **kwargs
+    )
+
+
+def make_flaky(replica, failures):
+    """
+    Make the pings of a replica fail.
+
+    :param replica: The replica.
+    :param failures: The number of pings to fail, or `None` to fail them
+        all.
+    :returns: A list that holds the outcome of each ping.
+    """
+    ping = replica._ping
+    outcomes = []
+
+    async def flaky_ping():
+        if failures is None or outcomes.count('failed') < failures:
+            outcomes.append('failed')
+            raise asyncio.TimeoutError
+
+        outcomes.append('ok')
+
+        return await ping()
+
+    replica._ping = flaky_ping
+
+    return outcomes
+
+
+@pytest.mark.asyncio
+async def test_replica_streams_sessions(cluster, endpoint):
+    replica = fast_replica(cluster, endpoint)
+    await cluster.wait_for(lambda: replica.synchronized)
+
+    # The session of the authentication service.
+    await cluster.wait_for(lambda: len(replica.sessions) == 1)
+
+    client = cluster.client(endpoint)
+    alice = cluster.user(client)
+    await alice.wait_registered()
+    await cluster.wait_for(lambda: len(replica.sessions) == 2)
+
+    # The broker forgets about the session once the connection is gone.
+    client.close()
+    await client.wait_closed()
+    client.socket.close()
+    await client.socket.wait_closed()
+    await cluster.wait_for(lambda: len(replica.sessions) == 1)
+
+
+@pytest.mark.asyncio
+async def test_replica_tolerates_missed_pings(cluster, endpoint):
+    replica = fast_replica(cluster, endpoint, max_missed_pings=3)
+    lost = []
+    replica.on_primary_lost.connect(lost.append)
+    await cluster.wait_for(lambda: replica.synchronized)
+    outcomes = make_flaky(replica, failures=2)
+    await cluster.wait_for(lambda: 'ok' in outcomes)
+
+    assert lost == []
+
+    # Replication went on.
+    alice = cluster.user(cluster.client(endpoint))
+    await alice.wait_registered()
+    await cluster.wait_for(lambda: len(replica.sessions) == 2)
+
+    # The count of missed pings starts over after a successful one.
+    make_flaky(replica, failures=2)
+    await asyncio.sleep(0.3, loop=cluster.loop)
+
+    assert lost == []
+
+
+@pytest.mark.asyncio
+async def test_replica_detects_lost_primary(cluster, endpoint):
+    replica = fast_replica(cluster, endpoint, max_missed_pings=3)
+    lost = []
+    replica.on_primary_lost.connect(lost.append)
+    await cluster.wait_for(lambda: replica.synchronized)
+    outcomes = make_flaky(replica, failures=None)
+    await cluster.wait_for(lambda: lost)
+
+    assert lost == [replica]
+    assert outcomes == ['failed'] * 3
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over(cluster):
+    primary_endpoint = cluster.endpoint()
+    standby_endpoint = cluster.endpoint()
+    primary_socket = cluster.listen(primary_endpoint)
+    primary = cluster.broker(socket=primary_socket)
+    standby = cluster.broker(
+        replicate_from=cluster.connect(primary_endpoint),
+    )
+    standby.on_promoted.connect(
+        lambda broker: broker.add_socket(cluster.listen(standby_endpoint)),
+    )
+    endpoints = [primary_endpoint, standby_endpoint]
+    clients = [
+        cluster.client(
+            endpoints=endpoints,
+            ping_interval=0.1,
+            ping_timeout=0.5,
+        )
+        for _ in range(2)
+    ]
+    cluster.authentication_service(clients[0])
+    arithmetic = cluster.service(ArithmeticService, clients[0])
+    alice = cluster.user(clients[1])
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+
+    assert standby.standby
+    assert await alice.method_call(
+        b'service/arithmetic',
+        'sum',
+        (1, 2),
+        timeout=5,
+    ) == 3
+
+    events = []
+    alice.on_unregistered.connect(events.append)
+    arithmetic.on_unregistered.connect(events.append)
+    connected = []
+
+    for client in clients:
+        client.on_connected.connect(connected.append)
+
+    # Leave the time for the registrations to reach the standby.
+    await asyncio.sleep(0.2, loop=cluster.loop)
+
+    primary.close()
+    await primary.wait_closed()
+    primary_socket.close()
+    await primary_socket.wait_closed()
+    standby.promote()
+
+    assert not standby.standby
+
+    await cluster.wait_for(lambda: len(connected) == 2)
+
+    assert await alice.method_call(
+        b'service/arithmetic',
+        'sum',
+        (1, 2),
+        timeout=5,
+    ) == 3
+
+    # The sessions were resumed: nobody had to register again.
+    assert events == []
@@ -0,0 +1,414 @@
+import asyncio
+import pytest
+
+from pylar.errors import CallError
+from pylar.rpc_client_proxy import RPCClientProxy
+from pylar.rpc_service import RPCService
+
+
+class SlowService(RPCService):
+    name = 'slow'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = []
+        self.cancelled = 0
+        self.release = asyncio.Event(loop=self.loop)
+
+    @RPCService.method()
+    async def get(self, x):
+        self.calls.append(x)
+
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+        return {'x': x}
+
+
+class FailingService(RPCService):
+    name = 'failing'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+        self.failures = []
+
+    def fail(self):
+        self.calls += 1
+
+        if self.failures:
+            raise CallError(code=self.failures.pop(0), message="Failed.")
+
+    @RPCService.method(idempotent=True)
+    def get(self):
+        self.fail()
+
+        return 'ok'
+
+    @RPCService.method()
+    def put(self):
+        self.fail()
+
+        return 'ok'
+
+
+class Stall(object):
+    """
+    Makes the next call to any instance of `HedgedService` hang.
+    """
+    def __init__(self):
+        self.armed = False
+        self.stalled = []
+        self.cancelled = []
+
+
+class HedgedService(RPCService):
+    name = 'hedged'
+
+    def __init__(self, *, tag, stall, **kwargs):
+        super().__init__(**kwargs)
+        self.tag = tag
+        self.stall = stall
+        self.calls = 0
+
+    async def run(self):
+        self.calls += 1
+
+        if self.stall.armed:
+            self.stall.armed = False
+            self.stall.stalled.append(self.tag)
+
+            try:
+                await asyncio.sleep(10, loop=self.loop)
+            except asyncio.CancelledError:
+                self.stall.cancelled.append(self.tag)
+                raise
+
+        return self.tag
+
+    @RPCService.method(idempotent=True)
+    async def get(self):
+        return await self.run()
+
+    @RPCService.method()
+    async def put(self):
+        return await self.run()
+
+
+class CoalescingRPCClientProxy(RPCClientProxy):
+    coalesce_method_calls = True
+
+
+class HedgingRPCClientProxy(RPCClientProxy):
+    hedge_method_calls = True
+    hedge_min_samples = 5
+
+
+@pytest.fixture
+def slow_service(cluster, endpoint):
+    return cluster.service(SlowService, cluster.client(endpoint))
+
+
+@pytest.fixture
+def failing_service(cluster, endpoint):
+    return cluster.service(FailingService, cluster.client(endpoint))
+
+
+@pytest.fixture
+def hedged_services(cluster, endpoint):
+    stall = Stall()
+    services = [
+        cluster.service(
+            HedgedService,
+            cluster.client(endpoint),
+            tag=tag,
+            stall=stall,
+        )
+        for tag in ('a', 'b')
+    ]
+
+    return stall, services
+
+
+@pytest.fixture
+def alice(cluster, endpoint):
+    return cluster.user(cluster.client(endpoint))
+
+
+@pytest.fixture
+def hedging_alice(cluster, endpoint):
+    return cluster.user(
+        cluster.client(endpoint),
+        proxy_class=HedgingRPCClientProxy,
+    )
+
+
+@pytest.fixture
+def coalescing_alice(cluster, endpoint):
+    return cluster.user(
+        cluster.client(endpoint),
+        proxy_class=CoalescingRPCClientProxy,
+    )
+
+
+def call_get(proxy, x, timeout=None):
+    return asyncio.ensure_future(
+        proxy.method_call(b'service/slow', 'get', (x,), timeout=timeout),
+        loop=proxy.loop,
+    )
+
+
+@pytest.mark.asyncio
+async def test_coalesced_calls(cluster, slow_service, coalescing_alice):
+    await slow_service.wait_registered()
+    await coalescing_alice.wait_registered()
+    tasks = [call_get(coalescing_alice, x % 2) for x in range(10)]
+    await cluster.wait_for(lambda: len(slow_service.calls) == 2)
+    slow_service.release.set()
+    results = await asyncio.gather(*tasks, loop=cluster.loop)
+
+    assert results == [{'x': x % 2} for x in range(10)]
+    assert sorted(slow_service.calls) == [0, 1]
+
+
+@pytest.mark.asyncio
+async def test_calls_are_not_coalesced_by_default(cluster, slow_service,
+                                                  alice):
+    await slow_service.wait_registered()
+    await alice.wait_registered()
+    tasks = [call_get(alice, 0) for _ in range(3)]
+    await cluster.wait_for(lambda: len(slow_service.calls) == 3)
+    slow_service.release.set()
+
+    assert await asyncio.gather(*tasks, loop=cluster.loop) == [{'x': 0}] * 3
+
+
+@pytest.mark.asyncio
+async def test_sequential_calls_are_not_coalesced(slow_service,
+                                                  coalescing_alice):
+    await slow_service.wait_registered()
+    await coalescing_alice.wait_registered()
+    slow_service.release.set()
+
+    for _ in range(3):
+        assert await call_get(coalescing_alice, 0) == {'x': 0}
+
+    assert slow_service.calls == [0, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_coalesced_call_timeout(cluster, slow_service,
+                                      coalescing_alice):
+    await slow_service.wait_registered()
+    await coalescing_alice.wait_registered()
+    impatient = call_get(coalescing_alice, 0, timeout=0.05)
+    patient = call_get(coalescing_alice, 0)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await impatient
+
+    # The shared call goes on for the callers that still wait for it.
+    slow_service.release.set()
+
+    assert await patient == {'x': 0}
+    assert slow_service.calls == [0]
+    assert slow_service.cancelled == 0
+
+
+@pytest.mark.asyncio
+async def test_abandoned_coalesced_call(cluster, slow_service,
+                                        coalescing_alice):
+    await slow_service.wait_registered()
+    await coalescing_alice.wait_registered()
+    tasks = [call_get(coalescing_alice, 0) for _ in range(2)]
+    await cluster.wait_for(lambda: slow_service.calls)
+
+    for task in tasks:
+        task.cancel()
+
+    # Once nobody waits for it, the shared call is cancelled remotely.
+    await cluster.wait_for(lambda: slow_service.cancelled)
+
+    slow_service.release.set()
+
+    assert await call_get(coalescing_alice, 0) == {'x': 0}
+    assert slow_service.calls == [0, 0]
+
+
+@pytest.mark.asyncio
+async def test_idempotent_call_is_retried(failing_service, alice):
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+    failing_service.failures = [503, 503]
+
+    assert await alice.method_call(
+        b'service/failing',
+        'get',
+        idempotent=True,
+    ) == 'ok'
+    assert failing_service.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_retries_are_limited(failing_service, alice):
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+    failing_service.failures = [503, 503, 503]
+
+    with pytest.raises(CallError) as error:
+        await alice.method_call(b'service/failing', 'get', idempotent=True)
+
+    assert error.value.code == 503
+    assert failing_service.calls == 1 + alice.max_retries
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('code', [400, 404, 500])
+async def test_only_some_errors_are_retried(failing_service, alice, code):
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+    failing_service.failures = [code]
+
+    with pytest.raises(CallError) as error:
+        await alice.method_call(b'service/failing', 'get', idempotent=True)
+
+    assert error.value.code == code
+    assert failing_service.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_non_idempotent_call_is_not_retried(failing_service, alice):
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+    await alice.describe(b'service/failing')
+    failing_service.failures = [503]
+
+    with pytest.raises(CallError):
+        await alice.method_call(b'service/failing', 'put')
+
+    assert failing_service.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_idempotent_methods_are_described(failing_service, alice):
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+
+    # Methods are not known to be idempotent until described.
+    failing_service.failures = [503]
+
+    with pytest.raises(CallError):
+        await alice.method_call(b'service/failing', 'get')
+
+    description = await alice.describe(b'service/failing')
+
+    assert description['methods']['get']['idempotent'] is True
+    assert description['methods']['put']['idempotent'] is False
+
+    failing_service.failures = [503]
+
+    assert await alice.method_call(b'service/failing', 'get') == 'ok'
+    assert failing_service.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_retry_budget(cluster, endpoint, failing_service):
+    class StingyRPCClientProxy(RPCClientProxy):
+        retry_budget_size = 1.0
+        retry_budget_ratio = 0.0
+
+    alice = cluster.user(
+        cluster.client(endpoint),
+        proxy_class=StingyRPCClientProxy,
+    )
+    await failing_service.wait_registered()
+    await alice.wait_registered()
+    failing_service.failures = [503] * 10
+
+    for _ in range(2):
+        with pytest.raises(CallError):
+            await alice.method_call(
+                b'service/failing',
+                'get',
+                idempotent=True,
+            )
+
+    # Only one retry could be afforded.
+    assert failing_service.calls == 3
+
+
+async def warm_up(proxy, method, samples):
+    for _ in range(samples):
+        await proxy.method_call(b'service/hedged', method)
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged(cluster, hedged_services, hedging_alice):
+    stall, services = hedged_services
+
+    for service in services:
+        await service.wait_registered()
+
+    await hedging_alice.wait_registered()
+    await hedging_alice.describe(b'service/hedged')
+    await warm_up(hedging_alice, 'get', hedging_alice.hedge_min_samples)
+    stall.armed = True
+    result = await hedging_alice.method_call(
+        b'service/hedged',
+        'get',
+        timeout=5,
+    )
+
+    # The copy went to the other instance, and the slow one was cancelled.
+    assert stall.stalled and result != stall.stalled[0]
+
+    await cluster.wait_for(lambda: stall.cancelled == stall.stalled)
+
+
+@pytest.mark.asyncio
+async def test_calls_are_not_hedged_without_samples(cluster, hedged_services,
+                                                    hedging_alice):
+    stall, services = hedged_services
+
+    for service in services:
+        await service.wait_registered()
+
+    await hedging_alice.wait_registered()
+    await hedging_alice.describe(b'service/hedged')
+    stall.armed = True
+
+    with pytest.raises(asyncio.TimeoutError):
+        await hedging_alice.method_call(
+            b'service/hedged',
+            'get',
+            timeout=0.2,
+        )
+
+    assert sum(service.calls for service in services) == 1
+
+
+@pytest.mark.asyncio
+async def test_non_idempotent_call_is_not_hedged(cluster, hedged_services,
+                                                 hedging_alice):
+    stall, services = hedged_services
+
+    for service in services:
+        await service.wait_registered()
+
+    await hedging_alice.wait_registered()
+    await hedging_alice.describe(b'service/hedged')
+    await warm_up(hedging_alice, 'put', hedging_alice.hedge_min_samples)
+    stall.armed = True
+
+    with pytest.raises(asyncio.TimeoutError):
+        await hedging_alice.method_call(
+            b'service/hedged',
+            'put',
+            timeout=0.2,
+        )
+
+    assert sum(service.calls for service in services) == \
+        hedging_alice.hedge_min_samples + 1
@@ -0,0 +1,197 @@
+import asyncio
+import pytest
+
+from pylar.rpc_service import (
+    MethodCache,
+    RPCService,
+)
+
+
+class SquareService(RPCService):
+    name = 'square'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = 0
+
+    @RPCService.method(cache=True)
+    def square(self, x):
+        self.calls += 1
+
+        return x * x
+
+    @RPCService.method(cache={'size': 2})
+    def bounded_square(self, x):
+        self.calls += 1
+
+        return x * x
+
+    @RPCService.method(cache={'size': 16, 'ttl': 0.1})
+    def fleeting_square(self, x):
+        self.calls += 1
+
+        return x * x
+
+    @RPCService.method(use_context=True, cache=True)
+    def whoami(self, context):
+        self.calls += 1
+
+        return context.domain.decode('utf-8')
+
+    @RPCService.method()
+    def uncached_square(self, x):
+        self.calls += 1
+
+        return x * x
+
+
+@pytest.fixture
+def service(cluster, endpoint):
+    return cluster.service(SquareService, cluster.client(endpoint))
+
+
+@pytest.fixture
+def alice(cluster, endpoint):
+    # The caller must not share the client of the service: local calls skip
+    # the cache.
+    return cluster.user(cluster.client(endpoint))
+
+
+@pytest.fixture
+def users(cluster, endpoint):
+    return (
+        cluster.user(cluster.client(endpoint), 'alice'),
+        cluster.user(cluster.client(endpoint), 'bob'),
+    )
+
+
+def test_method_cache():
+    cache = MethodCache(size=2)
+
+    assert cache.get('a') is None
+
+    cache.set('a', b'1')
+
+    assert cache.get('a') == b'1'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.set('b', b'2')
+    cache.set('c', b'3')
+
+    assert len(cache.results) == 2
+
+    cache.clear()
+
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_cached_method(service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+
+    for _ in range(5):
+        assert await alice.method_call(
+            b'service/square',
+            'square',
+            (3,),
+        ) == 9
+
+    assert service.calls == 1
+    assert service.get_cache_stats('square') == {
+        'hits': 4,
+        'misses': 1,
+        'size': 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_cached_method_arguments(service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+
+    assert await alice.method_call(b'service/square', 'square', (3,)) == 9
+    assert await alice.method_call(b'service/square', 'square', (4,)) == 16
+    assert await alice.method_call(
+        b'service/square',
+        'square',
+        kwargs={'x': 3},
+    ) == 9
+    assert service.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_uncached_method(service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+
+    for _ in range(3):
+        await alice.method_call(b'service/square', 'uncached_square', (3,))
+
+    assert service.calls == 3
+
+    with pytest.raises(KeyError):
+        service.get_cache_stats('uncached_square')
+
+
+@pytest.mark.asyncio
+async def test_invalidate_cache(service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+    await alice.method_call(b'service/square', 'square', (3,))
+    await alice.method_call(b'service/square', 'bounded_square', (3,))
+    service.invalidate_cache('square')
+    await alice.method_call(b'service/square', 'square', (3,))
+    await alice.method_call(b'service/square', 'bounded_square', (3,))
+
+    assert service.calls == 3
+
+    service.invalidate_cache()
+    await alice.method_call(b'service/square', 'square', (3,))
+    await alice.method_call(b'service/square', 'bounded_square', (3,))
+
+    assert service.calls == 5
+
+
+@pytest.mark.asyncio
+async def test_cache_size(service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+
+    for x in (1, 2, 3, 1):
+        await alice.method_call(b'service/square', 'bounded_square', (x,))
+
+    # The result for 1 was evicted by the one for 3.
+    assert service.calls == 4
+    assert service.get_cache_stats('bounded_square')['size'] == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_ttl(event_loop, service, alice):
+    await service.wait_registered()
+    await alice.wait_registered()
+    await alice.method_call(b'service/square', 'fleeting_square', (3,))
+    await alice.method_call(b'service/square', 'fleeting_square', (3,))
+
+    assert service.calls == 1
+
+    await asyncio.sleep(0.15, loop=event_loop)
+    await alice.method_call(b'service/square', 'fleeting_square', (3,))
+
+    assert service.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_cache_with_context(service, users):
+    alice, bob = users
+    await service.wait_registered()
+    await alice.wait_registered()
+    await bob.wait_registered()
+
+    assert await alice.method_call(b'service/square', 'whoami') == \
+        'user/alice'
+    assert await bob.method_call(b'service/square', 'whoami') == 'user/bob'
+    assert await alice.method_call(b'service/square', 'whoami') == \
+        'user/alice'
+    assert service.calls == 2
@@ -0,0 +1,136 @@
+import os
+import pytest
+import stat
+
+from pylar.arithmetic_service import ArithmeticService
+
+
+class Restartable(object):
+    """
+    A broker that can be restarted on the same endpoint.
+    """
+    def __init__(self, cluster, endpoint, **kwargs):
+        self.cluster = cluster
+        self.endpoint = endpoint
+        self.kwargs = kwargs
+        self.start()
+
+    def start(self):
+        self.socket = self.cluster.add(self.cluster.listen(self.endpoint))
+        self.broker = self.cluster.broker(socket=self.socket, **self.kwargs)
+
+    async def stop(self):
+        self.broker.close()
+        await self.broker.wait_closed()
+        self.socket.close()
+        await self.socket.wait_closed()
+
+    async def restart(self):
+        await self.stop()
+        self.start()
+
+
+@pytest.fixture
+def snapshot_path(tmpdir):
+    return str(tmpdir.join('snapshot'))
+
+
+def start(cluster, snapshot_path, **kwargs):
+    endpoint = cluster.endpoint()
+    restartable = Restartable(
+        cluster,
+        endpoint,
+        snapshot_path=snapshot_path,
+        **kwargs
+    )
+
+    # Fast pings let the clients notice the restart quickly.
+    client = cluster.client(endpoint, ping_interval=0.1, ping_timeout=0.5)
+    cluster.authentication_service(client)
+    arithmetic = cluster.service(ArithmeticService, client)
+    alice = cluster.user(
+        cluster.client(endpoint, ping_interval=0.1, ping_timeout=0.5),
+    )
+    events = []
+
+    for proxy in (arithmetic, alice):
+        proxy.on_registered.connect(
+            lambda proxy: events.append(('registered', proxy.domain)),
+        )
+        proxy.on_unregistered.connect(
+            lambda proxy: events.append(('unregistered', proxy.domain)),
+        )
+
+    return restartable, arithmetic, alice, events
+
+
+async def call_sum(alice):
+    return await alice.method_call(
+        b'service/arithmetic',
+        'sum',
+        (1, 2),
+        timeout=5,
+    )
+
+
+@pytest.mark.asyncio
+async def test_snapshot_is_private(cluster, snapshot_path):
+    # A leftover from a previous version, readable by everyone.
+    open(snapshot_path + '.tmp', 'w').close()
+    os.chmod(snapshot_path + '.tmp', 0o644)
+
+    restartable, arithmetic, alice, _ = start(cluster, snapshot_path)
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+    await restartable.broker.save_snapshot()
+
+    assert stat.S_IMODE(os.stat(snapshot_path).st_mode) == 0o600
+
+
+@pytest.mark.asyncio
+async def test_session_resumed_after_restart(cluster, snapshot_path):
+    restartable, arithmetic, alice, events = start(cluster, snapshot_path)
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+
+    assert await call_sum(alice) == 3
+
+    del events[:]
+    await restartable.restart()
+
+    assert await call_sum(alice) == 3
+
+    # The clients were not asked to register again.
+    assert events == []
+
+
+@pytest.mark.asyncio
+async def test_expired_session_registers_again(cluster, snapshot_path):
+    restartable, arithmetic, alice, events = start(
+        cluster,
+        snapshot_path,
+        session_restore_timeout=0,
+    )
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+    del events[:]
+    await restartable.restart()
+    await cluster.wait_for(
+        lambda: ('registered', b'user/alice') in events and
+        ('registered', b'service/arithmetic') in events,
+    )
+
+    assert await call_sum(alice) == 3
+    assert ('unregistered', b'user/alice') in events
+
+
+@pytest.mark.asyncio
+async def test_invalid_snapshot_is_ignored(cluster, snapshot_path):
+    with open(snapshot_path, 'wb') as file:
+        file.write(b'garbage')
+
+    _, arithmetic, alice, _ = start(cluster, snapshot_path)
+    await arithmetic.wait_registered()
+    await alice.wait_registered()
+
+    assert await call_sum(alice) == 3
@@ -0,0 +1,118 @@
+from pylar.topics import (
+    TopicTrie,
+    split_topic,
+)
+
+
+def test_split_topic():
+    assert split_topic(b'') == ()
+    assert split_topic(b'a') == (b'a',)
+    assert split_topic(b'a/b/c') == (b'a', b'b', b'c')
+
+
+def test_match_exact_topic():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b', 'x')
+
+    assert trie.match(b'a/b') == {'x'}
+
+
+def test_match_subtopics():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b', 'x')
+
+    assert trie.match(b'a/b/c') == {'x'}
+    assert trie.match(b'a/b/c/d') == {'x'}
+
+
+def test_match_does_not_match_parents_or_siblings():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b', 'x')
+
+    assert trie.match(b'a') == set()
+    assert trie.match(b'a/bc') == set()
+    assert trie.match(b'a/c') == set()
+    assert trie.match(b'') == set()
+
+
+def test_match_empty_topic_subscription_matches_everything():
+    trie = TopicTrie()
+    trie.subscribe(b'', 'x')
+
+    assert trie.match(b'') == {'x'}
+    assert trie.match(b'a') == {'x'}
+    assert trie.match(b'a/b/c') == {'x'}
+
+
+def test_match_several_subscribers():
+    trie = TopicTrie()
+    trie.subscribe(b'', 'x')
+    trie.subscribe(b'a', 'y')
+    trie.subscribe(b'a/b', 'z')
+    trie.subscribe(b'a/c', 't')
+
+    assert trie.match(b'a/b/c') == {'x', 'y', 'z'}
+    assert trie.match(b'a/c') == {'x', 'y', 't'}
+    assert trie.match(b'b') == {'x'}
+
+
+def test_unsubscribe():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b', 'x')
+    trie.subscribe(b'a/b', 'y')
+    trie.unsubscribe(b'a/b', 'x')
+
+    assert trie.match(b'a/b') == {'y'}
+    assert trie.get_topics('x') == set()
+    assert trie.get_topics('y') == {b'a/b'}
+
+
+def test_unsubscribe_unknown_topic():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b', 'x')
+    trie.unsubscribe(b'a', 'x')
+    trie.unsubscribe(b'a/b', 'y')
+    trie.unsubscribe(b'c', 'z')
+
+    assert trie.match(b'a/b') == {'x'}
+
+
+def test_unsubscribe_keeps_other_branches():
+    trie = TopicTrie()
+    trie.subscribe(b'a/b/c', 'x')
+    trie.subscribe(b'a', 'y')
+    trie.unsubscribe(b'a/b/c', 'x')
+
+    assert trie.match(b'a/b/c') == {'y'}
+
+    # The pruned nodes can be subscribed to again.
+    trie.subscribe(b'a/b/c', 'x')
+
+    assert trie.match(b'a/b/c') == {'x', 'y'}
+
+
+def test_remove_subscriber():
+    trie = TopicTrie()
+    trie.subscribe(b'a', 'x')
+    trie.subscribe(b'b/c', 'x')
+    trie.subscribe(b'b', 'y')
+    trie.remove_subscriber('x')
+
+    assert trie.get_topics('x') == set()
+    assert trie.match(b'a') == set()
+    assert trie.match(b'b/c') == {'y'}
+
+
+def test_remove_unknown_subscriber():
+    trie = TopicTrie()
+    trie.remove_subscriber('x')
+
+    assert trie.match(b'') == set()
+
+
+def test_get_topics_returns_a_copy():
+    trie = TopicTrie()
+    trie.subscribe(b'a', 'x')
+    trie.get_topics('x').add(b'b')
+
+    assert trie.get_topics('x') == {b'a'}
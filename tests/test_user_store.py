@@ -0,0 +1,111 @@
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pylar.security import (
+    hash_password,
+    verify_password,
+)
+from pylar.user_store import (
+    MemoryUserStore,
+    SQLiteUserStore,
+)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def user_store(request, tmpdir):
+    if request.param == 'memory':
+        store = MemoryUserStore()
+    else:
+        store = SQLiteUserStore(str(tmpdir.join('users.db')))
+
+    request.addfinalizer(store.close)
+
+    return store
+
+
+def test_user_store_get_unknown(user_store):
+    assert user_store.get(b'user/alice') is None
+
+
+def test_user_store_set_get(user_store):
+    user_store.set(b'user/alice', b'salt', b'hash')
+
+    assert user_store.get(b'user/alice') == (b'salt', b'hash')
+    assert user_store.get(b'user/bob') is None
+
+
+def test_user_store_set_replaces(user_store):
+    user_store.set(b'user/alice', b'salt', b'hash')
+    user_store.set(b'user/alice', b'salt2', b'hash2')
+
+    assert user_store.get(b'user/alice') == (b'salt2', b'hash2')
+
+
+def test_user_store_remove(user_store):
+    user_store.set(b'user/alice', b'salt', b'hash')
+    user_store.remove(b'user/alice')
+
+    assert user_store.get(b'user/alice') is None
+
+
+def test_user_store_remove_unknown(user_store):
+    with pytest.raises(KeyError):
+        user_store.remove(b'user/alice')
+
+
+def test_sqlite_user_store_persists(tmpdir):
+    path = str(tmpdir.join('users.db'))
+    store = SQLiteUserStore(path)
+    store.set(b'user/alice', b'salt', b'hash')
+    store.close()
+
+    store = SQLiteUserStore(path)
+
+    try:
+        assert store.get(b'user/alice') == (b'salt', b'hash')
+    finally:
+        store.close()
+
+
+def test_sqlite_user_store_use_after_close(tmpdir):
+    store = SQLiteUserStore(str(tmpdir.join('users.db')))
+    store.set(b'user/alice', b'salt', b'hash')
+    store.close()
+
+    assert store.get(b'user/alice') == (b'salt', b'hash')
+
+    store.close()
+
+
+def test_sqlite_user_store_threads(tmpdir):
+    store = SQLiteUserStore(str(tmpdir.join('users.db')))
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        executor.submit(store.set, b'user/alice', b'salt', b'hash').result()
+
+        assert store.get(b'user/alice') == (b'salt', b'hash')
+
+        # The worker thread must not reuse its closed connection.
+        store.close()
+
+        future = executor.submit(store.get, b'user/alice')
+
+        assert future.result() == (b'salt', b'hash')
+    finally:
+        executor.shutdown()
+        store.close()
+
+
+def test_verify_password():
+    hash = hash_password(b'password', b'salt')
+
+    assert verify_password(b'password', b'salt', hash)
+    assert not verify_password(b'passwore', b'salt', hash)
+    assert not verify_password(b'password', b'pepper', hash)
+
+
+def test_hash_password_is_salted():
+    assert hash_password(b'password', b'salt') != \
+        hash_password(b'password', b'pepper')